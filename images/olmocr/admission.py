@@ -0,0 +1,166 @@
+import math
+import threading
+import time
+from collections import deque
+
+import metrics
+from resize import visual_tokens
+
+
+class AdmissionError(RuntimeError):
+    """A request was turned away, `retry_after` seconds from now it may be accepted
+
+    `retry_after` is None when the request can never be accepted as it is.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(prompt, image, params):
+    """Estimate the KV cache tokens of a request, for every candidate it generates
+
+    Image tokens follow the processor's patching; the text is counted at about four
+    characters per token, which is cheaper than tokenizing it and close enough here.
+    """
+    _, max_new_tokens, num_return_sequences, _ = params
+    prompt_tokens = visual_tokens(*image.size) + len(prompt) // 4
+    return (prompt_tokens + int(max_new_tokens)) * max(1, int(num_return_sequences))
+
+
+class AdmissionController:
+    """Bounds the requests and estimated tokens waiting for or in generation
+
+    A request is admitted only if the totals stay within `max_requests` and
+    `max_tokens`, and its client holds fewer than `max_per_client` requests
+    (requests without a client, such as batch jobs, are only bound by the totals).
+    Requests above `request_tokens` on their own are always rejected. Limits of 0
+    are disabled. Rejections are immediate and carry a retry hint derived from how
+    fast admitted requests have been completing.
+    """
+
+    # Seconds of completions the retry hint is computed from
+    RATE_WINDOW = 60.0
+
+    def __init__(
+        self, max_requests=64, max_tokens=0, max_per_client=0, request_tokens=0
+    ):
+        self.max_requests = max(0, int(max_requests))
+        self.max_tokens = max(0, int(max_tokens))
+        self.max_per_client = max(0, int(max_per_client))
+        self.request_tokens = max(0, int(request_tokens))
+
+        self.requests = 0
+        self.tokens = 0
+        self.admitted = 0
+        self.rejected = {}
+        self._clients = {}
+        self._completed = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, client, tokens):
+        """Reserve room for a request, or raise AdmissionError"""
+        self._admit(client, tokens, reserve=True)
+
+    def check(self, client, tokens):
+        """Raise AdmissionError if a request would be turned away now, reserve nothing
+
+        Lets a caller refuse work up front, before the requests it will make are
+        known; each of them is still admitted on its own.
+        """
+        self._admit(client, tokens, reserve=False)
+
+    def _admit(self, client, tokens, reserve):
+        if self.request_tokens and tokens > self.request_tokens:
+            self._reject("too_large")
+            raise AdmissionError(
+                f"The request needs about {tokens} tokens, more than the limit of "
+                f"{self.request_tokens}; lower Max New Tokens or the number of sequences"
+            )
+
+        with self._lock:
+            if self.max_requests and self.requests >= self.max_requests:
+                reason = "queue_full"
+                retry_after = self._retry_after(requests=1)
+            elif (
+                self.max_tokens
+                and self.requests
+                and self.tokens + tokens > self.max_tokens
+            ):
+                # A request above the budget is still run once nothing else is
+                reason = "tokens_full"
+                retry_after = self._retry_after(
+                    tokens=self.tokens + tokens - self.max_tokens
+                )
+            elif (
+                self.max_per_client
+                and client is not None
+                and self._clients.get(client, 0) >= self.max_per_client
+            ):
+                reason = "client_limit"
+                retry_after = self._retry_after(requests=1)
+            else:
+                if reserve:
+                    self.requests += 1
+                    self.tokens += tokens
+                    self._clients[client] = self._clients.get(client, 0) + 1
+                    self.admitted += 1
+                return
+
+        self._reject(reason)
+        raise AdmissionError(
+            f"Server busy ({reason.replace('_', ' ')}), retry in {retry_after}s",
+            retry_after,
+        )
+
+    def release(self, client, tokens):
+        """Give back the room of an admitted request once it finished or was cancelled"""
+        with self._lock:
+            self.requests -= 1
+            self.tokens -= tokens
+            remaining = self._clients.get(client, 0) - 1
+            if remaining > 0:
+                self._clients[client] = remaining
+            else:
+                self._clients.pop(client, None)
+            now = time.monotonic()
+            self._completed.append((now, tokens))
+            self._trim(now)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "clients": len(self._clients),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "max_requests": self.max_requests,
+                "max_tokens": self.max_tokens,
+                "max_per_client": self.max_per_client,
+                "request_tokens": self.request_tokens,
+            }
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        metrics.observe_rejection(reason)
+
+    def _trim(self, now):
+        while self._completed and self._completed[0][0] < now - self.RATE_WINDOW:
+            self._completed.popleft()
+
+    def _retry_after(self, requests=0, tokens=0):
+        """Seconds until enough requests or tokens should have completed, at least 1"""
+        now = time.monotonic()
+        self._trim(now)
+        if not self._completed:
+            # Nothing completed lately, e.g. the model is still loading
+            return 10
+
+        span = max(1.0, now - self._completed[0][0])
+        request_rate = len(self._completed) / span
+        token_rate = sum(count for _, count in self._completed) / span
+        seconds = max(requests / request_rate, tokens / token_rate if token_rate else 0)
+        return min(300, max(1, math.ceil(seconds)))
@@ -0,0 +1,210 @@
+import json
+import threading
+from collections import OrderedDict
+
+from pypdf import PdfReader
+
+from olmocr.prompts.anchor import get_anchor_text
+
+# The page report helpers are private to olmocr, but reusing them keeps the anchor
+# text identical to get_anchor_text(..., pdf_engine="pdfreport") and scores the text
+# layer from the same parse. Releases without them fall back to get_anchor_text,
+# without text-layer scores.
+try:
+    from olmocr.prompts.anchor import (
+        BoundingBox,
+        ImageElement,
+        PageReport,
+        TextElement,
+        _linearize_pdf_report,
+        _mult,
+        _transform_point,
+    )
+
+    PAGE_REPORTS = True
+except ImportError:
+    PAGE_REPORTS = False
+
+from cache import DiskStore
+from textlayer import score_text_layer
+
+
+def page_report(page):
+    """Collect the text and image elements of a pypdf page, like olmocr's _pdf_report
+
+    Returns the PageReport and the page's text, extracted in the same pass.
+    """
+    resources = page.get("/Resources", {})
+    xobjects = resources.get("/XObject", {})
+    text_elements, image_elements = [], []
+
+    def visitor_body(text, cm, tm, font_dict, font_size):
+        txt2user = _mult(tm, cm)
+        text_elements.append(TextElement(text, txt2user[4], txt2user[5]))
+
+    def visitor_op(op, args, cm, tm):
+        if op == b"Do":
+            xobject = xobjects.get(args[0])
+            if xobject and xobject["/Subtype"] == "/Image":
+                # The image is placed according to the CTM
+                x0, y0 = _transform_point(0, 0, cm)
+                x1, y1 = _transform_point(1, 1, cm)
+                image_elements.append(
+                    ImageElement(
+                        args[0],
+                        BoundingBox(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)),
+                    )
+                )
+
+    text = page.extract_text(
+        visitor_text=visitor_body, visitor_operand_before=visitor_op
+    )
+    report = PageReport(
+        mediabox=BoundingBox.from_rectangle(page.mediabox),
+        text_elements=text_elements,
+        image_elements=image_elements,
+    )
+    return report, text
+
+
+class AnchorIndex:
+    """Anchor text of every page of one PDF, built from a single parse of the document
+
+    The PDF is opened on the first lookup and each page's text layer is only parsed
+    the first time that page is requested, so single-page requests pay for one page.
+    After that a page's anchor text is a dict lookup. pypdf is not thread safe, so
+    parsing is serialised by a lock. `text_layer` scores the page's text from the
+    same parse, for the text-layer fast path.
+    """
+
+    def __init__(self, pdf_path, target_length=4000):
+        self.pdf_path = pdf_path
+        self.target_length = target_length
+        self._reader = None
+        self._texts = {}
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def get(self, page_number):
+        text = self._texts.get(page_number)
+        if text is not None:
+            return text
+
+        with self._lock:
+            if page_number not in self._texts:
+                self._parse(page_number)
+            return self._texts[page_number]
+
+    def text_layer(self, page_number):
+        """Return the page's text and its score_text_layer signals, as one dict
+
+        Returns None when the installed olmocr has no page report helpers.
+        """
+        layer = self._layers.get(page_number)
+        if layer is not None:
+            return layer
+
+        with self._lock:
+            if page_number not in self._layers:
+                self._parse(page_number, keep_layer=True)
+            return self._layers[page_number]
+
+    def _parse(self, page_number, keep_layer=False):
+        if not PAGE_REPORTS:
+            # Every page is then sent to the model
+            self._texts[page_number] = get_anchor_text(
+                self.pdf_path,
+                page_number,
+                pdf_engine="pdfreport",
+                target_length=self.target_length,
+            )
+            if keep_layer:
+                self._layers[page_number] = None
+            return
+        if self._reader is None:
+            self._reader = PdfReader(self.pdf_path)
+        report, text = page_report(self._reader.pages[page_number - 1])
+        self._texts[page_number] = _linearize_pdf_report(
+            report, max_length=self.target_length
+        )
+        if keep_layer:
+            self._layers[page_number] = dict(
+                score_text_layer(report, text), text=text
+            )
+
+    def __len__(self):
+        return len(self._texts)
+
+
+class AnchorStore:
+    """Anchor text persisted per PDF digest, so a document is parsed once across restarts
+
+    Each document has one file in a DiskStore, named after its digest, with one JSON
+    line appended per page. Recently used documents are also kept in memory.
+    """
+
+    def __init__(self, directory, max_bytes, max_documents=64):
+        self.disk = DiskStore(directory, max_bytes)
+        self.max_documents = max(1, int(max_documents))
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        """Return the {page_number: text} mapping of a document, reading it if needed"""
+        with self._lock:
+            pages = self._documents.get(key)
+            if pages is not None:
+                self._documents.move_to_end(key)
+                return pages
+
+        pages = {}
+        data = self.disk.get(key)
+        for line in (data or b"").decode("utf-8").splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash may have left a partial last line
+                continue
+            pages[record["page"]] = record["text"]
+
+        with self._lock:
+            pages = self._documents.setdefault(key, pages)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return pages
+
+    @staticmethod
+    def make_key(digest, target_length):
+        return f"{digest}-{target_length}"
+
+    def get(self, digest, page_number, target_length=4000):
+        text = self._load(self.make_key(digest, target_length)).get(page_number)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    def put(self, digest, page_number, text, target_length=4000):
+        key = self.make_key(digest, target_length)
+        pages = self._load(key)
+        with self._lock:
+            if page_number in pages:
+                return
+            pages[page_number] = text
+        record = json.dumps({"page": page_number, "text": text}, ensure_ascii=False)
+        self.disk.append(key, (record + "\n").encode("utf-8"))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "documents": len(self._documents),
+            "disk_bytes": self.disk.current_bytes,
+            "disk_evictions": self.disk.evictions,
+        }
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from itertools import chain
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from pypdf.errors import PdfReadError
+
+from admission import AdmissionError
+
+# Errors caused by the request rather than the server: an invalid page range, a file
+# pypdf cannot read
+REQUEST_ERRORS = (ValueError, PdfReadError)
+
+
+class UploadTooLarge(Exception):
+    """Raised when an uploaded file exceeds the API's size limit"""
+
+
+def save_upload(upload, directory, max_bytes, chunk_size=1024 * 1024):
+    """Copy an upload into `directory`, keeping its extension, and return the path
+
+    Raises UploadTooLarge as soon as more than `max_bytes` (0 for no limit) have
+    been read, instead of copying the rest first.
+    """
+    extension = os.path.splitext(upload.filename or "")[1].lower()
+    fd, path = tempfile.mkstemp(suffix=extension, dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        size = 0
+        while True:
+            chunk = upload.file.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise UploadTooLarge(
+                    f"{upload.filename} is larger than "
+                    f"{max_bytes // (1024 * 1024)} MB"
+                )
+            f.write(chunk)
+    return path
+
+
+def client_id(request):
+    """Identify the caller of an API request, for admission control and fairness
+
+    The API key (`Authorization: Bearer ...` or `X-API-Key`) if any, else the
+    `X-Client-Id` header, else the address, which callers behind the same proxy or
+    NAT share. Keys are hashed, they are not kept in memory.
+    """
+    authorization = request.headers.get("authorization", "")
+    scheme, _, credentials = authorization.partition(" ")
+    key = request.headers.get("x-api-key") or (
+        credentials.strip() if scheme.lower() == "bearer" else ""
+    )
+    if key:
+        return "key:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    if request.headers.get("x-client-id"):
+        return "client:" + request.headers["x-client-id"]
+    if request.client is not None:
+        return "host:" + request.client.host
+    return None
+
+
+def page_result(filename, page_number, result, error):
+    """Return the JSON object of one page: its text, or its error"""
+    if error is None:
+        return {"file": filename, "page": page_number, "text": result}
+    entry = {"file": filename, "page": page_number, "error": str(error)}
+    if isinstance(error, AdmissionError):
+        entry["retry_after"] = error.retry_after
+    return entry
+
+
+def error_response(status, message, retry_after=None):
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+
+def request_error_response(error):
+    """Return the 422 of an unreadable PDF or the 400 of another request error"""
+    if isinstance(error, PdfReadError):
+        return error_response(422, f"Unreadable PDF: {error}")
+    return error_response(400, str(error))
+
+
+def create_api(
+    process_upload_pages,
+    get_status,
+    check_admission=None,
+    heartbeat=1.0,
+    allowed_extensions=(".pdf",),
+    max_upload_bytes=0,
+):
+    """Return the FastAPI app of the binary OCR API, see the README
+
+    `process_upload_pages(path, pages, temperature, max_new_tokens,
+    num_return_sequences, do_sample, select_best, client=, heartbeat=)` yields the
+    (page_number, result, error) of a file, or None while waiting; `get_status()`
+    returns the service status. `check_admission(client, max_new_tokens,
+    num_return_sequences)` raises AdmissionError when a request would be turned
+    away. Handlers run in FastAPI's thread pool.
+    """
+    api = FastAPI(
+        title="olmOCR API", docs_url="/v1/docs", openapi_url="/v1/openapi.json"
+    )
+
+    @api.post("/v1/ocr")
+    def ocr(
+        request: Request,
+        files: list[UploadFile] = File(...),
+        pages: str = Form("all"),
+        temperature: float = Form(0.8),
+        max_new_tokens: int = Form(50),
+        num_return_sequences: int = Form(1),
+        do_sample: bool = Form(True),
+        select_best: bool = Form(False),
+        stream: bool = Form(False),
+    ):
+        """OCR the pages of uploaded PDFs and images
+
+        Returns {"pages": [...]} once every page is done, or with `stream` one JSON
+        object per line as the pages finish. A request turned away by admission
+        control before it starts gets a 429 with a Retry-After header; pages turned
+        away later carry their error and `retry_after`.
+        """
+        for upload in files:
+            extension = os.path.splitext(upload.filename or "")[1].lower()
+            if extension not in allowed_extensions:
+                return error_response(
+                    415, f"Unsupported file format of {upload.filename!r}"
+                )
+        client = client_id(request)
+        if check_admission is not None:
+            try:
+                check_admission(client, max_new_tokens, num_return_sequences)
+            except AdmissionError as e:
+                if e.retry_after is None:
+                    return error_response(413, str(e))
+                return error_response(429, str(e), e.retry_after)
+
+        directory = tempfile.mkdtemp(prefix="olmocr-api-")
+        try:
+            paths = [
+                save_upload(upload, directory, max_upload_bytes) for upload in files
+            ]
+        except UploadTooLarge as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            return error_response(413, str(e))
+
+        def iter_results():
+            try:
+                for upload, path in zip(files, paths):
+                    for item in process_upload_pages(
+                        path,
+                        pages,
+                        temperature,
+                        max_new_tokens,
+                        num_return_sequences,
+                        do_sample,
+                        select_best,
+                        client=client,
+                        heartbeat=heartbeat,
+                    ):
+                        yield None if item is None else page_result(
+                            upload.filename, *item
+                        )
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        # Start on the first file, up to its first page or heartbeat, so that
+        # request errors are still answered with a status code
+        results = iter_results()
+        try:
+            first = next(results, None)
+        except REQUEST_ERRORS as e:
+            results.close()
+            return request_error_response(e)
+        if first is not None and "retry_after" in first:
+            results.close()
+            if first["retry_after"] is None:
+                return error_response(413, first["error"])
+            return error_response(429, first["error"], first["retry_after"])
+
+        results = chain([first] if first is not None else [], results)
+        if not stream:
+            try:
+                return {"pages": [entry for entry in results if entry is not None]}
+            except REQUEST_ERRORS as e:
+                return request_error_response(e)
+
+        def iter_lines():
+            try:
+                for entry in results:
+                    # An empty chunk sends nothing, but lets the server notice a
+                    # departed client, which closes the pending pages
+                    yield "" if entry is None else json.dumps(entry) + "\n"
+            except REQUEST_ERRORS as e:
+                yield json.dumps({"error": str(e)}) + "\n"
+
+        return StreamingResponse(iter_lines(), media_type="application/x-ndjson")
+
+    @api.get("/v1/status")
+    def status():
+        return get_status()
+
+    return api
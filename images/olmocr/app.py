@@ -1,37 +1,305 @@
 import os
-import torch
 import base64
-import urllib.request
 import tempfile
 import gradio as gr
-import shutil
+import mmap
+import threading
+import time
+import queue
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from functools import partial
 from io import BytesIO
 from PIL import Image
-from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
 
-from olmocr.data.renderpdf import render_pdf_to_base64png
 from olmocr.prompts import build_finetuning_prompt
-from olmocr.prompts.anchor import get_anchor_text
 
-# Initialize the model (globally to avoid reloading it on each request)
-print("Initializing the model...")
-model = Qwen2VLForConditionalGeneration.from_pretrained(
-    "allenai/olmOCR-7B-0225-preview", torch_dtype=torch.bfloat16
-).eval()
-processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct")
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
-print(f"Model loaded on {device}")
+import metrics
+from admission import AdmissionController, AdmissionError, estimate_tokens
+from anchors import AnchorStore
+from backends import OpenAIBackend, ReplicaBackend, TransformersBackend
+from cache import PageCache, ResultCache
+from downloader import DownloadError, Downloader
+from generation import (
+    CPU_MODE,
+    CPU_THREADS,
+    MODEL_NAME,
+    MODEL_REVISION,
+    PROCESSOR_NAME,
+    compiled_stats,
+    configure_cpu,
+    generate_batch,
+    make_engine,
+    prefix_cache_stats,
+)
+from pipeline import (
+    RENDER_CHUNK_PAGES,
+    chain_futures,
+    combine_futures,
+    extract_anchor_text,
+    extract_text_layer,
+    get_page_count,
+    get_render_executor,
+    get_render_threads,
+    iter_pipelined,
+    parse_page_range,
+    timed_call,
+)
+from render import RangeRenderer, render_page
+from replicas import ReplicaPool, parse_cpus, replica_specs
+from resize import downscale_to_budget, visual_tokens
+from scoring import best_candidate
+from scheduler import BatchScheduler
+from textlayer import TextLayerStats, page_response
+
+# Inference backend: "transformers" runs the model in this process, "openai" sends
+# requests to an OpenAI-compatible server such as sglang or vLLM
+BACKEND = os.environ.get("OLMOCR_BACKEND", "transformers")
+OPENAI_BASE_URL = os.environ.get("OLMOCR_OPENAI_BASE_URL", "http://localhost:30000/v1")
+OPENAI_MODEL = os.environ.get("OLMOCR_OPENAI_MODEL", MODEL_NAME)
+OPENAI_API_KEY = os.environ.get("OLMOCR_OPENAI_API_KEY")
+OPENAI_CONCURRENCY = int(os.environ.get("OLMOCR_OPENAI_CONCURRENCY", "16"))
+
+# What generates the outputs, part of every result cache key: the disk tier outlives
+# the process, a new checkpoint or backend must not be served the old outputs
+if BACKEND == "openai":
+    MODEL_IDENTITY = (BACKEND, OPENAI_BASE_URL, OPENAI_MODEL)
+else:
+    MODEL_IDENTITY = (BACKEND, MODEL_NAME, MODEL_REVISION, PROCESSOR_NAME)
+
+# Micro-batching settings for concurrent requests
+MAX_BATCH_SIZE = int(os.environ.get("OLMOCR_MAX_BATCH_SIZE", "4"))
+BATCH_WAIT_MS = float(os.environ.get("OLMOCR_BATCH_WAIT_MS", "50"))
+# Estimated KV cache tokens (prompt and output of every candidate) of one batch
+MAX_BATCH_TOKENS = int(os.environ.get("OLMOCR_MAX_BATCH_TOKENS", "40960"))
+
+# Model replicas in worker processes, see replicas.py. With 1 the model runs in this
+# process. Devices are assigned in turn, by default each CUDA device or the CPU;
+# CPU replicas split the available CPUs unless given CPU sets ("0-7;8-15")
+REPLICAS = int(os.environ.get("OLMOCR_REPLICAS", "1"))
+REPLICA_DEVICES = os.environ.get("OLMOCR_REPLICA_DEVICES", "")
+REPLICA_CPUS = os.environ.get("OLMOCR_REPLICA_CPUS", "")
+REPLICA_FACTORY = os.environ.get("OLMOCR_REPLICA_FACTORY", "generation:make_replica")
+REPLICA_HEALTH_TIMEOUT = float(os.environ.get("OLMOCR_REPLICA_HEALTH_TIMEOUT", "30"))
+REPLICA_STALL_TIMEOUT = float(os.environ.get("OLMOCR_REPLICA_STALL_TIMEOUT", "300"))
+
+# Admission control in front of generation, see admission.py. 0 disables a limit
+MAX_QUEUED_REQUESTS = int(os.environ.get("OLMOCR_MAX_QUEUED_REQUESTS", "64"))
+MAX_QUEUED_TOKENS = int(os.environ.get("OLMOCR_MAX_QUEUED_TOKENS", "327680"))
+MAX_QUEUED_PER_CLIENT = int(os.environ.get("OLMOCR_MAX_QUEUED_PER_CLIENT", "16"))
+
+# How often a streaming request checks whether its generation has failed
+STREAM_POLL_SECONDS = 1.0
+
+# Result cache settings, the disk tier is disabled when its budget is 0
+RESULT_CACHE_MB = float(os.environ.get("OLMOCR_RESULT_CACHE_MB", "64"))
+RESULT_CACHE_DIR = os.environ.get(
+    "OLMOCR_RESULT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "olmocr", "results"),
+)
+RESULT_CACHE_DISK_MB = float(os.environ.get("OLMOCR_RESULT_CACHE_DISK_MB", "1024"))
+
+# Rendered pages and anchor text reused across requests. Pages are kept as raw PPM
+# buffers, about 2.4 MB for a letter page at TARGET_LONGEST_IMAGE_DIM
+PAGE_CACHE_PAGES = int(os.environ.get("OLMOCR_PAGE_CACHE_PAGES", "100"))
+TARGET_LONGEST_IMAGE_DIM = 1024
+ANCHOR_TARGET_LENGTH = 4000
+
+# Largest number of visual tokens an image may cost, larger images are downscaled.
+# The default fits a square page rendered at TARGET_LONGEST_IMAGE_DIM, 0 disables it
+VISUAL_TOKEN_BUDGET = int(
+    os.environ.get(
+        "OLMOCR_VISUAL_TOKEN_BUDGET",
+        str(visual_tokens(TARGET_LONGEST_IMAGE_DIM, TARGET_LONGEST_IMAGE_DIM)),
+    )
+)
+
+# Per-document anchor text persisted by PDF digest, disabled when the budget is 0
+ANCHOR_INDEX_DIR = os.environ.get(
+    "OLMOCR_ANCHOR_INDEX_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "olmocr", "anchors"),
+)
+ANCHOR_INDEX_DISK_MB = float(os.environ.get("OLMOCR_ANCHOR_INDEX_DISK_MB", "256"))
+
+# PDF downloads, kept on disk and revalidated with ETag / Last-Modified
+DOWNLOAD_DIR = os.environ.get(
+    "OLMOCR_DOWNLOAD_DIR", os.path.join(tempfile.gettempdir(), "olmocr-downloads")
+)
+DOWNLOAD_MAX_MB = float(os.environ.get("OLMOCR_DOWNLOAD_MAX_MB", "200"))
+DOWNLOAD_TIMEOUT = float(os.environ.get("OLMOCR_DOWNLOAD_TIMEOUT", "300"))
+DOWNLOAD_CACHE_ENTRIES = int(os.environ.get("OLMOCR_DOWNLOAD_CACHE_ENTRIES", "64"))
+
+# Text-layer fast path, see textlayer.py: PDF pages whose text layer scores at least
+# the threshold are answered with their extracted text, without the model
+TEXT_LAYER = os.environ.get("OLMOCR_TEXT_LAYER", "0") == "1"
+TEXT_LAYER_THRESHOLD = float(os.environ.get("OLMOCR_TEXT_LAYER_THRESHOLD", "0.9"))
+# Such pages are not rendered for the model, the UI shows a smaller render of them
+PREVIEW_LONGEST_IMAGE_DIM = 512
+
+# Image formats accepted next to PDFs, and the anchor text used for them
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif", ".webp"]
+IMAGE_ANCHOR_TEXT = "Image analysis."
+
+
+# Binary HTTP API for machine clients, see api.py. When enabled the UI is mounted
+# next to it and served by uvicorn, without a Gradio share link
+API_ENABLED = os.environ.get("OLMOCR_API", "1") == "1"
+API_MAX_UPLOAD_MB = float(os.environ.get("OLMOCR_API_MAX_UPLOAD_MB", "200"))
+SERVER_PORT = int(os.environ.get("GRADIO_SERVER_PORT", "7860"))
+
+
+admission = AdmissionController(
+    MAX_QUEUED_REQUESTS,
+    MAX_QUEUED_TOKENS,
+    MAX_QUEUED_PER_CLIENT,
+    # A remote server manages its own memory, only bound local generation
+    request_tokens=MAX_BATCH_TOKENS if BACKEND == "transformers" else 0,
+)
+result_cache = ResultCache(
+    RESULT_CACHE_MB * 1024 * 1024,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_DISK_MB * 1024 * 1024,
+)
+page_cache = PageCache(PAGE_CACHE_PAGES)
+anchor_store = (
+    AnchorStore(ANCHOR_INDEX_DIR, ANCHOR_INDEX_DISK_MB * 1024 * 1024)
+    if ANCHOR_INDEX_DISK_MB > 0
+    else None
+)
+text_layer_stats = TextLayerStats(TEXT_LAYER_THRESHOLD) if TEXT_LAYER else None
+downloader = Downloader(
+    DOWNLOAD_DIR,
+    max_bytes=DOWNLOAD_MAX_MB * 1024 * 1024,
+    total_timeout=DOWNLOAD_TIMEOUT,
+    max_entries=DOWNLOAD_CACHE_ENTRIES,
+)
+
+if BACKEND == "openai":
+    backend = OpenAIBackend(
+        OPENAI_BASE_URL,
+        OPENAI_MODEL,
+        max_concurrency=OPENAI_CONCURRENCY,
+        api_key=OPENAI_API_KEY,
+    )
+elif BACKEND == "transformers" and REPLICAS > 1:
+    pool = ReplicaPool(
+        replica_specs(
+            REPLICAS,
+            [device.strip() for device in REPLICA_DEVICES.split(",") if device.strip()],
+            [parse_cpus(cpus) for cpus in REPLICA_CPUS.split(";") if cpus.strip()],
+        ),
+        factory=REPLICA_FACTORY,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=BATCH_WAIT_MS,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+        health_timeout=REPLICA_HEALTH_TIMEOUT,
+        stall_timeout=REPLICA_STALL_TIMEOUT,
+    )
+    backend = ReplicaBackend(pool)
+    metrics.REPLICA_UTILISATION.callback = pool.utilisation
+elif BACKEND == "transformers":
+    # The model runs in this process. It is loaded on first use, or in the
+    # background once the server starts
+    if CPU_MODE:
+        configure_cpu(CPU_THREADS or None)
+    engine = make_engine()
+    scheduler = BatchScheduler(
+        partial(generate_batch, engine),
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=BATCH_WAIT_MS,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+    )
+    backend = TransformersBackend(engine, scheduler)
+else:
+    raise ValueError(f"Unknown OLMOCR_BACKEND: {BACKEND}")
+metrics.QUEUE_DEPTH.callback = backend.queue_depth
+
+
+class StageTimings:
+    """Wall-clock durations of the I/O stages of one request, logged as one line"""
+
+    def __init__(self, label):
+        self.label = label
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - started
+
+    def log(self):
+        stages = ", ".join(
+            f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.stages.items()
+        )
+        print(f"I/O timings for {self.label}: {stages}")
 
 
-def download_pdf(url):
-    """Download a PDF from the specified URL"""
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+def map_file(path):
+    """Memory-map a file read-only, its pages are only read from disk when touched"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"{path} is empty")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def unmap(mapping):
+    """Close a mapping from map_file, and the file descriptor it holds"""
     try:
-        urllib.request.urlretrieve(url, temp_file.name)
-        return temp_file.name
-    except Exception as e:
-        return None, f"Error during PDF download: {str(e)}"
+        mapping.close()
+    except BufferError:
+        # Still read by a request that is being stopped, garbage collection closes it
+        pass
+
+
+def unmap_after(results, mapping):
+    """Yield the (text, image) updates of a mapped image file, then unmap it
+
+    The images are loaded as they are yielded, so that they do not read the mapping
+    once it is gone.
+    """
+    try:
+        for text, image in results:
+            if isinstance(image, Image.Image):
+                image.load()
+            yield text, image
+    finally:
+        unmap(mapping)
+
+
+def download_pdf(url):
+    """Download a PDF from the specified URL
+
+    Returns a path leased from the downloader, to hand back with
+    `downloader.release(path)` once done, and raises DownloadError on failure.
+    """
+    with metrics.stage("download"):
+        return downloader.fetch(url)
+
+
+def get_page_inputs(pdf_path, page_number):
+    """Return the rendered page and its anchor text, from the page cache when possible"""
+    page_number = int(page_number)
+    timings = StageTimings(f"{os.path.basename(pdf_path)} page {page_number}")
+    with timings.stage("digest"):
+        digest = page_cache.digest(pdf_path)
+    cached = page_cache.get(digest, page_number, TARGET_LONGEST_IMAGE_DIM)
+    if cached is not None:
+        timings.log()
+        return cached
+
+    # Pages are rendered to raw PPM buffers, there is no PNG or base64 to decode
+    with timings.stage("render"):
+        image_bytes = render_page(pdf_path, page_number, TARGET_LONGEST_IMAGE_DIM)
+    with timings.stage("anchor"):
+        anchor_text = submit_anchor_text(pdf_path, page_number, digest).result()
+    timings.log()
+    page_cache.put(
+        digest, page_number, TARGET_LONGEST_IMAGE_DIM, image_bytes, anchor_text
+    )
+    return image_bytes, anchor_text
 
 
 def process_pdf_url(
@@ -41,33 +309,54 @@ def process_pdf_url(
     max_new_tokens=50,
     num_return_sequences=1,
     do_sample=True,
+    select_best=False,
+    stream=False,
+    client=None,
 ):
     """Process a PDF from URL and generate output using olmOCR"""
     try:
-        # Download the PDF
-        pdf_path = download_pdf(url)
-        if pdf_path is None:
-            return "Error downloading the PDF", None
+        # Download the PDF, a URL seen before is only revalidated
+        try:
+            pdf_path = download_pdf(url)
+        except DownloadError as e:
+            result = f"Error downloading the PDF: {str(e)}", None
+            return iter([result]) if stream else result
 
         # Process the PDF
-        result, image = process_pdf_file(
-            pdf_path,
-            page_number,
-            temperature,
-            max_new_tokens,
-            num_return_sequences,
-            do_sample,
-        )
-
-        # Clean up temporary files
-        os.unlink(pdf_path)
-
-        return result, image
+        try:
+            result = process_pdf_file(
+                pdf_path,
+                page_number,
+                temperature,
+                max_new_tokens,
+                num_return_sequences,
+                do_sample,
+                select_best,
+                stream=stream,
+                client=client,
+            )
+        except BaseException:
+            downloader.release(pdf_path)
+            raise
+        if stream:
+            # The file is read until the stream is done
+            return release_after(result, pdf_path)
+        downloader.release(pdf_path)
+        return result
 
     except Exception as e:
         import traceback
 
-        return f"Error: {str(e)}\n{traceback.format_exc()}", None
+        result = f"Error: {str(e)}\n{traceback.format_exc()}", None
+        return iter([result]) if stream else result
+
+
+def release_after(results, pdf_path):
+    """Yield from `results`, then release the downloaded `pdf_path`"""
+    try:
+        yield from results
+    finally:
+        downloader.release(pdf_path)
 
 
 def process_pdf_file(
@@ -77,29 +366,47 @@ def process_pdf_file(
     max_new_tokens=50,
     num_return_sequences=1,
     do_sample=True,
+    select_best=False,
+    stream=False,
+    client=None,
 ):
-    """Process a local PDF and generate output using olmOCR"""
-    try:
-        # Render the PDF page as an image
-        image_base64 = render_pdf_to_base64png(
-            pdf_path, page_number, target_longest_image_dim=1024
-        )
+    """Process a local PDF and generate output using olmOCR
 
-        # Process the PDF with the generated base64
-        return process_pdf_base64(
-            image_base64,
+    With the text-layer fast path, a page whose text layer clears the threshold is
+    answered with its text before it is rendered, and shown with a preview render.
+    """
+    try:
+        if text_layer_stats is not None:
+            text = text_layer_page(pdf_path, int(page_number))
+            if text is not None:
+                result = text, render_preview(pdf_path, int(page_number))
+                return iter([result]) if stream else result
+
+        # Render the PDF page as an image, reusing earlier renders of the same document
+        image_bytes, anchor_text = get_page_inputs(pdf_path, page_number)
+
+        # Process the PDF with the rendered page
+        return process_image_bytes(
+            image_bytes,
             pdf_path,
             page_number,
             temperature,
             max_new_tokens,
             num_return_sequences,
             do_sample,
+            select_best,
+            anchor_text=anchor_text,
+            stream=stream,
+            client=client,
+            # The text layer was already turned down
+            text_layer=False,
         )
 
     except Exception as e:
         import traceback
 
-        return f"Error: {str(e)}\n{traceback.format_exc()}", None
+        result = f"Error: {str(e)}\n{traceback.format_exc()}", None
+        return iter([result]) if stream else result
 
 
 def process_file_upload(
@@ -109,59 +416,58 @@ def process_file_upload(
     max_new_tokens=50,
     num_return_sequences=1,
     do_sample=True,
+    select_best=False,
+    stream=False,
+    client=None,
 ):
-    """Process a file (PDF or image) uploaded by the user"""
-    try:
-        # Save the uploaded file temporarily
-        temp_file = tempfile.NamedTemporaryFile(
-            delete=False, suffix=os.path.splitext(file.name)[1]
-        )
-        temp_file.close()
-        shutil.copy(file.name, temp_file.name)
+    """Process a file (PDF or image) uploaded by the user
 
+    Gradio has already stored the upload on disk, so it is processed in place.
+    """
+    try:
         # Determine if it's a PDF or an image
-        file_extension = os.path.splitext(temp_file.name)[1].lower()
+        file_extension = os.path.splitext(file.name)[1].lower()
 
         if file_extension == ".pdf":
             # Process as PDF
-            result, image = process_pdf_file(
-                temp_file.name,
+            output = process_pdf_file(
+                file.name,
                 page_number,
                 temperature,
                 max_new_tokens,
                 num_return_sequences,
                 do_sample,
+                select_best,
+                stream=stream,
+                client=client,
             )
-        elif file_extension in [
-            ".jpg",
-            ".jpeg",
-            ".png",
-            ".bmp",
-            ".tiff",
-            ".tif",
-            ".webp",
-        ]:
+        elif file_extension in IMAGE_EXTENSIONS:
             # Process as image
-            result, image = process_image_file(
-                temp_file.name,
+            output = process_image_file(
+                file.name,
                 temperature,
                 max_new_tokens,
                 num_return_sequences,
                 do_sample,
+                select_best,
+                stream=stream,
+                client=client,
             )
         else:
-            result = f"Unsupported file format: {file_extension}. Please use PDF or images (JPG, PNG, etc.)"
-            image = None
-
-        # Clean up temporary files
-        os.unlink(temp_file.name)
+            output = (
+                f"Unsupported file format: {file_extension}. Please use PDF or images (JPG, PNG, etc.)",
+                None,
+            )
+            if stream:
+                output = iter([output])
 
-        return result, image
+        return output
 
     except Exception as e:
         import traceback
 
-        return f"Error: {str(e)}\n{traceback.format_exc()}", None
+        result = f"Error: {str(e)}\n{traceback.format_exc()}", None
+        return iter([result]) if stream else result
 
 
 def process_image_file(
@@ -170,33 +476,179 @@ def process_image_file(
     max_new_tokens=50,
     num_return_sequences=1,
     do_sample=True,
+    select_best=False,
+    stream=False,
+    client=None,
 ):
     """Process a local image and generate output using olmOCR"""
     try:
-        # Open the image
-        with open(image_path, "rb") as img_file:
-            img_data = img_file.read()
-            image_base64 = base64.b64encode(img_data).decode("utf-8")
-
-        # Use a generic anchor text for images
-        anchor_text = "Image analysis."
-
-        # Process the image with the generated base64
-        return process_pdf_base64(
-            image_base64,
-            None,  # No PDF path
-            1,  # Not applicable for images
-            temperature,
-            max_new_tokens,
-            num_return_sequences,
-            do_sample,
-            anchor_text=anchor_text,
-        )
+        # Map the encoded image instead of reading it, the decoder and the cache key
+        # read it straight from the page cache of the OS
+        timings = StageTimings(os.path.basename(image_path))
+        with timings.stage("map"):
+            image_bytes = map_file(image_path)
+        try:
+            with timings.stage("header"):
+                image = Image.open(image_bytes)
+            timings.log()
+
+            # Process the image bytes directly, with a generic anchor text for images
+            result = process_image_bytes(
+                image_bytes,
+                None,  # No PDF path
+                1,  # Not applicable for images
+                temperature,
+                max_new_tokens,
+                num_return_sequences,
+                do_sample,
+                select_best,
+                anchor_text=IMAGE_ANCHOR_TEXT,
+                image=image,
+                stream=stream,
+                client=client,
+            )
+        except BaseException:
+            unmap(image_bytes)
+            raise
+
+        # The request is done with the bytes once its last result is out
+        if stream:
+            return unmap_after(result, image_bytes)
+        text, image = result
+        if image is not None:
+            image.load()
+        unmap(image_bytes)
+        return text, image
 
     except Exception as e:
         import traceback
 
-        return f"Error: {str(e)}\n{traceback.format_exc()}", None
+        result = f"Error: {str(e)}\n{traceback.format_exc()}", None
+        return iter([result]) if stream else result
+
+
+def format_candidates(candidates, select_best=False):
+    """Return the text shown for the candidates generated for one page
+
+    A single candidate, or the best one with `select_best`, is shown as is. Several
+    candidates are listed with their sequence log-probabilities.
+    """
+    if select_best:
+        return best_candidate(candidates)["text"]
+    if len(candidates) == 1:
+        return candidates[0]["text"]
+
+    sections = []
+    for index, candidate in enumerate(candidates, start=1):
+        score = ""
+        if candidate["logprob"] is not None:
+            score = (
+                f" (log-prob {candidate['logprob']:.2f} "
+                f"over {candidate['tokens']} tokens)"
+            )
+        sections.append(f"=== Candidate {index}{score} ===\n{candidate['text']}")
+    return "\n\n".join(sections)
+
+
+def fit_image(image):
+    """Downscale an image that exceeds the visual token budget, logging the new size"""
+    width, height = image.size
+    with metrics.stage("resize"):
+        image = downscale_to_budget(image, VISUAL_TOKEN_BUDGET)
+    tokens = visual_tokens(*image.size)
+    if image.size != (width, height):
+        print(
+            f"Downscaled image from {width}x{height} to {image.width}x{image.height} "
+            f"({tokens} visual tokens, budget {VISUAL_TOKEN_BUDGET})"
+        )
+    metrics.observe_image(tokens)
+    return image
+
+
+def submit_page(
+    image_bytes,
+    anchor_text,
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    use_cache=None,
+    image=None,
+    streamer=None,
+    stop_event=None,
+    client=None,
+):
+    """Queue a page for generation and return the pending outputs with the page image
+
+    `image_bytes` is the encoded image, used as is for the cache key; `image` may be
+    given when the caller already decoded it. Results are served from the cache for
+    deterministic runs (`do_sample=False`); pass `use_cache=True` to also cache
+    sampled outputs, or False to bypass it. `streamer` and `stop_event` are handed
+    to the backend, see `stream_page`. Raises AdmissionError when the server is too
+    busy to queue the request of `client`.
+    """
+    prompt = build_finetuning_prompt(anchor_text)
+
+    # The same decoded image is fed to the model and displayed, it is never modified
+    # after being fitted to the visual token budget
+    if image is None:
+        image = Image.open(BytesIO(image_bytes))
+    image = fit_image(image)
+    rendered_image = image
+
+    params = (
+        float(temperature),
+        int(max_new_tokens),
+        int(num_return_sequences),
+        bool(do_sample),
+    )
+    if use_cache is None:
+        use_cache = not params[3]
+
+    if use_cache:
+        # The key is built from the original bytes, the budget decides what they become
+        cache_key = ResultCache.make_key(
+            image_bytes,
+            anchor_text,
+            prompt,
+            params + (VISUAL_TOKEN_BUDGET,),
+            MODEL_IDENTITY,
+        )
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future, rendered_image
+
+    # Reserve room for the request, then hand it to the backend, which batches or
+    # sends it concurrently
+    tokens = estimate_tokens(prompt, image, params)
+    admission.admit(client, tokens)
+    submitted = time.perf_counter()
+    try:
+        future = backend.submit(
+            prompt, image, image_bytes, params, streamer, stop_event, client
+        )
+    except BaseException:
+        admission.release(client, tokens)
+        raise
+    future.add_done_callback(lambda done: admission.release(client, tokens))
+    if text_layer_stats is not None:
+
+        def observe_model_page(done):
+            # The time a page answered from its text layer saves
+            if not done.cancelled() and done.exception() is None:
+                text_layer_stats.observe_model_page(time.perf_counter() - submitted)
+
+        future.add_done_callback(observe_model_page)
+    if use_cache:
+
+        def store_result(done):
+            if not done.cancelled() and done.exception() is None:
+                result_cache.put(cache_key, done.result())
+
+        future.add_done_callback(store_result)
+    return future, rendered_image
 
 
 def process_pdf_base64(
@@ -207,74 +659,747 @@ def process_pdf_base64(
     max_new_tokens=50,
     num_return_sequences=1,
     do_sample=True,
+    select_best=False,
     anchor_text=None,
+    use_cache=None,
+    stream=False,
+    client=None,
 ):
     """Process an image in base64 format and generate output using olmOCR"""
     try:
-        # If a PDF path was provided, get the anchor text
+        # Base64 only exists at this boundary, decode it once
+        image_bytes = base64.b64decode(image_base64)
+    except Exception as e:
+        result = f"Error: invalid base64 image: {str(e)}", None
+        return iter([result]) if stream else result
+
+    return process_image_bytes(
+        image_bytes,
+        pdf_path,
+        page_number,
+        temperature,
+        max_new_tokens,
+        num_return_sequences,
+        do_sample,
+        select_best,
+        anchor_text=anchor_text,
+        use_cache=use_cache,
+        stream=stream,
+        client=client,
+    )
+
+
+def process_image_bytes(
+    image_bytes,
+    pdf_path=None,
+    page_number=1,
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    select_best=False,
+    anchor_text=None,
+    use_cache=None,
+    image=None,
+    stream=False,
+    client=None,
+    text_layer=True,
+):
+    """Process an encoded image (PNG, JPEG, ...) and generate output using olmOCR
+
+    With `stream=True` an iterator of (partial_text, image) is returned instead of a
+    single (text, image) tuple, see `stream_page`. The page of `pdf_path` is
+    answered from its text layer when it clears the threshold, unless `text_layer`
+    is False.
+    """
+    try:
+        if pdf_path and text_layer and text_layer_stats is not None:
+            # Born-digital pages are answered from their text layer
+            text = text_layer_page(pdf_path, int(page_number))
+            if text is not None:
+                if image is None:
+                    image = Image.open(BytesIO(image_bytes))
+                return iter([(text, image)]) if stream else (text, image)
+
+        # If a PDF path was provided, get the anchor text from the document's index
         if pdf_path and not anchor_text:
-            anchor_text = get_anchor_text(
-                pdf_path, page_number, pdf_engine="pdfreport", target_length=4000
-            )
+            anchor_text = submit_anchor_text(
+                pdf_path, int(page_number), page_cache.digest(pdf_path)
+            ).result()
         elif not anchor_text:
             # If we don't have a PDF or a specified anchor text, use a generic anchor text
             anchor_text = "Document analysis."
 
-        prompt = build_finetuning_prompt(anchor_text)
-
-        # Build the complete prompt
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{image_base64}"},
-                    },
-                ],
-            }
-        ]
-
-        # Apply the chat template and processor
-        text = processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
+        if stream:
+            return stream_page(
+                image_bytes,
+                anchor_text,
+                temperature,
+                max_new_tokens,
+                num_return_sequences,
+                do_sample,
+                select_best,
+                use_cache=use_cache,
+                image=image,
+                client=client,
+            )
+
+        future, rendered_image = submit_page(
+            image_bytes,
+            anchor_text,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            use_cache=use_cache,
+            image=image,
+            client=client,
         )
-        main_image = Image.open(BytesIO(base64.b64decode(image_base64)))
+        return format_candidates(future.result(), select_best), rendered_image
 
-        # Display the image
-        rendered_image = main_image.copy()
+    except AdmissionError as e:
+        result = f"Error: {str(e)}", None
+        return iter([result]) if stream else result
+    except Exception as e:
+        import traceback
+
+        result = f"Error: {str(e)}\n{traceback.format_exc()}", None
+        return iter([result]) if stream else result
+
+
+def unchanged():
+    """Return the (text, image) update of a streaming handler that changes nothing"""
+    return gr.update(), gr.update()
+
+
+def stream_page(
+    image_bytes,
+    anchor_text,
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    select_best=False,
+    use_cache=None,
+    image=None,
+    client=None,
+):
+    """Yield (partial_text, image) as tokens are decoded
+
+    Closing the generator early (e.g. the user pressed Stop) stops the generation
+    instead of letting it run to `max_new_tokens`. Several return sequences cannot be
+    streamed, they are yielded once they are complete. While nothing new arrives,
+    an unchanged update is yielded every STREAM_POLL_SECONDS: that is when Gradio
+    closes the generators of clients that went away.
+    """
+    try:
+        streamer = None
+        if int(num_return_sequences) == 1:
+            streamer = backend.make_streamer(STREAM_POLL_SECONDS)
+        stop_event = threading.Event()
+        started = time.monotonic()
+        future, rendered_image = submit_page(
+            image_bytes,
+            anchor_text,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            use_cache=use_cache,
+            image=image,
+            streamer=streamer,
+            stop_event=stop_event,
+            client=client,
+        )
+
+        finished = False
+        try:
+            # Show the page right away while the request waits for the model
+            yield "", rendered_image
+
+            # Cached results never reach the streamer
+            if streamer is not None and not future.done():
+                text = ""
+                first_token_at = None
+                while True:
+                    try:
+                        chunk = next(streamer)
+                    except StopIteration:
+                        break
+                    except queue.Empty:
+                        # The end signal never comes if generation failed
+                        if future.done():
+                            break
+                        yield unchanged()
+                        continue
+
+                    if first_token_at is None and chunk:
+                        first_token_at = time.monotonic()
+                        print(f"Time to first token: {first_token_at - started:.2f}s")
+                    text += chunk
+                    yield text, rendered_image
+
+            while not wait([future], timeout=STREAM_POLL_SECONDS).done:
+                yield unchanged()
+            candidates = future.result()
+            finished = True
+            yield format_candidates(candidates, select_best), rendered_image
+        finally:
+            if not finished:
+                stop_event.set()
+                future.cancel()
+
+    except AdmissionError as e:
+        yield f"Error: {str(e)}", None
+    except Exception as e:
+        import traceback
 
-        inputs = processor(
-            text=[text],
-            images=[main_image],
-            padding=True,
-            return_tensors="pt",
+        yield f"Error: {str(e)}\n{traceback.format_exc()}", None
+
+
+def submit_anchor_text(pdf_path, page_number, digest):
+    """Return a Future of a page's anchor text, from the persisted index when possible
+
+    Otherwise the text comes from the per-document index of a worker process.
+    """
+    if anchor_store is not None:
+        anchor_text = anchor_store.get(digest, page_number, ANCHOR_TARGET_LENGTH)
+        if anchor_text is not None:
+            future = Future()
+            future.set_result(anchor_text)
+            return future
+
+    def unwrap(result):
+        # The extraction time is measured in the worker, without the pool's queueing
+        anchor_text, seconds = result
+        metrics.observe_stage("anchor", seconds)
+        return anchor_text
+
+    future = combine_futures(
+        [
+            get_render_executor().submit(
+                timed_call,
+                extract_anchor_text,
+                pdf_path,
+                page_number,
+                ANCHOR_TARGET_LENGTH,
+            )
+        ],
+        unwrap,
+    )
+    if anchor_store is not None:
+
+        def store_anchor_text(done):
+            if not done.cancelled() and done.exception() is None:
+                anchor_store.put(
+                    digest, page_number, done.result(), ANCHOR_TARGET_LENGTH
+                )
+
+        future.add_done_callback(store_anchor_text)
+    return future
+
+
+def submit_text_layer(pdf_path, page_number):
+    """Return a Future of a page's scored text layer and its extraction seconds"""
+    return get_render_executor().submit(
+        timed_call, extract_text_layer, pdf_path, page_number, ANCHOR_TARGET_LENGTH
+    )
+
+
+def use_text_layer(pdf_path, page_number, done):
+    """Decide from a finished submit_text_layer Future whether to skip the model
+
+    Records the decision and returns the page's text, in the structured output of
+    the model (see page_response), when its text layer clears the threshold, else
+    None.
+    """
+    layer, seconds = None, 0.0
+    if done.exception() is not None:
+        # Unreadable text layers go to the model, which reports real errors
+        print(
+            f"Could not score the text layer of page {page_number}: "
+            f"{done.exception()}"
+        )
+    else:
+        layer, seconds = done.result()
+        metrics.observe_stage("text_layer", seconds)
+    decision = text_layer_stats.record(
+        os.path.basename(pdf_path), page_number, layer, seconds
+    )
+    metrics.observe_text_layer(decision["source"], decision["saved_seconds"])
+    saved = decision["saved_seconds"]
+    print(
+        f"Page {page_number} of {decision['file']}: text layer score "
+        f"{decision['score']} (threshold {text_layer_stats.threshold}), "
+        f"answered by the {decision['source'].replace('_', ' ')}"
+        + (f", saved about {saved:.1f}s" if saved is not None else "")
+    )
+    if decision["source"] != "text_layer":
+        return None
+    return page_response(layer["text"])
+
+
+def text_layer_page(pdf_path, page_number):
+    """Return the text of a page when its text layer clears the threshold, else None"""
+    future = submit_text_layer(pdf_path, page_number)
+    wait([future])
+    return use_text_layer(pdf_path, page_number, future)
+
+
+def text_layer_submitter(pdf_path):
+    """Return a function submitting the text layer of a page of `pdf_path` once
+
+    The renderer of the document and the preparation of its pages share the Future
+    of each page, see make_renderer.
+    """
+    futures = {}
+    lock = threading.Lock()
+
+    def submit(page_number):
+        with lock:
+            if page_number not in futures:
+                futures[page_number] = submit_text_layer(pdf_path, page_number)
+            return futures[page_number]
+
+    return submit
+
+
+def goes_to_model(text_layer, page_number):
+    """Return whether a page goes to the model, waiting for its text layer"""
+    done = text_layer(page_number)
+    wait([done])
+    if done.exception() is not None:
+        return True
+    layer, _ = done.result()
+    return not text_layer_stats.accepts(layer)
+
+
+def render_preview(pdf_path, page_number):
+    """Return a small image of a page answered from its text layer, None on failure"""
+    try:
+        data = render_page(pdf_path, page_number, PREVIEW_LONGEST_IMAGE_DIM)
+        return Image.open(BytesIO(data))
+    except Exception as e:
+        print(f"Could not render a preview of page {page_number}: {e}")
+        return None
+
+
+def make_renderer(pdf_path, page_numbers, text_layer=None):
+    """Return a RangeRenderer rasterising `page_numbers` of a PDF in contiguous chunks
+
+    With `text_layer` (see text_layer_submitter), pages whose text layer clears the
+    threshold are left out of the chunks.
+    """
+    needs_render = None
+    if text_layer is not None and text_layer_stats is not None:
+        needs_render = partial(goes_to_model, text_layer)
+    return RangeRenderer(
+        pdf_path,
+        page_numbers,
+        get_render_threads(),
+        TARGET_LONGEST_IMAGE_DIM,
+        RENDER_CHUNK_PAGES,
+        needs_render,
+    )
+
+
+def submit_page_preparation(pdf_path, page_number, digest=None, renderer=None):
+    """Render a page and extract its anchor text in the worker pools, using the page cache
+
+    Pages are rendered by `renderer` when given (see make_renderer), so that a range
+    of pages shares one pdftoppm run. Returns a Future of
+    (page_number, image_bytes, anchor_text).
+    """
+    if digest is None:
+        digest = page_cache.digest(pdf_path)
+    cached = page_cache.get(digest, page_number, TARGET_LONGEST_IMAGE_DIM)
+    if cached is not None:
+        future = Future()
+        future.set_result((page_number,) + cached)
+        return future
+
+    if renderer is not None:
+        image_future = renderer.submit(page_number)
+    else:
+        image_future = get_render_threads().submit(
+            render_page, pdf_path, page_number, TARGET_LONGEST_IMAGE_DIM
         )
-        inputs = {key: value.to(device) for (key, value) in inputs.items()}
-
-        # Generate the output
-        output = model.generate(
-            **inputs,
-            temperature=temperature,
-            max_new_tokens=max_new_tokens,
-            num_return_sequences=num_return_sequences,
-            do_sample=do_sample,
+    anchor_future = submit_anchor_text(pdf_path, page_number, digest)
+    future = combine_futures(
+        [image_future, anchor_future],
+        lambda image_bytes, anchor_text: (page_number, image_bytes, anchor_text),
+    )
+
+    def store_page(done):
+        if not done.cancelled() and done.exception() is None:
+            _, image_bytes, anchor_text = done.result()
+            page_cache.put(
+                digest, page_number, TARGET_LONGEST_IMAGE_DIM, image_bytes, anchor_text
+            )
+
+    future.add_done_callback(store_page)
+    return future
+
+
+def prepare_pdf_page(
+    pdf_path, page_number, digest=None, renderer=None, text_layer=None
+):
+    """Prepare a PDF page for the model, unless its text layer can answer it
+
+    Returns a Future of (page_number, image_bytes, anchor_text) like
+    submit_page_preparation. With the text-layer fast path, pages whose text layer
+    clears the threshold are not rendered: their image_bytes are None and the page
+    text, in the model's output format, stands in for the anchor text. The text
+    layer is submitted with `text_layer` when given, see make_renderer.
+    """
+    if text_layer_stats is None:
+        return submit_page_preparation(pdf_path, page_number, digest, renderer)
+
+    def after_text_layer(done):
+        text = use_text_layer(pdf_path, page_number, done)
+        if text is None:
+            return submit_page_preparation(pdf_path, page_number, digest, renderer)
+        future = Future()
+        future.set_result((page_number, None, text))
+        return future
+
+    if text_layer is None:
+        text_layer = partial(submit_text_layer, pdf_path)
+    return chain_futures(text_layer(page_number), after_text_layer)
+
+
+def process_pdf_pages(
+    pdf_path,
+    pages="all",
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    select_best=False,
+    client=None,
+    heartbeat=None,
+    previews=False,
+):
+    """Process several pages of a local PDF, yielding (page_number, result, image, error)
+
+    A failed page has its error message as `result` and the exception as `error`.
+    Rendering and anchor text extraction run in worker pools a few pages ahead of
+    the model, so the GPU does not wait on the CPU between pages. Consecutive pages
+    are rasterised together, with one pdftoppm run per chunk of the range. With the
+    text-layer fast path, pages whose text layer clears the threshold are neither
+    rendered nor generated, and have no image unless `previews` asks for a small
+    render of them (see render_preview). With `heartbeat` seconds, None is yielded
+    whenever a page takes that long. Closing the generator cancels the queued pages
+    and stops the ones being generated.
+    """
+    page_numbers = parse_page_range(pages, get_page_count(pdf_path))
+    digest = page_cache.digest(pdf_path)
+    text_layer = text_layer_submitter(pdf_path)
+    renderer = make_renderer(pdf_path, page_numbers, text_layer)
+
+    def prepare(page_number):
+        return prepare_pdf_page(pdf_path, page_number, digest, renderer, text_layer)
+
+    def generate(prepared):
+        page_number, image_bytes, anchor_text = prepared
+        if image_bytes is None:
+            if previews:
+                return get_render_threads().submit(
+                    lambda: (anchor_text, render_preview(pdf_path, page_number))
+                )
+            future = Future()
+            future.set_result((anchor_text, None))
+            return future
+        stop_event = threading.Event()
+        future, rendered_image = submit_page(
+            image_bytes,
+            anchor_text,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            stop_event=stop_event,
+            client=client,
         )
+        # Attach the page image to the generated outputs
+        result = Future()
+
+        def attach_image(done):
+            if done.cancelled():
+                result.cancel()
+            elif done.exception() is not None:
+                result.set_exception(done.exception())
+            else:
+                result.set_result(
+                    (format_candidates(done.result(), select_best), rendered_image)
+                )
+
+        future.add_done_callback(attach_image)
+
+        def stop(done):
+            # Cancelling the page (e.g. the user pressed Stop) also unqueues the
+            # request, or stops it if it is being generated
+            if done.cancelled():
+                stop_event.set()
+                future.cancel()
+
+        result.add_done_callback(stop)
+        return result
+
+    for item in iter_pipelined(page_numbers, prepare, generate, heartbeat=heartbeat):
+        if item is None:
+            yield None
+            continue
+        page_number, output, error = item
+        if error is not None:
+            yield page_number, f"Error: {str(error)}", None, error
+        else:
+            yield page_number, output[0], output[1], None
+
+
+def check_admission(client, max_new_tokens=50, num_return_sequences=1):
+    """Raise AdmissionError if the server would turn away a request of `client` now
+
+    Used by the HTTP API before it starts on a file: only the output tokens are
+    counted, the pages are not known yet. Each page is still admitted on its own.
+    """
+    admission.check(
+        client, int(max_new_tokens) * max(1, int(num_return_sequences))
+    )
 
-        # Decode the output
-        prompt_length = inputs["input_ids"].shape[1]
-        new_tokens = output[:, prompt_length:]
-        text_output = processor.tokenizer.batch_decode(
-            new_tokens, skip_special_tokens=True
+
+def process_upload_pages(
+    path,
+    pages="all",
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    select_best=False,
+    client=None,
+    heartbeat=None,
+):
+    """Process the pages of a PDF or an image, yielding (page_number, result, error)
+
+    Used by the HTTP API (see api.py). A failed page has its error message as
+    `result` and the exception as `error`, e.g. an AdmissionError. With `heartbeat`
+    seconds, None is yielded while a page is pending. Closing the generator stops the
+    pending pages.
+    """
+    file_extension = os.path.splitext(path)[1].lower()
+    if file_extension == ".pdf":
+        for item in process_pdf_pages(
+            path,
+            pages,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            select_best,
+            client=client,
+            heartbeat=heartbeat,
+        ):
+            yield item if item is None else (item[0], item[1], item[3])
+        return
+    if file_extension not in IMAGE_EXTENSIONS:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+
+    stop_event = threading.Event()
+    try:
+        image_bytes = map_file(path)
+    except Exception as e:
+        yield 1, f"Error: {str(e)}", e
+        return
+    try:
+        future, _ = submit_page(
+            image_bytes,
+            IMAGE_ANCHOR_TEXT,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            image=Image.open(image_bytes),
+            stop_event=stop_event,
+            client=client,
         )
+    except Exception as e:
+        unmap(image_bytes)
+        yield 1, f"Error: {str(e)}", e
+        return
+    # Only the text is returned, the bytes are done with once the request is
+    future.add_done_callback(lambda done: unmap(image_bytes))
+
+    finished = False
+    try:
+        while not wait([future], timeout=heartbeat).done:
+            yield None
+        finished = True
+        if future.exception() is not None:
+            yield 1, f"Error: {str(future.exception())}", future.exception()
+        else:
+            yield 1, format_candidates(future.result(), select_best), None
+    finally:
+        if not finished:
+            stop_event.set()
+            future.cancel()
 
-        return text_output[0], rendered_image
+
+def process_document_upload(
+    file,
+    pages="all",
+    temperature=0.8,
+    max_new_tokens=50,
+    num_return_sequences=1,
+    do_sample=True,
+    select_best=False,
+    request: gr.Request = None,
+):
+    """Process a range of pages of an uploaded PDF, streaming results page by page"""
+    try:
+        if os.path.splitext(file.name)[1].lower() != ".pdf":
+            yield "Whole-document mode only supports PDF files", None
+            return
+
+        sections = []
+        for item in process_pdf_pages(
+            file.name,
+            pages,
+            temperature,
+            max_new_tokens,
+            num_return_sequences,
+            do_sample,
+            select_best,
+            client=client_id(request),
+            heartbeat=STREAM_POLL_SECONDS,
+            previews=True,
+        ):
+            if item is None:
+                # Lets Gradio close this generator if the client went away
+                yield unchanged()
+                continue
+            page_number, result, image, error = item
+            sections.append(f"--- Page {page_number} ---\n{result}")
+            # Keep the last image when a page has none, e.g. its preview failed
+            if image is None and error is None:
+                image = gr.update()
+            yield "\n\n".join(sections), image
 
     except Exception as e:
         import traceback
 
-        return f"Error: {str(e)}\n{traceback.format_exc()}", None
+        yield f"Error: {str(e)}\n{traceback.format_exc()}", None
+
+
+def client_id(request):
+    """Identify the user behind a Gradio request: the login, else the browser session
+
+    Users behind the same proxy or NAT share an address, so the address is only used
+    when Gradio gives neither. Gradio hands the request to the handlers through a
+    `gr.Request` parameter, which must come right after the inputs of the event.
+    """
+    if request is None:
+        return None
+    if getattr(request, "username", None):
+        return f"user:{request.username}"
+    if getattr(request, "session_hash", None):
+        return f"session:{request.session_hash}"
+    if getattr(request, "client", None) is not None:
+        return f"host:{request.client.host}"
+    return None
+
+
+def stream_pdf_url(
+    url,
+    page_number,
+    temperature,
+    max_new_tokens,
+    num_return_sequences,
+    do_sample,
+    select_best,
+    request: gr.Request = None,
+):
+    """Streaming handler for the PDF URL tab"""
+    yield from process_pdf_url(
+        url,
+        page_number,
+        temperature,
+        max_new_tokens,
+        num_return_sequences,
+        do_sample,
+        select_best,
+        stream=True,
+        client=client_id(request),
+    )
+
+
+def stream_file_upload(
+    file,
+    page_number,
+    temperature,
+    max_new_tokens,
+    num_return_sequences,
+    do_sample,
+    select_best,
+    request: gr.Request = None,
+):
+    """Streaming handler for the Upload File tab"""
+    yield from process_file_upload(
+        file,
+        page_number,
+        temperature,
+        max_new_tokens,
+        num_return_sequences,
+        do_sample,
+        select_best,
+        stream=True,
+        client=client_id(request),
+    )
+
+
+def stream_pdf_base64(
+    image_base64,
+    temperature,
+    max_new_tokens,
+    num_return_sequences,
+    do_sample,
+    select_best,
+    request: gr.Request = None,
+):
+    """Streaming handler for the Direct Base64 tab"""
+    yield from process_pdf_base64(
+        image_base64,
+        None,
+        1,
+        temperature,
+        max_new_tokens,
+        num_return_sequences,
+        do_sample,
+        select_best,
+        stream=True,
+        client=client_id(request),
+    )
+
+
+def get_service_status():
+    """Collect runtime statistics shown in the Status tab"""
+    return {
+        "backend": backend.status(),
+        "admission": admission.stats(),
+        "result_cache": result_cache.stats(),
+        "page_cache": page_cache.stats(),
+        # Replicas keep their prefix caches and compiled graphs in their processes
+        "prefix_cache": (
+            prefix_cache_stats() if backend.name == "transformers" else None
+        ),
+        "compiled_generation": (
+            compiled_stats() if backend.name == "transformers" else None
+        ),
+        "anchor_index": anchor_store.stats() if anchor_store is not None else None,
+        "text_layer": (
+            text_layer_stats.stats() if text_layer_stats is not None else None
+        ),
+        "downloads": downloader.stats(),
+    }
 
 
 # Create the Gradio interface
@@ -320,8 +1445,13 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                                 step=1,
                             )
                             do_sample_url = gr.Checkbox(label="Do Sample", value=True)
+                            select_best_url = gr.Checkbox(
+                                label="Pick Best Candidate", value=False
+                            )
 
-                    submit_btn_url = gr.Button("Analyze PDF", variant="primary")
+                    with gr.Row():
+                        submit_btn_url = gr.Button("Analyze PDF", variant="primary")
+                        stop_btn_url = gr.Button("Stop")
 
                 with gr.Column(scale=3):
                     with gr.Row():
@@ -331,8 +1461,8 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                         with gr.Column():
                             text_output_url = gr.Textbox(label="Result", lines=10)
 
-                submit_btn_url.click(
-                    fn=process_pdf_url,
+                event_url = submit_btn_url.click(
+                    fn=stream_pdf_url,
                     inputs=[
                         url_input,
                         page_number_url,
@@ -340,9 +1470,11 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                         max_new_tokens_url,
                         num_return_sequences_url,
                         do_sample_url,
+                        select_best_url,
                     ],
                     outputs=[text_output_url, image_output_url],
                 )
+                stop_btn_url.click(fn=None, cancels=[event_url])
 
                 gr.Markdown("### Example URL")
                 gr.Examples(
@@ -405,8 +1537,13 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                                 step=1,
                             )
                             do_sample_file = gr.Checkbox(label="Do Sample", value=True)
+                            select_best_file = gr.Checkbox(
+                                label="Pick Best Candidate", value=False
+                            )
 
-                    submit_btn_file = gr.Button("Analyze File", variant="primary")
+                    with gr.Row():
+                        submit_btn_file = gr.Button("Analyze File", variant="primary")
+                        stop_btn_file = gr.Button("Stop")
 
                 with gr.Column(scale=3):
                     with gr.Row():
@@ -418,8 +1555,8 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                         with gr.Column():
                             text_output_file = gr.Textbox(label="Result", lines=10)
 
-                submit_btn_file.click(
-                    fn=process_file_upload,
+                event_file = submit_btn_file.click(
+                    fn=stream_file_upload,
                     inputs=[
                         file_input,
                         page_number_file,
@@ -427,9 +1564,88 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                         max_new_tokens_file,
                         num_return_sequences_file,
                         do_sample_file,
+                        select_best_file,
                     ],
                     outputs=[text_output_file, image_output_file],
                 )
+                stop_btn_file.click(fn=None, cancels=[event_file])
+
+        with gr.TabItem("Whole Document"):
+            with gr.Row():
+                with gr.Column(scale=2):
+                    document_input = gr.File(
+                        label="Upload a PDF", file_types=[".pdf"]
+                    )
+                    pages_document = gr.Textbox(
+                        label="Pages",
+                        value="all",
+                        placeholder="all, or a range such as 1-5, 8",
+                    )
+
+                    with gr.Row():
+                        with gr.Column():
+                            temperature_document = gr.Slider(
+                                label="Temperature",
+                                minimum=0.0,
+                                maximum=1.0,
+                                value=0.8,
+                                step=0.1,
+                            )
+                            max_new_tokens_document = gr.Slider(
+                                label="Max New Tokens",
+                                minimum=10,
+                                maximum=5000,
+                                value=50,
+                                step=10,
+                            )
+
+                        with gr.Column():
+                            num_return_sequences_document = gr.Slider(
+                                label="Number of Returned Sequences",
+                                minimum=1,
+                                maximum=5,
+                                value=1,
+                                step=1,
+                            )
+                            do_sample_document = gr.Checkbox(
+                                label="Do Sample", value=True
+                            )
+                            select_best_document = gr.Checkbox(
+                                label="Pick Best Candidate", value=False
+                            )
+
+                    with gr.Row():
+                        submit_btn_document = gr.Button(
+                            "Analyze Document", variant="primary"
+                        )
+                        stop_btn_document = gr.Button("Stop")
+
+                with gr.Column(scale=3):
+                    with gr.Row():
+                        with gr.Column():
+                            image_output_document = gr.Image(
+                                label="Latest Page", type="pil"
+                            )
+
+                        with gr.Column():
+                            text_output_document = gr.Textbox(
+                                label="Result", lines=20
+                            )
+
+                event_document = submit_btn_document.click(
+                    fn=process_document_upload,
+                    inputs=[
+                        document_input,
+                        pages_document,
+                        temperature_document,
+                        max_new_tokens_document,
+                        num_return_sequences_document,
+                        do_sample_document,
+                        select_best_document,
+                    ],
+                    outputs=[text_output_document, image_output_document],
+                )
+                stop_btn_document.click(fn=None, cancels=[event_document])
 
         with gr.TabItem("Direct Base64"):
             with gr.Row():
@@ -466,8 +1682,15 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                             do_sample_base64 = gr.Checkbox(
                                 label="Do Sample", value=True
                             )
+                            select_best_base64 = gr.Checkbox(
+                                label="Pick Best Candidate", value=False
+                            )
 
-                    submit_btn_base64 = gr.Button("Analyze Image", variant="primary")
+                    with gr.Row():
+                        submit_btn_base64 = gr.Button(
+                            "Analyze Image", variant="primary"
+                        )
+                        stop_btn_base64 = gr.Button("Stop")
 
                 with gr.Column(scale=3):
                     with gr.Row():
@@ -479,20 +1702,59 @@ with gr.Blocks(title="olmOCR Document Analyzer") as demo:
                         with gr.Column():
                             text_output_base64 = gr.Textbox(label="Result", lines=10)
 
-                submit_btn_base64.click(
-                    fn=lambda b64, t, m, n, d: process_pdf_base64(
-                        b64, None, 1, t, m, n, d
-                    ),
+                event_base64 = submit_btn_base64.click(
+                    fn=stream_pdf_base64,
                     inputs=[
                         base64_input,
                         temperature_base64,
                         max_new_tokens_base64,
                         num_return_sequences_base64,
                         do_sample_base64,
+                        select_best_base64,
                     ],
                     outputs=[text_output_base64, image_output_base64],
                 )
+                stop_btn_base64.click(fn=None, cancels=[event_base64])
+
+        with gr.TabItem("Status"):
+            status_output = gr.JSON(label="Service Status")
+            refresh_btn_status = gr.Button("Refresh")
+            refresh_btn_status.click(
+                fn=get_service_status, inputs=[], outputs=[status_output]
+            )
+            demo.load(fn=get_service_status, inputs=[], outputs=[status_output])
 
 # Launch the app
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", share=True)
\ No newline at end of file
+    # Bind the server right away and report readiness while the model warms up
+    backend.start()
+    # Bound Gradio's own queue too, so that a burst is turned away instead of piling
+    # up, and run as many handlers as the backend generates requests at once
+    demo.queue(
+        default_concurrency_limit=backend.concurrency,
+        max_size=MAX_QUEUED_REQUESTS or None,
+    )
+    if API_ENABLED or metrics.ENABLED:
+        import uvicorn
+        from fastapi import FastAPI
+
+        from api import create_api
+
+        if API_ENABLED:
+            server = create_api(
+                process_upload_pages,
+                get_service_status,
+                check_admission,
+                heartbeat=STREAM_POLL_SECONDS,
+                allowed_extensions=[".pdf"] + IMAGE_EXTENSIONS,
+                max_upload_bytes=int(API_MAX_UPLOAD_MB * 1024 * 1024),
+            )
+        else:
+            server = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+        if metrics.ENABLED:
+            metrics.add_route(server)
+        # Mounted last, the UI at "/" would otherwise shadow the other routes
+        server = gr.mount_gradio_app(server, demo, path="/")
+        uvicorn.run(server, host="0.0.0.0", port=SERVER_PORT)
+    else:
+        demo.launch(server_name="0.0.0.0", share=True)
\ No newline at end of file
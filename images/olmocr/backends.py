@@ -0,0 +1,359 @@
+import base64
+import json
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Data URL types for the image formats PIL reports
+IMAGE_MIME_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "BMP": "image/bmp",
+    "TIFF": "image/tiff",
+}
+
+
+class QueueStreamer:
+    """Iterator of text chunks fed by a backend, compatible with TextIteratorStreamer
+
+    Iterating raises `queue.Empty` when no chunk arrives within `timeout` seconds,
+    so that callers can check whether the generation failed.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._end = object()
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self._queue.put(text)
+        if stream_end:
+            self._queue.put(self._end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._queue.get(timeout=self.timeout)
+        if chunk is self._end:
+            raise StopIteration()
+        return chunk
+
+
+class TransformersBackend:
+    """In-process HuggingFace generation behind the micro-batching scheduler"""
+
+    name = "transformers"
+
+    def __init__(self, engine, scheduler):
+        self.engine = engine
+        self.scheduler = scheduler
+
+    def start(self):
+        self.engine.start_background()
+
+    def make_streamer(self, timeout):
+        from transformers import TextIteratorStreamer
+
+        _, processor, _ = self.engine.get()
+        return TextIteratorStreamer(
+            processor.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=timeout,
+        )
+
+    def submit(
+        self,
+        prompt,
+        image,
+        image_bytes,
+        params,
+        streamer=None,
+        stop_event=None,
+        client=None,
+    ):
+        """Queue a request and return a Future of its candidates
+
+        Each candidate is a dict with the generated "text", its sequence "logprob"
+        and its number of "tokens" (both None when the backend cannot score it).
+        `client` identifies the sender, requests are scheduled fairly between them.
+        """
+        return self.scheduler.submit(
+            prompt, image, params, streamer, stop_event, client
+        )
+
+    @property
+    def concurrency(self):
+        """Requests generated at the same time"""
+        return self.scheduler.max_batch_size
+
+    def queue_depth(self):
+        return self.scheduler.stats()["queued"]
+
+    def status(self):
+        return {
+            "backend": self.name,
+            "model": self.engine.status(),
+            "scheduler": self.scheduler.stats(),
+        }
+
+
+class ReplicaBackend:
+    """Local generation spread over model replicas in worker processes
+
+    See replicas.ReplicaPool; each replica batches its own requests.
+    """
+
+    name = "replicas"
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def start(self):
+        self.pool.start()
+
+    def make_streamer(self, timeout):
+        return QueueStreamer(timeout=timeout)
+
+    def submit(
+        self,
+        prompt,
+        image,
+        image_bytes,
+        params,
+        streamer=None,
+        stop_event=None,
+        client=None,
+    ):
+        """Return a Future of the candidates, generated by the least loaded replica"""
+        return self.pool.submit(prompt, image, params, streamer, stop_event, client)
+
+    @property
+    def concurrency(self):
+        """Requests generated at the same time, a batch per replica"""
+        return self.pool.max_batch_size * len(self.pool.replicas)
+
+    def queue_depth(self):
+        return self.pool.queue_depth()
+
+    def status(self):
+        return {"backend": self.name, "replicas": self.pool.status()}
+
+
+class OpenAIBackend:
+    """OpenAI-compatible chat completions endpoint, such as sglang or vLLM
+
+    The server does continuous batching and paged KV caching, so requests are sent
+    concurrently over a pool of keep-alive connections instead of being batched here.
+    """
+
+    name = "openai"
+
+    def __init__(
+        self, base_url, model, max_concurrency=16, timeout=600, api_key=None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max(1, int(max_concurrency))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_concurrency, max_retries=0
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="olmocr-openai"
+        )
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._requests = 0
+        self._errors = 0
+
+    def start(self):
+        pass
+
+    def make_streamer(self, timeout):
+        return QueueStreamer(timeout=timeout)
+
+    def submit(
+        self,
+        prompt,
+        image,
+        image_bytes,
+        params,
+        streamer=None,
+        stop_event=None,
+        client=None,
+    ):
+        """Send a request from a pooled thread and return a Future of its candidates
+
+        The server schedules the requests it receives, `client` is not used here.
+        """
+        with self._lock:
+            self._waiting += 1
+        future = self._executor.submit(
+            self._complete, prompt, image, image_bytes, params, streamer, stop_event
+        )
+
+        def forget_cancelled(done):
+            # Requests cancelled while waiting never reach _complete
+            if done.cancelled():
+                with self._lock:
+                    self._waiting -= 1
+
+        future.add_done_callback(forget_cancelled)
+        return future
+
+    @property
+    def concurrency(self):
+        """Requests in flight to the server at the same time"""
+        return self.max_concurrency
+
+    def queue_depth(self):
+        return self._waiting
+
+    def status(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "base_url": self.base_url,
+                "model": self.model,
+                "max_concurrency": self.max_concurrency,
+                "waiting": self._waiting,
+                "in_flight": self._in_flight,
+                "requests": self._requests,
+                "errors": self._errors,
+            }
+
+    def _payload(self, prompt, image, image_bytes, params):
+        temperature, max_new_tokens, num_return_sequences, do_sample = params
+        # The HTTP API needs the image inline, this is the only place it is encoded
+        mime = IMAGE_MIME_TYPES.get(image.format)
+        if mime is None:
+            # Rendered pages are raw PPM buffers, which servers do not accept
+            buffer = BytesIO()
+            image.save(buffer, format="PNG")
+            image_bytes, mime = buffer.getvalue(), "image/png"
+        image_url = f"data:{mime};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": image_url}},
+                    ],
+                }
+            ],
+            "max_tokens": int(max_new_tokens),
+            "temperature": float(temperature) if do_sample else 0.0,
+            "n": int(num_return_sequences),
+            # Token log-probabilities score the candidates, only needed with several
+            "logprobs": int(num_return_sequences) > 1,
+        }
+
+    def _complete(self, prompt, image, image_bytes, params, streamer, stop_event):
+        with self._lock:
+            self._waiting -= 1
+            self._in_flight += 1
+            self._requests += 1
+        try:
+            payload = self._payload(prompt, image, image_bytes, params)
+            started = time.perf_counter()
+            candidates, usage = self._stream(
+                payload, streamer if payload["n"] == 1 else None, stop_event
+            )
+            elapsed = time.perf_counter() - started
+            metrics.observe_stage("generate", elapsed)
+            if usage:
+                metrics.observe_generation(
+                    usage.get("prompt_tokens", 0),
+                    usage.get("completion_tokens", 0),
+                    elapsed,
+                )
+            return candidates
+
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _stream(self, payload, streamer, stop_event):
+        """Run a completion over SSE, returning its candidates and token usage
+
+        Every request is streamed, whatever the number of candidates, so that a
+        stopped request can be aborted: closing the response aborts the generation
+        on the server. The text of a single candidate is also fed to `streamer`.
+        """
+        texts, logprobs, tokens = {}, {}, {}
+        usage = None
+        with self.session.post(
+            f"{self.base_url}/chat/completions",
+            json=dict(payload, stream=True, stream_options={"include_usage": True}),
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            try:
+                # Read each chunk of the chunked response as soon as it arrives, the
+                # default 512 byte reads would hold back short events
+                lines = response.iter_lines(chunk_size=None, decode_unicode=True)
+                for line in lines:
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:") :].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    for choice in chunk.get("choices") or []:
+                        index = choice.get("index", 0)
+                        text = (choice.get("delta") or {}).get("content") or ""
+                        texts[index] = texts.get(index, "") + text
+                        scored = (choice.get("logprobs") or {}).get("content") or []
+                        for token in scored:
+                            logprob = logprobs.get(index, 0.0) + token["logprob"]
+                            logprobs[index] = logprob
+                            tokens[index] = tokens.get(index, 0) + 1
+                        if streamer is not None and text:
+                            streamer.on_finalized_text(text)
+            finally:
+                if streamer is not None:
+                    streamer.on_finalized_text("", stream_end=True)
+
+        if stop_event is not None and stop_event.is_set():
+            # The output is truncated, do not return it
+            raise CancelledError()
+        candidates = [
+            {
+                "text": texts.get(index, ""),
+                "logprob": (
+                    round(logprobs[index], 4) if index in logprobs else None
+                ),
+                "tokens": tokens.get(index),
+            }
+            for index in range(payload["n"])
+        ]
+        return candidates, usage
@@ -0,0 +1,232 @@
+"""Headless, resumable bulk OCR of PDFs and images
+
+Writes one JSON record per page to the output JSONL file. The output doubles as the
+checkpoint: on restart, pages that already have a successful record are skipped, so
+an interrupted run resumes where it left off. Pages that failed are retried. With
+OLMOCR_TEXT_LAYER=1, born-digital PDF pages are answered from their text layer, and
+their records have "source": "text_layer" instead of "model".
+
+Usage:
+    python batch_ocr.py /data/archive -o /data/archive.jsonl
+    python batch_ocr.py --manifest files.txt -o results.jsonl --pages 1-3
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import app
+from pipeline import PAGE_LOOKAHEAD, get_page_count, iter_pipelined, parse_page_range
+
+SUPPORTED_EXTENSIONS = [".pdf"] + app.IMAGE_EXTENSIONS
+
+
+def collect_files(inputs, manifest=None):
+    """Expand directories and manifest entries into a sorted list of supported files"""
+    paths = list(inputs)
+    if manifest:
+        with open(manifest, "r", encoding="utf-8") as f:
+            paths.extend(line.strip() for line in f if line.strip())
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+
+    return sorted(
+        dict.fromkeys(
+            os.path.abspath(path)
+            for path in files
+            if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS
+        )
+    )
+
+
+def load_checkpoint(output_path):
+    """Return the (path, page) pairs already completed in an existing output file"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        # A crash may have left a partial last line, drop it before appending
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[: data.rfind(b"\n") + 1]
+
+    for line in data.decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("error") is None:
+            done.add((record["path"], record["page"]))
+    return done
+
+
+def list_work(files, pages, done):
+    """Return the (path, page) items still to process; images have a single page 1"""
+    work = []
+    for path in files:
+        try:
+            if os.path.splitext(path)[1].lower() == ".pdf":
+                page_numbers = parse_page_range(pages, get_page_count(path))
+            else:
+                page_numbers = [1]
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        work.extend(
+            (path, page_number)
+            for page_number in page_numbers
+            if (path, page_number) not in done
+        )
+    return work
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument("inputs", nargs="*", help="Files or directories to OCR")
+    parser.add_argument("--manifest", help="Text file listing one input path per line")
+    parser.add_argument("-o", "--output", required=True, help="Output JSONL file")
+    parser.add_argument("--pages", default="all", help="Pages of each PDF, e.g. 1-3")
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--max-new-tokens", type=int, default=3000)
+    parser.add_argument(
+        "--do-sample",
+        action="store_true",
+        help="Sample instead of greedy decoding (disables the result cache)",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=max(PAGE_LOOKAHEAD, 2 * app.MAX_BATCH_SIZE),
+        help="Pages prepared ahead of, and queued for, the model",
+    )
+    parser.add_argument(
+        "--progress-interval", type=float, default=10.0, help="Seconds between reports"
+    )
+    args = parser.parse_args()
+
+    files = collect_files(args.inputs, args.manifest)
+    if not files:
+        parser.error("no PDF or image files found in the given inputs")
+
+    done = load_checkpoint(args.output)
+    work = list_work(files, args.pages, done)
+    print(
+        f"{len(files)} files, {len(work)} pages to process, "
+        f"{len(done)} already done",
+        file=sys.stderr,
+    )
+    if not work:
+        return
+
+    app.backend.start()
+    io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="olmocr-read")
+
+    def read_image(path):
+        with open(path, "rb") as f:
+            return 1, f.read(), app.IMAGE_ANCHOR_TEXT
+
+    # One renderer per PDF, so that its remaining pages are rasterised in ranges
+    pdf_pages = {}
+    for path, page_number in work:
+        if os.path.splitext(path)[1].lower() == ".pdf":
+            pdf_pages.setdefault(path, []).append(page_number)
+    renderers = {}
+
+    def prepare(item):
+        path, page_number = item
+        if path not in pdf_pages:
+            return io_executor.submit(read_image, path)
+        if path not in renderers:
+            # Files are processed in order, the previous renderer is no longer needed
+            renderers.clear()
+            text_layer = app.text_layer_submitter(path)
+            renderers[path] = (
+                app.make_renderer(path, pdf_pages[path], text_layer),
+                text_layer,
+            )
+        renderer, text_layer = renderers[path]
+        return app.prepare_pdf_page(
+            path, page_number, renderer=renderer, text_layer=text_layer
+        )
+
+    def generate(prepared):
+        _, image_bytes, anchor_text = prepared
+        if image_bytes is None:
+            # Answered from the text layer, in the model's output format
+            future = Future()
+            future.set_result(
+                [
+                    {
+                        "text": anchor_text,
+                        "logprob": None,
+                        "tokens": None,
+                        "source": "text_layer",
+                    }
+                ]
+            )
+            return future
+        future, _ = app.submit_page(
+            image_bytes,
+            anchor_text,
+            args.temperature,
+            args.max_new_tokens,
+            1,
+            args.do_sample,
+        )
+        return future
+
+    started = time.monotonic()
+    last_report = started
+    completed = failed = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+        for (path, page_number), outputs, error in iter_pipelined(
+            work, prepare, generate, args.lookahead
+        ):
+            record = {
+                "path": path,
+                "page": page_number,
+                "text": outputs[0]["text"] if error is None else None,
+                "logprob": outputs[0]["logprob"] if error is None else None,
+                "source": outputs[0].get("source", "model") if error is None else None,
+                "error": None if error is None else f"{type(error).__name__}: {error}",
+            }
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            completed += 1
+            failed += error is not None
+
+            now = time.monotonic()
+            if now - last_report >= args.progress_interval or completed == len(work):
+                last_report = now
+                rate = completed / (now - started)
+                eta = (len(work) - completed) / rate if rate else 0
+                print(
+                    f"[{completed}/{len(work)}] {rate:.2f} pages/s, "
+                    f"{failed} failed, ETA {format_duration(eta)}",
+                    file=sys.stderr,
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compare the legacy base64 image path with the direct bytes path
+
+The legacy path read an image file, base64-encoded it, embedded the string in the
+chat message, decoded it back into a PIL image and copied that image for display.
+The direct path reads the bytes once and decodes a single image. Each run happens in
+a fresh subprocess so that peak RSS is measured independently for both paths.
+
+Usage:
+    python benchmarks/bench_image_path.py [--image scan.png] [--runs 5]
+"""
+
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+
+def make_fixture(path, width, height):
+    """Write a large noisy RGB PNG standing in for a high resolution scan"""
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    image.save(path, format="PNG", compress_level=1)
+
+
+def legacy_path(image_path):
+    with open(image_path, "rb") as img_file:
+        image_base64 = base64.b64encode(img_file.read()).decode("utf-8")
+    message_text = f"data:image/png;base64,{image_base64}"
+    main_image = Image.open(BytesIO(base64.b64decode(image_base64)))
+    rendered_image = main_image.copy()
+    main_image.load()
+    return len(message_text), rendered_image.size
+
+
+def direct_path(image_path):
+    with open(image_path, "rb") as img_file:
+        image_bytes = img_file.read()
+    main_image = Image.open(BytesIO(image_bytes))
+    main_image.load()
+    return len(image_bytes), main_image.size
+
+
+def run_once(mode, image_path):
+    """Run one path in this process and print latency and peak RSS as JSON"""
+    started = time.perf_counter()
+    (legacy_path if mode == "legacy" else direct_path)(image_path)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"mode": mode, "seconds": elapsed, "peak_rss_mb": peak_rss_mb}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", help="Image to use, a synthetic scan by default")
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=8000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", choices=["legacy", "direct"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_once(args.child, args.image)
+        return
+
+    image_path = args.image
+    if image_path is None:
+        fd, image_path = tempfile.mkstemp(suffix=".png")
+        os.close(fd)
+        make_fixture(image_path, args.width, args.height)
+
+    try:
+        size_mb = os.path.getsize(image_path) / (1024 * 1024)
+        print(f"Image: {image_path} ({size_mb:.1f} MB)")
+        results = {}
+        for mode in ("legacy", "direct"):
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, "--image", image_path],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                runs.append(json.loads(output))
+            results[mode] = {
+                "median_seconds": sorted(r["seconds"] for r in runs)[len(runs) // 2],
+                "max_peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+            }
+            print(
+                f"{mode:>6}: {results[mode]['median_seconds'] * 1000:8.1f} ms median, "
+                f"{results[mode]['max_peak_rss_mb']:8.1f} MB peak RSS"
+            )
+
+        legacy, direct = results["legacy"], results["direct"]
+        print(
+            f"Savings: {100 * (1 - direct['median_seconds'] / legacy['median_seconds']):.0f}% latency, "
+            f"{legacy['max_peak_rss_mb'] - direct['max_peak_rss_mb']:.1f} MB peak RSS"
+        )
+    finally:
+        if args.image is None:
+            os.unlink(image_path)
+
+
+if __name__ == "__main__":
+    main()
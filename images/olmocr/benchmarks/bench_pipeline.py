@@ -0,0 +1,323 @@
+"""Latency and throughput benchmark of the olmOCR request paths
+
+Drives process_pdf_file, process_image_file and process_pdf_base64 with generated
+fixture documents at one or more concurrency levels, and reports p50/p95/p99
+latency, pages/s and peak RSS. Results are saved as JSON; pass the file of an
+earlier run with --compare to print the change of each number.
+
+With --stub the model and processor are replaced by tiny stand-ins that sleep for
+a configurable prefill and per-token time, so the benchmark runs on a CPU-only box
+without downloading weights. The scheduler, caches and page preparation still run
+for real. The page and result caches are disabled unless --cache is given, so
+repeated requests measure the full path. With --replicas N the requests are served
+by N worker processes (see replicas.py), each with its own stub model.
+
+Usage:
+    python benchmarks/bench_pipeline.py --stub --concurrency 1,4 -o results.json
+    python benchmarks/bench_pipeline.py --stub --compare results.json
+    python benchmarks/bench_pipeline.py --stub --replicas 2 --concurrency 8
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+MODES = ("pdf", "image", "base64")
+
+
+class StubTokenizer:
+    pad_token_id = 0
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [
+            " ".join("token" for token in row.tolist() if token != self.pad_token_id)
+            for row in sequences
+        ]
+
+
+class StubProcessor:
+    """Counts prompt tokens like Qwen2-VL (one token per 28x28 image patch)"""
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        return "".join(
+            part.get("text", "") for message in messages for part in message["content"]
+        )
+
+    def __call__(self, text, images, padding=True, return_tensors="pt"):
+        import torch
+
+        lengths = [
+            len(prompt) // 4 + (image.width // 28) * (image.height // 28)
+            for prompt, image in zip(text, images)
+        ]
+        longest = max(lengths)
+        # Pad on the left, like the real processor is configured to
+        input_ids = torch.zeros((len(lengths), longest), dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, length in enumerate(lengths):
+            input_ids[row, longest - length :] = 1
+            attention_mask[row, longest - length :] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+class StubModel:
+    """Sleeps for the prefill and decode time a real model would take"""
+
+    generation_config = SimpleNamespace(eos_token_id=None)
+
+    def __init__(self, tokens, prefill_ms, token_ms):
+        self.tokens = tokens
+        self.prefill_ms = prefill_ms
+        self.token_ms = token_ms
+
+    def generate(self, input_ids, max_new_tokens, num_return_sequences, **kwargs):
+        import torch
+
+        new_tokens = min(self.tokens, max_new_tokens)
+        time.sleep((self.prefill_ms + self.token_ms * new_tokens) / 1000)
+        input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+        generated = torch.full((input_ids.shape[0], new_tokens), 2, dtype=torch.long)
+        return torch.cat([input_ids, generated], dim=1)
+
+
+class StubEngine:
+    """Stands in for ModelHandle, with the stub model loaded from the start"""
+
+    def __init__(self, model):
+        import torch
+
+        self.components = (model, StubProcessor(), torch.device("cpu"))
+
+    def get(self):
+        return self.components
+
+    def start_background(self):
+        pass
+
+    def status(self):
+        return {"state": "ready", "stub": True}
+
+
+def stub_replica(device=None):
+    """Replica factory of the stub model, configured by the parent's arguments"""
+    from functools import partial
+
+    from generation import generate_batch
+
+    engine = StubEngine(
+        StubModel(
+            int(os.environ["OLMOCR_BENCH_STUB_TOKENS"]),
+            float(os.environ["OLMOCR_BENCH_STUB_PREFILL_MS"]),
+            float(os.environ["OLMOCR_BENCH_STUB_TOKEN_MS"]),
+        )
+    )
+    return engine, partial(generate_batch, engine)
+
+
+def make_fixtures(directory, pages):
+    """Write a text PDF and a scan-sized PNG, and return the inputs of each mode"""
+    from bench_render import make_fixture
+    from PIL import Image, ImageDraw
+
+    pdf_path = os.path.join(directory, "fixture.pdf")
+    make_fixture(pdf_path, pages)
+
+    image_path = os.path.join(directory, "fixture.png")
+    image = Image.new("RGB", (1700, 2200), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(60):
+        draw.text((100, 100 + 33 * line), f"Line {line}: " + "lorem ipsum " * 10, "black")
+    image.save(image_path)
+    with open(image_path, "rb") as f:
+        image_base64 = base64.b64encode(f.read()).decode("ascii")
+    return pdf_path, image_path, image_base64
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def run_mode(app, mode, fixtures, pages, args, concurrency):
+    pdf_path, image_path, image_base64 = fixtures
+    settings = (args.temperature, args.max_new_tokens, 1, args.do_sample)
+
+    def call(index):
+        if mode == "pdf":
+            return app.process_pdf_file(pdf_path, index % pages + 1, *settings)
+        if mode == "image":
+            return app.process_image_file(image_path, *settings)
+        return app.process_pdf_base64(image_base64, None, 1, *settings)
+
+    def timed(index):
+        started = time.perf_counter()
+        text, _ = call(index)
+        return time.perf_counter() - started, text.startswith("Error:")
+
+    call(0)  # Warm up the pools and, without --stub, the model
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(failed for _, failed in results),
+        "p50_ms": 1000 * percentile(latencies, 0.50),
+        "p95_ms": 1000 * percentile(latencies, 0.95),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "pages_per_second": len(results) / elapsed,
+        # ru_maxrss is reported in kilobytes on Linux, and only ever grows
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, baseline):
+    previous = {(r["mode"], r["concurrency"]): r for r in baseline["results"]}
+    print("Change against the baseline:")
+    for result in results:
+        before = previous.get((result["mode"], result["concurrency"]))
+        if before is None:
+            continue
+        changes = ", ".join(
+            f"{key} {100 * (result[key] / before[key] - 1):+.1f}%"
+            for key in ("p50_ms", "p95_ms", "pages_per_second", "peak_rss_mb")
+            if before[key]
+        )
+        print(f"  {result['mode']:>6} x{result['concurrency']}: {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]),
+    )
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--concurrency", default="1,4", help="Comma separated levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per level")
+    parser.add_argument("--pages", type=int, default=8, help="Pages of the fixture PDF")
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--do-sample", action="store_true")
+    parser.add_argument("--cache", action="store_true", help="Keep the caches enabled")
+    parser.add_argument("--stub", action="store_true", help="Use the stub model")
+    parser.add_argument("--stub-tokens", type=int, default=64)
+    parser.add_argument("--stub-prefill-ms", type=float, default=20.0)
+    parser.add_argument("--stub-token-ms", type=float, default=2.0)
+    parser.add_argument("--replicas", type=int, default=1, help="Model replicas")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    if not set(modes) <= set(MODES):
+        parser.error(f"--modes must be a subset of {','.join(MODES)}")
+
+    if not args.cache:
+        # Read by app.py at import time
+        os.environ["OLMOCR_RESULT_CACHE_MB"] = "0"
+        os.environ["OLMOCR_RESULT_CACHE_DISK_MB"] = "0"
+        os.environ["OLMOCR_PAGE_CACHE_PAGES"] = "0"
+        os.environ["OLMOCR_ANCHOR_INDEX_DISK_MB"] = "0"
+    if args.stub:
+        os.environ["OLMOCR_BACKEND"] = "transformers"
+        # The stub model has no KV cache to reuse
+        os.environ["OLMOCR_PREFIX_CACHE_ENTRIES"] = "0"
+    if args.replicas > 1:
+        os.environ["OLMOCR_REPLICAS"] = str(args.replicas)
+        if args.stub:
+            # Read by stub_replica in the worker processes
+            os.environ["OLMOCR_REPLICA_FACTORY"] = "bench_pipeline:stub_replica"
+            os.environ["OLMOCR_REPLICA_DEVICES"] = "cpu"
+            os.environ["OLMOCR_BENCH_STUB_TOKENS"] = str(args.stub_tokens)
+            os.environ["OLMOCR_BENCH_STUB_PREFILL_MS"] = str(args.stub_prefill_ms)
+            os.environ["OLMOCR_BENCH_STUB_TOKEN_MS"] = str(args.stub_token_ms)
+            os.environ["PYTHONPATH"] = os.pathsep.join(
+                filter(None, [HERE, os.environ.get("PYTHONPATH")])
+            )
+
+    import app
+
+    if args.stub and args.replicas <= 1:
+        from functools import partial
+
+        from generation import generate_batch
+
+        app.engine = StubEngine(
+            StubModel(args.stub_tokens, args.stub_prefill_ms, args.stub_token_ms)
+        )
+        app.backend.engine = app.engine
+        # The scheduler runs its batches on the engine it was built with
+        app.scheduler.run_batch = partial(generate_batch, app.engine)
+    app.backend.start()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="olmocr-bench-") as directory:
+        fixtures = make_fixtures(directory, args.pages)
+        for mode in modes:
+            for concurrency in levels:
+                result = run_mode(app, mode, fixtures, args.pages, args, concurrency)
+                results.append(result)
+                print(
+                    f"{mode:>6} x{concurrency:<3} p50 {result['p50_ms']:8.1f} ms  "
+                    f"p95 {result['p95_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+                    f"{result['pages_per_second']:6.2f} pages/s  "
+                    f"{result['peak_rss_mb']:7.1f} MB peak RSS  "
+                    f"{result['errors']} errors"
+                )
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
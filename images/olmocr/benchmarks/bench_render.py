@@ -0,0 +1,131 @@
+"""Compare per-page rendering with ranged rendering of a whole PDF
+
+The per-page path calls olmocr's render_pdf_to_base64png for every page, which runs
+pdfinfo and pdftoppm (each parsing the whole document) and then PNG-encodes and
+base64-encodes the page. The ranged path renders contiguous chunks of pages with
+one pdftoppm run each (see render.py) and hands out raw PPM buffers. Both paths use
+a pool of the same number of workers.
+
+Usage:
+    python benchmarks/bench_render.py [--pdf document.pdf] [--pages 100] [--workers 4]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import RangeRenderer  # noqa: E402
+
+
+def make_fixture(path, page_count):
+    """Write a text-only letter-size PDF with `page_count` pages"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(1, page_count + 1):
+        lines = "".join(
+            f"(Page {page}, line {line}: the quick brown fox jumps over the lazy dog) Tj T* "
+            for line in range(1, 41)
+        )
+        content = f"BT /F1 11 Tf 14 TL 72 740 Td {lines}ET".encode("ascii")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(kids),
+        page_count,
+    )
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref)
+        )
+
+
+def per_page(pdf_path, pages, workers, dim):
+    from olmocr.data.renderpdf import render_pdf_to_base64png
+
+    def render(page):
+        return base64.b64decode(
+            render_pdf_to_base64png(pdf_path, page, target_longest_image_dim=dim)
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(len(data) for data in executor.map(render, pages))
+
+
+def ranged(pdf_path, pages, workers, dim, chunk_size):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        renderer = RangeRenderer(pdf_path, pages, executor, dim, chunk_size)
+        futures = [renderer.submit(page) for page in pages]
+        return sum(len(future.result()) for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pdf", help="PDF to render, a synthetic text PDF by default")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--dim", type=int, default=1024)
+    args = parser.parse_args()
+
+    pdf_path = args.pdf
+    if pdf_path is None:
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        make_fixture(pdf_path, args.pages)
+
+    try:
+        from pypdf import PdfReader
+
+        pages = list(range(1, min(args.pages, len(PdfReader(pdf_path).pages)) + 1))
+        print(f"PDF: {pdf_path} ({len(pages)} pages), {args.workers} workers")
+
+        results = {}
+        for mode in ("per-page", "ranged"):
+            started = time.perf_counter()
+            if mode == "per-page":
+                total = per_page(pdf_path, pages, args.workers, args.dim)
+            else:
+                total = ranged(pdf_path, pages, args.workers, args.dim, args.chunk_size)
+            results[mode] = time.perf_counter() - started
+            print(
+                f"{mode:>8}: {results[mode]:7.2f} s, "
+                f"{len(pages) / results[mode]:6.1f} pages/s, "
+                f"{total / len(pages) / 1024:7.1f} KB per page"
+            )
+
+        print(f"Speed-up: {results['per-page'] / results['ranged']:.2f}x")
+    finally:
+        if args.pdf is None:
+            os.unlink(pdf_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Latency and memory of image preparation versus input resolution
+
+For each resolution a synthetic photo of a text page is written as JPEG (or PNG),
+then decoded and prepared for the model with and without the visual token budget
+(see resize.py). Each run happens in a fresh subprocess so that peak RSS is
+measured independently. The model input is sized from the visual tokens (each one
+is four 14x14 RGB patches in float32); pass --processor to run the real Qwen2-VL
+image processor instead and time it as well.
+
+Usage:
+    python benchmarks/bench_resize.py [--sizes 1600x1200,4000x3000,6000x4000]
+    python benchmarks/bench_resize.py --processor Qwen/Qwen2-VL-7B-Instruct --budget 1369
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resize import PATCH_SIZE, downscale_to_budget, visual_tokens  # noqa: E402
+
+# Floats of one visual token once patched: 2x2 patches of 14x14 pixels, 3 channels,
+# and 2 temporal frames for a still image
+FLOATS_PER_TOKEN = 4 * 3 * 2 * (PATCH_SIZE // 2) ** 2
+
+
+def make_fixture(path, width, height):
+    """Write a page of text at `width` x `height`, with the text scaled to the page"""
+    image = Image.new("RGB", (width, height), (236, 232, 220))
+    draw = ImageDraw.Draw(image)
+    line_height = max(12, height // 60)
+    for line in range(height // line_height - 2):
+        draw.text(
+            (width // 20, line_height * (line + 1)),
+            f"Line {line}: the quick brown fox jumps over the lazy dog " * 3,
+            (20, 20, 20),
+            font_size=line_height * 0.7,
+        )
+    image.save(path, quality=90)
+
+
+def run_once(image_path, budget, processor_name):
+    """Prepare one image in this process and print latency and memory as JSON"""
+    started = time.perf_counter()
+    image = downscale_to_budget(Image.open(image_path), budget)
+    image.load()
+    prepare_seconds = time.perf_counter() - started
+    tokens = visual_tokens(*image.size)
+
+    processor_seconds = None
+    pixel_values_mb = tokens * FLOATS_PER_TOKEN * 4 / (1024 * 1024)
+    if processor_name:
+        from transformers import AutoProcessor
+
+        image_processor = AutoProcessor.from_pretrained(processor_name).image_processor
+        started = time.perf_counter()
+        pixel_values = image_processor(images=[image], return_tensors="pt")[
+            "pixel_values"
+        ]
+        processor_seconds = time.perf_counter() - started
+        pixel_values_mb = pixel_values.nbytes / (1024 * 1024)
+
+    print(
+        json.dumps(
+            {
+                "size": f"{image.width}x{image.height}",
+                "visual_tokens": tokens,
+                "prepare_seconds": prepare_seconds,
+                "processor_seconds": processor_seconds,
+                "pixel_values_mb": pixel_values_mb,
+                # ru_maxrss is reported in kilobytes on Linux
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1024x768,1600x1200,3000x2000,4000x3000,6000x4000")
+    parser.add_argument("--format", choices=["jpeg", "png"], default="jpeg")
+    parser.add_argument("--budget", type=int, default=1369, help="Visual token budget")
+    parser.add_argument("--processor", help="Also run this checkpoint's image processor")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--fixture", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fixture:
+        width, height = (int(side) for side in args.sizes.lower().split("x"))
+        make_fixture(args.fixture, width, height)
+        return
+    if args.child:
+        run_once(args.child, args.budget, args.processor)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="olmocr-bench-") as directory:
+        for size in args.sizes.split(","):
+            width, height = (int(side) for side in size.lower().split("x"))
+            image_path = os.path.join(directory, f"{width}x{height}.{args.format}")
+            # Drawing the fixture here would raise the peak RSS the children inherit
+            subprocess.run(
+                [sys.executable, __file__, "--fixture", image_path, "--sizes", size],
+                check=True,
+            )
+
+            for budget in (0, args.budget):
+                command = [sys.executable, __file__, "--child", image_path]
+                command += ["--budget", str(budget)]
+                if args.processor:
+                    command += ["--processor", args.processor]
+                runs = [
+                    json.loads(
+                        subprocess.run(
+                            command, check=True, capture_output=True, text=True
+                        ).stdout
+                    )
+                    for _ in range(args.runs)
+                ]
+                result = dict(runs[0], input=size, budget=budget)
+                for key in ("prepare_seconds", "processor_seconds"):
+                    if result[key] is not None:
+                        result[key] = sorted(r[key] for r in runs)[len(runs) // 2]
+                result["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+                results.append(result)
+
+                processor = ""
+                if result["processor_seconds"] is not None:
+                    processor = f"processor {result['processor_seconds'] * 1000:7.1f} ms  "
+                print(
+                    f"{size:>9} budget {budget or 'off':>5}: -> {result['size']:>9}  "
+                    f"{result['visual_tokens']:6d} tokens  "
+                    f"decode+resize {result['prepare_seconds'] * 1000:7.1f} ms  "
+                    f"{processor}"
+                    f"pixel_values {result['pixel_values_mb']:7.1f} MB  "
+                    f"{result['peak_rss_mb']:7.1f} MB peak RSS"
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
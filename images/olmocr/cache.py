@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Suffix of the files DiskStore.put writes before moving them into place
+TEMP_SUFFIX = ".tmp"
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache bounded by the total size of its entries"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self.current_bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def values(self):
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskStore:
+    """Directory of files keyed by hex digest, evicting least recently used files by size"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.current_bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # Entries being written by put() are not in the store yet
+                if name.endswith(TEMP_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Refresh the modification time so eviction follows recent use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=TEMP_SUFFIX)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self._lock:
+            try:
+                self.current_bytes -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, path)
+            self.current_bytes += len(data)
+            if self.current_bytes > self.max_bytes:
+                self._evict()
+
+    def append(self, key, data):
+        """Append to an entry, for records that readers can parse line by line"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            with open(path, "ab") as f:
+                f.write(data)
+            self.current_bytes += len(data)
+            if self.current_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop the oldest files until we are comfortably below the budget
+        target = self.max_bytes * 0.9
+        for path, size, _ in sorted(self._scan(), key=lambda entry: entry[2]):
+            if self.current_bytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            self.current_bytes -= size
+            self.evictions += 1
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PageCache:
+    """Rendered page images and anchor text keyed by PDF digest and page number
+
+    The budget is a number of pages: they are raw PPM buffers, whose size only
+    depends on the page's shape and the render size, so pages say more than bytes.
+    Cached pages keep the exact bytes they were rendered to, which the result cache
+    keys on, so compressing them would make re-runs miss it.
+    """
+
+    def __init__(self, max_pages):
+        self.max_pages = max(0, int(max_pages))
+        self.pages = LRUCache(self.max_pages)
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, pdf_path):
+        """Return the PDF digest, hashing the file only when it changed on disk"""
+        stat = os.stat(pdf_path)
+        identity = (os.path.realpath(pdf_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(identity)
+        if digest is None:
+            digest = file_digest(pdf_path)
+            with self._lock:
+                # Keep the identity map small, it only saves re-hashing hot files
+                if len(self._digests) >= 1024:
+                    self._digests.clear()
+                self._digests[identity] = digest
+        return digest
+
+    def get(self, digest, page_number, target_longest_image_dim):
+        entry = self.pages.get((digest, page_number, target_longest_image_dim))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, digest, page_number, target_longest_image_dim, image, anchor_text):
+        # Every page counts as one unit of the LRU budget
+        self.pages.put(
+            (digest, page_number, target_longest_image_dim), (image, anchor_text), 1
+        )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.pages),
+            "max_pages": self.max_pages,
+            "bytes": sum(
+                len(image) + len(anchor_text)
+                for image, anchor_text in self.pages.values()
+            ),
+            "evictions": self.pages.evictions,
+        }
+
+
+# Part of every result key, bumped when the shape of the cached outputs changes so
+# that entries written by older versions are not misread
+RESULT_FORMAT_VERSION = 3
+
+
+class ResultCache:
+    """Content-addressed cache of generated outputs with a memory and a disk tier"""
+
+    def __init__(self, memory_bytes, directory=None, disk_bytes=0):
+        self.memory = LRUCache(memory_bytes)
+        self.disk = DiskStore(directory, disk_bytes) if directory and disk_bytes else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_bytes, anchor_text, prompt, params, model=()):
+        """Hash everything that influences the generated output
+
+        `model` identifies what generates it, such as the backend, checkpoint and
+        revision, so that outputs of another model are never served.
+        """
+        digest = hashlib.sha256()
+        for part in (
+            str(RESULT_FORMAT_VERSION).encode("utf-8"),
+            json.dumps(list(model)).encode("utf-8"),
+            image_bytes,
+            anchor_text.encode("utf-8"),
+            prompt.encode("utf-8"),
+            json.dumps(list(params)).encode("utf-8"),
+        ):
+            # Length-prefix each part so that boundaries cannot be confused
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        outputs = self.memory.get(key)
+        if outputs is not None:
+            with self._lock:
+                self.memory_hits += 1
+            return outputs
+
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                outputs = json.loads(data.decode("utf-8"))
+                self.memory.put(key, outputs, len(data))
+                with self._lock:
+                    self.disk_hits += 1
+                return outputs
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, outputs):
+        data = json.dumps(outputs).encode("utf-8")
+        self.memory.put(key, outputs, len(data))
+        if self.disk is not None:
+            self.disk.put(key, data)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            ),
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.current_bytes,
+            "memory_evictions": self.memory.evictions,
+            "disk_bytes": self.disk.current_bytes if self.disk else 0,
+            "disk_evictions": self.disk.evictions if self.disk else 0,
+        }
@@ -0,0 +1,343 @@
+import inspect
+import itertools
+import math
+import time
+from collections import namedtuple
+
+import torch
+import torch._dynamo
+import torch.nn.functional as F
+from PIL import Image
+
+from resize import visual_tokens
+
+# Shapes a batch is padded to: requests, image size, prompt tokens, new tokens
+Bucket = namedtuple("Bucket", ["rows", "image_size", "prompt_length", "new_tokens"])
+
+
+def parse_ints(text):
+    """Parse "512,2048" into a sorted list of ints"""
+    return sorted(int(part) for part in text.split(",") if part.strip())
+
+
+def parse_sizes(text):
+    """Parse "812x1036,1036x812" into a list of (width, height)"""
+    sizes = []
+    for part in text.split(","):
+        if part.strip():
+            width, height = part.lower().split("x")
+            sizes.append((int(width), int(height)))
+    return sizes
+
+
+def smallest_fit(value, buckets):
+    """Return the smallest bucket of at least `value`, or None"""
+    return min((bucket for bucket in buckets if bucket >= value), default=None)
+
+
+def pad_image(image, size):
+    """Return `image` on a white canvas of `size`, at the top left
+
+    The margin is part of what the model sees: its patches become visual tokens and
+    shift the positions of the rest of the prompt, so the output may differ from
+    that of the unpadded image.
+    """
+    if image.size == size:
+        return image
+    canvas = Image.new("RGB", size, "white")
+    canvas.paste(image.convert("RGB"), (0, 0))
+    return canvas
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class CompiledGeneration:
+    """Generation through a compiled forward pass and a static KV cache
+
+    torch.compile specialises its graphs to the input shapes, so each batch is padded
+    to a bucket: its number of requests to one of `batch_sizes` (repeating the last
+    request), its images to one of `image_sizes` (blank margin right and below, the
+    sizes are multiples of the 28 pixel patches), and its prompts to one of
+    `prompt_lengths` tokens (left padding). The image margin changes the model's
+    input, so a padded page is not guaranteed the output of eager decoding (see
+    pad_image); padding rows and prompt padding are masked out. The KV cache holds
+    the prompt bucket plus a bucket of `new_tokens`; it is allocated the first time
+    a batch of its shape runs and then kept, so that CUDA graphs can be replayed.
+    `warm_up` compiles every bucket and frees the caches it used, so only the
+    buckets real batches use hold memory. Batches that fit no bucket, such as pages
+    larger than every image size, are generated eagerly, and so are batches asking
+    for several candidates per request: their rows are not part of the buckets.
+    """
+
+    def __init__(self, model, batch_sizes, image_sizes, prompt_lengths, new_tokens):
+        self.model = model
+        self.batch_sizes = sorted(batch_sizes)
+        self.image_sizes = sorted(image_sizes, key=lambda size: size[0] * size[1])
+        self.prompt_lengths = sorted(prompt_lengths)
+        self.new_tokens = sorted(new_tokens)
+        # CUDA graphs remove the per-kernel launch overhead that dominates decoding
+        self.mode = "reduce-overhead" if model.device.type == "cuda" else "default"
+        self.report = None
+
+        self._eager_forward = model.forward
+        self._compiled_forward = torch.compile(
+            model.forward, mode=self.mode, dynamic=False
+        )
+        self._caches = {}
+        self._batches = 0
+        self._eager = {}
+
+        # Every bucket is a prefill and a decoding graph, keep them all
+        shapes = len(self.buckets()) * 2 + 8
+        config = torch._dynamo.config
+        config.cache_size_limit = max(config.cache_size_limit, shapes)
+        if hasattr(config, "accumulated_cache_size_limit"):
+            config.accumulated_cache_size_limit = max(
+                config.accumulated_cache_size_limit, shapes
+            )
+        # Recent transformers compile generate() on their own for static caches
+        if hasattr(model.generation_config, "disable_compile"):
+            model.generation_config.disable_compile = True
+
+    def buckets(self):
+        return [
+            Bucket(*shape)
+            for shape in itertools.product(
+                self.batch_sizes,
+                self.image_sizes,
+                self.prompt_lengths,
+                self.new_tokens,
+            )
+        ]
+
+    def plan(self, requests):
+        """Return the Bucket of a batch before tokenization, prompt length unknown
+
+        Returns None when the batch fits no bucket, counting the reason.
+        """
+        params = requests[0].params
+        width = max(request.image.width for request in requests)
+        height = max(request.image.height for request in requests)
+        rows = smallest_fit(len(requests), self.batch_sizes)
+        image_size = min(
+            (
+                size
+                for size in self.image_sizes
+                if size[0] >= width and size[1] >= height
+            ),
+            default=None,
+        )
+        new_tokens = smallest_fit(params.max_new_tokens, self.new_tokens)
+
+        reason = None
+        if params.num_return_sequences > 1:
+            reason = "candidates"
+        elif rows is None:
+            reason = "batch_size"
+        elif image_size is None:
+            reason = "image_size"
+        elif new_tokens is None:
+            reason = "new_tokens"
+        if reason is not None:
+            self._eager[reason] = self._eager.get(reason, 0) + 1
+            return None
+        return Bucket(rows, image_size, None, new_tokens)
+
+    def pad_inputs(self, bucket, inputs, pad_token_id):
+        """Pad processed inputs to `bucket`, returning (bucket, inputs) or None
+
+        The images must already be padded to the bucket's image size.
+        """
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        prompt_length = smallest_fit(input_ids.shape[1], self.prompt_lengths)
+        if prompt_length is None:
+            self._eager["prompt_length"] = self._eager.get("prompt_length", 0) + 1
+            return None
+
+        padding = prompt_length - input_ids.shape[1]
+        inputs = dict(
+            inputs,
+            input_ids=F.pad(input_ids, (padding, 0), value=pad_token_id),
+            attention_mask=F.pad(attention_mask, (padding, 0)),
+        )
+        extra = bucket.rows - input_ids.shape[0]
+        if extra:
+            # Repeat the last request, its outputs are discarded
+            for key in ("input_ids", "attention_mask", "image_grid_thw"):
+                if key in inputs:
+                    last = inputs[key][-1:]
+                    inputs[key] = torch.cat([inputs[key]] + [last] * extra)
+            if "pixel_values" in inputs:
+                patches = int(inputs["image_grid_thw"][-1].prod())
+                pixel_values = inputs["pixel_values"]
+                last = pixel_values[-patches:]
+                inputs["pixel_values"] = torch.cat([pixel_values] + [last] * extra)
+        return bucket._replace(prompt_length=prompt_length), inputs
+
+    def generate(self, bucket, inputs, **generate_kwargs):
+        """Generate a padded batch with the compiled forward pass and a static cache
+
+        Returns the outputs of every row, including the padding rows.
+        """
+        from transformers import StaticCache
+
+        rows = bucket.rows
+        length = bucket.prompt_length + bucket.new_tokens
+        cache = self._caches.get((rows, length))
+        if cache is None:
+            # The batch size argument was renamed in transformers 4.45
+            batch_size = "batch_size"
+            if batch_size not in inspect.signature(StaticCache).parameters:
+                batch_size = "max_batch_size"
+            cache = self._caches[(rows, length)] = StaticCache(
+                config=self.model.config,
+                max_cache_len=length,
+                device=self.model.device,
+                dtype=self.model.dtype,
+                **{batch_size: rows},
+            )
+        else:
+            cache.reset()
+
+        self.model.forward = self._compiled_forward
+        try:
+            output = self.model.generate(
+                **inputs,
+                past_key_values=cache,
+                **generate_kwargs,
+            )
+        finally:
+            self.model.forward = self._eager_forward
+        self._batches += 1
+        return output
+
+    def warm_up(self, make_inputs, build_prompt, tokenizer, tokens=16):
+        """Compile every bucket and time it against eager decoding, see `report`
+
+        `make_inputs(requests, image_size)` processes requests with their images
+        padded to `image_size`, `build_prompt(text)` makes a prompt of an anchor
+        text. Prompts are filled with words to land in each prompt bucket.
+        """
+        from scheduler import GenerationParams, GenerationRequest
+
+        device = self.model.device
+        base_length = len(tokenizer(build_prompt(""))["input_ids"])
+        results = []
+        eager_ms = None
+        previous_length = {
+            length: ([0] + self.prompt_lengths)[index]
+            for index, length in enumerate(self.prompt_lengths)
+        }
+
+        def timed(run):
+            synchronize(device)
+            started = time.perf_counter()
+            run()
+            synchronize(device)
+            return time.perf_counter() - started
+
+        for bucket in self.buckets():
+            # Land just below the bucket, leaving room for the chat template
+            image_tokens = visual_tokens(*bucket.image_size)
+            words = bucket.prompt_length - base_length - image_tokens - 32
+            lower = previous_length[bucket.prompt_length]
+            if words < 0 or base_length + image_tokens + words <= lower:
+                continue
+            request = GenerationRequest(
+                build_prompt(" the" * words),
+                Image.new("RGB", bucket.image_size, "white"),
+                GenerationParams(0.0, bucket.new_tokens, 1, False),
+            )
+            requests = [request] * bucket.rows
+            planned = self.plan(requests)
+            padded = planned and self.pad_inputs(
+                planned,
+                make_inputs(requests, planned.image_size),
+                tokenizer.pad_token_id,
+            )
+            if not padded or padded[0] != bucket:
+                continue
+            _, inputs = padded
+
+            def run(count, compiled=True):
+                # Force the length, a blank page would otherwise stop right away
+                kwargs = dict(
+                    max_new_tokens=count, min_new_tokens=count, do_sample=False
+                )
+                if compiled:
+                    return self.generate(bucket, inputs, **kwargs)
+                return self.model.generate(**inputs, **kwargs)
+
+            if eager_ms is None:
+                # Eager decoding on the smallest bucket, the baseline of the report
+                eager_short = timed(lambda: run(2, compiled=False))
+                eager_long = timed(lambda: run(tokens, compiled=False))
+                eager_ms = 1000 * (eager_long - eager_short) / (tokens - 2)
+
+            first = timed(lambda: run(2))
+            short = timed(lambda: run(2))
+            long = timed(lambda: run(tokens))
+            result = {
+                "rows": bucket.rows,
+                "image_size": "{}x{}".format(*bucket.image_size),
+                "prompt_tokens": bucket.prompt_length,
+                "new_tokens": bucket.new_tokens,
+                "compile_seconds": round(max(0.0, first - short), 2),
+                "ms_per_token": round(1000 * (long - short) / (tokens - 2), 2),
+            }
+            results.append(result)
+            self._free_cache(bucket)
+            print(
+                f"Compiled {result['rows']} x {result['image_size']} with "
+                f"{result['prompt_tokens']}+{result['new_tokens']} tokens in "
+                f"{result['compile_seconds']}s, {result['ms_per_token']} ms/token"
+            )
+
+        # Only count the batches of real requests
+        self._batches = 0
+        self._eager = {}
+        compile_seconds = sum(result["compile_seconds"] for result in results)
+        compiled_ms = results[0]["ms_per_token"] if results else None
+        saved_ms = eager_ms - compiled_ms if results else 0
+        self.report = {
+            "mode": self.mode,
+            "buckets": results,
+            "compile_seconds": round(compile_seconds, 2),
+            "eager_ms_per_token": round(eager_ms, 2) if eager_ms else None,
+            "compiled_ms_per_token": compiled_ms,
+            # Tokens to generate before the compile time is paid back
+            "break_even_tokens": (
+                math.ceil(1000 * compile_seconds / saved_ms) if saved_ms > 0 else None
+            ),
+        }
+        print(
+            f"Compiled generation: {len(results)} buckets in {compile_seconds:.1f}s, "
+            f"{compiled_ms} ms/token against "
+            f"{self.report['eager_ms_per_token']} eager, paid back after "
+            f"{self.report['break_even_tokens']} tokens"
+        )
+        return self.report
+
+    def _free_cache(self, bucket):
+        """Drop the static cache of a bucket, it is allocated again on first use
+
+        On CUDA the graphs captured with it are then re-recorded, which is fast next
+        to compiling.
+        """
+        self._caches.pop((bucket.rows, bucket.prompt_length + bucket.new_tokens), None)
+        if self.model.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def restore(self):
+        self.model.forward = self._eager_forward
+
+    def stats(self):
+        return {
+            "report": self.report,
+            "compiled_batches": self._batches,
+            "eager_batches": dict(self._eager),
+            "allocated_caches": len(self._caches),
+        }
@@ -0,0 +1,80 @@
+import math
+import os
+
+import torch
+
+
+def cpu_quota():
+    """Return the number of CPUs this process may use, honouring the cgroup CPU quota
+
+    Containers usually see every host CPU in os.cpu_count() even when their quota is
+    a fraction of that, which makes PyTorch oversubscribe the quota with threads.
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is None:
+        return available
+    return max(1, min(available, math.floor(quota)))
+
+
+def configure_threads(threads=None):
+    """Size PyTorch's intra- and inter-op thread pools, returns (intra, inter)
+
+    Generation runs one op after the other, so nearly all threads go to intra-op
+    parallelism. Must be called before the first parallel op runs.
+    """
+    intra = max(1, int(threads or cpu_quota()))
+    inter = 2 if intra >= 8 else 1
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        # The inter-op pool is already running, keep its size
+        inter = torch.get_num_interop_threads()
+    return intra, inter
+
+
+def quantize(model):
+    """Quantise the weights of every Linear layer to int8, activations stay float
+
+    Dynamic quantisation needs a float32 model and only runs on CPU.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def compile_forward(model):
+    """Compile the model's forward pass, which generate() calls once per token
+
+    Returns a function restoring the eager forward, in case the compiled one fails.
+    """
+    eager_forward = model.forward
+    model.forward = torch.compile(eager_forward, dynamic=True)
+
+    def restore():
+        model.forward = eager_forward
+
+    return restore
@@ -0,0 +1,256 @@
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DownloadError(Exception):
+    """Raised when a document cannot be downloaded"""
+
+
+class Downloader:
+    """Streaming, size-bounded downloads over pooled connections
+
+    Concurrent fetches of the same URL share a single in-flight download. Downloaded
+    files are kept in a subdirectory of `directory` private to this process (at most
+    `max_entries` of them) together with their ETag / Last-Modified validators, so
+    fetching a URL again only revalidates it with a conditional request and reuses
+    the local copy on `304 Not Modified`. The subdirectory is removed on exit,
+    nothing else in `directory` is ever deleted.
+
+    `fetch` leases the returned path: it stays on disk until the caller hands it
+    back with `release`, even if the URL is downloaded again (each download gets
+    its own file) or its entry is evicted, in which case the file is deleted on
+    release. Callers must not delete the paths themselves.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=200 * 1024 * 1024,
+        connect_timeout=10,
+        read_timeout=60,
+        total_timeout=300,
+        max_entries=64,
+        chunk_size=1024 * 1024,
+    ):
+        self.max_bytes = int(max_bytes)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_entries = max(1, int(max_entries))
+        self.chunk_size = chunk_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.downloads = 0
+        self.revalidated = 0
+        self.shared = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        # Leases held on each path, and the paths to delete once no longer leased
+        self._leases = {}
+        self._retired = set()
+        self._lock = threading.Lock()
+
+        # `directory` may be shared with other processes or hold the user's files,
+        # only the files this downloader creates are cleaned up
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="downloads-", dir=directory)
+        atexit.register(self.close)
+
+    def close(self):
+        """Delete the downloaded files"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def fetch(self, url):
+        """Return a leased local path of the document at `url`, downloading if needed
+
+        Hand the path back with `release` once done with it.
+        """
+        with self._lock:
+            flight = self._in_flight.get(url)
+            owner = flight is None
+            if owner:
+                # Every caller sharing the download gets a lease on its result
+                flight = self._in_flight[url] = {"future": Future(), "holders": 1}
+            else:
+                flight["holders"] += 1
+                self.shared += 1
+
+        if owner:
+            try:
+                path = self._download(url, flight)
+            except Exception as e:
+                with self._lock:
+                    del self._in_flight[url]
+                flight["future"].set_exception(e)
+            else:
+                flight["future"].set_result(path)
+        return flight["future"].result()
+
+    def release(self, path):
+        """Give back a path returned by `fetch`, deleting it if it was evicted"""
+        with self._lock:
+            leases = self._leases.get(path, 0) - 1
+            if leases > 0:
+                self._leases[path] = leases
+                return
+            self._leases.pop(path, None)
+            if path not in self._retired:
+                return
+            self._retired.discard(path)
+        self._unlink(path)
+
+    @contextmanager
+    def lease(self, url):
+        """Context manager of `fetch(url)`, released on exit"""
+        path = self.fetch(url)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "revalidated": self.revalidated,
+                "shared": self.shared,
+                "cached_files": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "leased_files": len(self._leases),
+            }
+
+    def _download(self, url, flight):
+        """Download or revalidate `url` and lease the path to the fetch's holders"""
+        with self._lock:
+            entry = self._entries.get(url)
+
+        headers = {}
+        if entry is not None and os.path.exists(entry["path"]):
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = self.session.get(
+                url,
+                headers=headers,
+                stream=True,
+                timeout=(self.connect_timeout, self.read_timeout),
+            )
+        except requests.RequestException as e:
+            raise DownloadError(f"Error during download of {url}: {e}") from e
+
+        with response:
+            if response.status_code == 304 and headers:
+                with self._lock:
+                    # Still current unless evicted meanwhile, then it is downloaded
+                    if self._entries.get(url) is entry:
+                        self._entries.move_to_end(url)
+                        self.revalidated += 1
+                        self._lease(url, entry["path"], flight)
+                        return entry["path"]
+                return self._download(url, flight)
+
+            if response.status_code != 200:
+                raise DownloadError(
+                    f"Error during download of {url}: HTTP {response.status_code}"
+                )
+
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise DownloadError(
+                    f"Document at {url} is {int(length)} bytes, "
+                    f"more than the {self.max_bytes} bytes limit"
+                )
+
+            path = self._stream_to(response, url)
+
+        unused = []
+        with self._lock:
+            replaced = self._entries.pop(url, None)
+            if replaced is not None:
+                unused.append(self._retire(replaced["path"]))
+            self._entries[url] = {
+                "path": path,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            self.downloads += 1
+            self._lease(url, path, flight)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                unused.append(self._retire(evicted["path"]))
+        for unused_path in unused:
+            if unused_path is not None:
+                self._unlink(unused_path)
+        return path
+
+    def _lease(self, url, path, flight):
+        # Called with the lock held: no caller can join the fetch after this
+        self._leases[path] = self._leases.get(path, 0) + flight["holders"]
+        del self._in_flight[url]
+
+    def _retire(self, path):
+        """Forget a file, returning it if it can be deleted now (lock held)"""
+        if self._leases.get(path):
+            self._retired.add(path)
+            return None
+        return path
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _stream_to(self, response, url):
+        """Write the body to a new file through a temporary one, enforcing the limits
+
+        Each download gets its own file, so that files in use are never replaced.
+        Returns its path.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        prefix = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + "-"
+        fd, temp_path = tempfile.mkstemp(
+            dir=self.directory, prefix=prefix, suffix=".part"
+        )
+        try:
+            received = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    received += len(chunk)
+                    if received > self.max_bytes:
+                        raise DownloadError(
+                            f"Document at {url} exceeds the {self.max_bytes} bytes limit"
+                        )
+                    if time.monotonic() > deadline:
+                        raise DownloadError(
+                            f"Download of {url} took longer than {self.total_timeout}s"
+                        )
+                    f.write(chunk)
+            path = temp_path[: -len(".part")]
+            os.replace(temp_path, path)
+            return path
+        except requests.RequestException as e:
+            os.unlink(temp_path)
+            raise DownloadError(f"Error during download of {url}: {e}") from e
+        except BaseException:
+            os.unlink(temp_path)
+            raise
@@ -0,0 +1,488 @@
+import os
+import time
+from functools import partial
+
+import torch
+import transformers
+from PIL import Image
+from transformers import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+
+from olmocr.prompts import build_finetuning_prompt
+
+import metrics
+from compiled import CompiledGeneration, pad_image, parse_ints, parse_sizes
+from cpu import compile_forward, configure_threads, quantize
+from loader import ModelHandle
+from prefix_cache import (
+    SUPPORTED_TRANSFORMERS,
+    FirstTokenTimer,
+    PrefixCache,
+    generate_from_prefix,
+    move_padding_after_prefix,
+    prefix_token_ids,
+    transformers_supported,
+)
+from scoring import SequenceScorer, sampling_warpers
+from scheduler import GenerationParams, GenerationRequest
+
+# Model checkpoints, loaded lazily (see ModelHandle)
+MODEL_NAME = os.environ.get("OLMOCR_MODEL", "allenai/olmOCR-7B-0225-preview")
+MODEL_REVISION = os.environ.get("OLMOCR_MODEL_REVISION", "main")
+PROCESSOR_NAME = os.environ.get("OLMOCR_PROCESSOR", "Qwen/Qwen2-VL-7B-Instruct")
+WARMUP = os.environ.get("OLMOCR_WARMUP", "1") == "1"
+# Stream safetensors shards straight to the device instead of building on the host
+LOW_MEMORY_LOAD = os.environ.get("OLMOCR_LOW_MEMORY_LOAD", "1") == "1"
+
+# Device to run the model on: "auto" picks CUDA when available, "cpu" forces the CPU
+# serving mode (int8 weights, thread pools sized to the CPU quota)
+DEVICE = os.environ.get("OLMOCR_DEVICE", "auto")
+CPU_MODE = DEVICE == "cpu" or (DEVICE == "auto" and not torch.cuda.is_available())
+CPU_THREADS = int(os.environ.get("OLMOCR_CPU_THREADS", "0"))
+CPU_QUANTIZE = os.environ.get("OLMOCR_CPU_QUANTIZE", "1") == "1"
+CPU_COMPILE = os.environ.get("OLMOCR_CPU_COMPILE", "0") == "1"
+# Tokens generated by the startup self-benchmark, 0 disables it
+BENCHMARK_TOKENS = int(os.environ.get("OLMOCR_BENCHMARK_TOKENS", "32"))
+
+# Prefill each page once and copy its KV state for every candidate it asks for,
+# rather than prefilling every candidate (see generate_shared_prefill)
+SHARED_PREFILL = os.environ.get("OLMOCR_SHARED_PREFILL", "1") == "1"
+# KV states of the shared prompt prefix kept for reuse, 0 disables prefix caching.
+# Off by default: the prefill it saves has not been measured against its own cost
+PREFIX_CACHE_ENTRIES = int(os.environ.get("OLMOCR_PREFIX_CACHE_ENTRIES", "0"))
+
+# Compiled generation with a static KV cache over padded shape buckets, see
+# compiled.py. The 4 default buckets cover portrait Letter (791x1024) and A4
+# (724x1024) pages rendered at 1024 pixels, padded to the next 28 pixel patch, and
+# their anchor text; every bucket costs a compilation and a KV cache
+COMPILE = os.environ.get("OLMOCR_COMPILE", "0") == "1"
+COMPILE_BATCH_SIZES = parse_ints(os.environ.get("OLMOCR_COMPILE_BATCH_SIZES", "1,4"))
+COMPILE_IMAGE_SIZES = parse_sizes(
+    os.environ.get("OLMOCR_COMPILE_IMAGE_SIZES", "812x1036")
+)
+COMPILE_PROMPT_LENGTHS = parse_ints(
+    os.environ.get("OLMOCR_COMPILE_PROMPT_LENGTHS", "1536,3072")
+)
+COMPILE_NEW_TOKENS = parse_ints(os.environ.get("OLMOCR_COMPILE_NEW_TOKENS", "2048"))
+
+prefix_cache = None
+if PREFIX_CACHE_ENTRIES > 0:
+    if transformers_supported():
+        prefix_cache = PrefixCache(PREFIX_CACHE_ENTRIES)
+    else:
+        low, high = SUPPORTED_TRANSFORMERS
+        print(
+            f"Prefix cache disabled: it follows the internals of transformers "
+            f">={low},<{high}, not {transformers.__version__}"
+        )
+shared_prefill = SHARED_PREFILL and transformers_supported()
+compiled = None
+# time.monotonic() of the last decoding step of this process, see StepClock
+last_step_at = None
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stop generating the rows of the requests in the batch that have been stopped
+
+    The batch finishes as soon as its remaining requests do, and right away once
+    every request has been stopped.
+    """
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Each request owns the same number of consecutive rows
+        rows = input_ids.shape[0] // len(self.requests)
+        stopped = [request.stopped for request in self.requests for _ in range(rows)]
+        return torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class BatchStreamer:
+    """Hand each row of a batch to the streamer of its request, if it has one
+
+    generate() streams a whole batch to a single streamer, which only decodes one
+    sequence. Streaming requests return a single sequence, so row i belongs to
+    request i; rows past the requests (padding of a compiled batch) are ignored. A
+    row's streamer ends as soon as the row emits an end-of-sequence token, without
+    waiting for the rest of the batch.
+    """
+
+    def __init__(self, requests, eos_token_id):
+        self.streamers = [request.streamer for request in requests]
+        self.open = [streamer is not None for streamer in self.streamers]
+        self.eos_token_ids = (
+            set(torch.tensor(eos_token_id).flatten().tolist())
+            if eos_token_id is not None
+            else set()
+        )
+
+    def put(self, value):
+        # The prompts arrive first as a 2D tensor, then one new token per row
+        for row, streamer in enumerate(self.streamers):
+            if not self.open[row]:
+                continue
+            streamer.put(value[row : row + 1])
+            if value.dim() == 1 and int(value[row]) in self.eos_token_ids:
+                self.open[row] = False
+                streamer.end()
+
+    def end(self):
+        for row, streamer in enumerate(self.streamers):
+            if self.open[row]:
+                self.open[row] = False
+                streamer.end()
+
+
+class StepClock(LogitsProcessor):
+    """Record the time of every decoding step in `last_step_at`
+
+    Replica workers report how long ago it was, so that a batch that stopped making
+    progress can be told apart from a long one.
+    """
+
+    def __call__(self, input_ids, scores):
+        global last_step_at
+        last_step_at = time.monotonic()
+        return scores
+
+
+def prepare_inputs(processor, device, requests, image_size=None):
+    """Tokenize the prompts and preprocess the images of a batch of requests
+
+    With `image_size` the images are first padded to that size.
+    """
+    texts = []
+    for request in requests:
+        # Build the complete prompt
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": request.prompt},
+                    {"type": "image"},
+                ],
+            }
+        ]
+        texts.append(
+            processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+        )
+
+    images = [request.image for request in requests]
+    if image_size is not None:
+        images = [pad_image(image, image_size) for image in images]
+
+    with metrics.stage("processor"):
+        inputs = processor(
+            text=texts,
+            images=images,
+            padding=True,
+            return_tensors="pt",
+        )
+        return {key: value.to(device) for (key, value) in inputs.items()}
+
+
+def generate_with_prefix_cache(
+    model, processor, inputs, num_return_sequences, **generate_kwargs
+):
+    """Generate reusing the cached KV state of the prompt prefix shared by all requests
+
+    Each request's prompt and image are encoded once, however many candidates it
+    asks for, where plain generate() prefills every candidate. Returns None when the
+    batch cannot use the prefix, e.g. a prompt without it.
+    """
+    global prefix_cache
+
+    try:
+        prefix_ids = prefix_token_ids(processor, build_finetuning_prompt)
+        aligned = move_padding_after_prefix(inputs, prefix_ids)
+        if aligned is None:
+            return None
+        prefix_kv = prefix_cache.get(model, prefix_ids)
+        return generate_from_prefix(
+            model,
+            aligned,
+            prefix_kv,
+            len(prefix_ids),
+            num_return_sequences,
+            **generate_kwargs,
+        )
+    except Exception as e:
+        # The prefill relies on model internals, keep serving without it
+        print(f"Disabling the prefix cache after an error: {e}")
+        prefix_cache = None
+        return None
+
+
+def generate_shared_prefill(model, inputs, num_return_sequences, **generate_kwargs):
+    """Generate several candidates per request from a single prefill of each request
+
+    Returns None when it fails, the caller then prefills every candidate.
+    """
+    global shared_prefill
+
+    try:
+        return generate_from_prefix(
+            model, inputs, None, 0, num_return_sequences, **generate_kwargs
+        )
+    except Exception as e:
+        # The prefill relies on model internals, keep serving without it
+        print(f"Disabling the shared candidate prefill after an error: {e}")
+        shared_prefill = False
+        return None
+
+
+def run_generation(model, processor, device, requests):
+    """Run a batch of requests sharing the same generation params through the model"""
+    global compiled
+
+    params = requests[0].params
+    bucket = compiled.plan(requests) if compiled is not None else None
+    inputs = prepare_inputs(
+        processor, device, requests, bucket.image_size if bucket else None
+    )
+    if bucket is not None:
+        padded = compiled.pad_inputs(bucket, inputs, processor.tokenizer.pad_token_id)
+        if padded is not None:
+            bucket, inputs = padded
+        else:
+            bucket = None
+
+    generate_kwargs = {}
+    if any(request.streamer is not None for request in requests):
+        generate_kwargs["streamer"] = BatchStreamer(
+            requests, model.generation_config.eos_token_id
+        )
+    if any(request.stop_event is not None for request in requests):
+        # Padding rows of a compiled batch repeat the last request
+        rows = requests + requests[-1:] * (bucket.rows - len(requests) if bucket else 0)
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([StopOnEvent(rows)])
+
+    # Time the prefill, up to the logits of the first new token, and score the outputs
+    first_token = FirstTokenTimer()
+    scorer = SequenceScorer(
+        sampling_warpers(model.generation_config, params.temperature)
+        if params.do_sample
+        else None
+    )
+    generate_kwargs["logits_processor"] = LogitsProcessorList(
+        [first_token, scorer, StepClock()]
+    )
+    generate_kwargs.update(
+        temperature=params.temperature,
+        max_new_tokens=params.max_new_tokens,
+        do_sample=params.do_sample,
+    )
+
+    # Generate the output
+    started = first_token.started = time.perf_counter()
+    output = None
+    if bucket is not None:
+        try:
+            output = compiled.generate(bucket, inputs, **generate_kwargs)
+        except Exception as e:
+            # Keep serving eagerly, on the padded inputs
+            print(f"Disabling compiled generation after an error: {e}")
+            compiled.restore()
+            compiled = None
+    cached_prefix = prefix_cache is not None and bucket is None
+    if cached_prefix:
+        output = generate_with_prefix_cache(
+            model, processor, inputs, params.num_return_sequences, **generate_kwargs
+        )
+        cached_prefix = output is not None
+    if output is None and params.num_return_sequences > 1 and shared_prefill:
+        output = generate_shared_prefill(
+            model, inputs, params.num_return_sequences, **generate_kwargs
+        )
+    if output is None:
+        # generate() repeats the inputs per candidate, each one is prefilled
+        output = model.generate(
+            **inputs,
+            num_return_sequences=params.num_return_sequences,
+            **generate_kwargs,
+        )
+    generate_seconds = time.perf_counter() - started
+
+    if first_token.prefill_seconds is not None:
+        metrics.observe_stage("prefill", first_token.prefill_seconds)
+        if prefix_cache is not None:
+            prefix_cache.record_prefill(cached_prefix, first_token.prefill_seconds)
+
+    # Decode the output, each request owns num_return_sequences consecutive rows
+    prompt_length = inputs["input_ids"].shape[1]
+    new_tokens = output[:, prompt_length:]
+    n = params.num_return_sequences
+    if metrics.ENABLED:
+        # Without the padding rows of a compiled batch
+        generated = new_tokens[: len(requests) * n]
+        metrics.observe_stage("generate", generate_seconds)
+        metrics.observe_generation(
+            int(inputs["attention_mask"][: len(requests)].sum()),
+            int((generated != processor.tokenizer.pad_token_id).sum()),
+            generate_seconds,
+        )
+    with metrics.stage("batch_decode"):
+        text_output = processor.tokenizer.batch_decode(
+            new_tokens, skip_special_tokens=True
+        )
+    candidates = [
+        {"text": text, "logprob": logprob, "tokens": tokens}
+        for text, (logprob, tokens) in zip(
+            text_output,
+            scorer.finish(new_tokens, model.generation_config.eos_token_id),
+        )
+    ]
+    return [candidates[i * n : (i + 1) * n] for i in range(len(requests))]
+
+
+def warmup_model(model, processor, device):
+    """Generate a token for a blank page so the first real request is not slowed down"""
+    request = GenerationRequest(
+        build_finetuning_prompt("Warm-up."),
+        Image.new("RGB", (256, 256), "white"),
+        GenerationParams(0.0, 1, 1, False),
+    )
+    run_generation(model, processor, device, [request])
+
+
+def optimize_for_cpu(model, processor, device):
+    """Quantise the weights to int8 and optionally compile the forward pass"""
+    if CPU_QUANTIZE:
+        model = quantize(model)
+    # Compiled generation compiles the forward pass with static shapes instead
+    if CPU_COMPILE and not COMPILE:
+        restore = compile_forward(model)
+        try:
+            # Compilation happens on the first call, fall back to eager if it fails
+            warmup_model(model, processor, device)
+        except Exception as e:
+            print(f"Compiled forward failed, using eager mode: {e}")
+            restore()
+    return model
+
+
+def compile_generation(model, processor, device):
+    """Compile and warm up every shape bucket, falling back to eager if it fails"""
+    global compiled
+
+    compiled = CompiledGeneration(
+        model,
+        COMPILE_BATCH_SIZES,
+        COMPILE_IMAGE_SIZES,
+        COMPILE_PROMPT_LENGTHS,
+        COMPILE_NEW_TOKENS,
+    )
+    try:
+        compiled.warm_up(
+            lambda requests, image_size: prepare_inputs(
+                processor, device, requests, image_size
+            ),
+            build_finetuning_prompt,
+            processor.tokenizer,
+        )
+    except Exception as e:
+        print(f"Compiled generation failed, using eager mode: {e}")
+        compiled.restore()
+        compiled = None
+
+
+def optimize_model(model, processor, device):
+    """Apply the enabled CPU optimisations, then compile generation if enabled"""
+    if device.type == "cpu":
+        model = optimize_for_cpu(model, processor, device)
+    if COMPILE:
+        compile_generation(model, processor, device)
+    return model
+
+
+def benchmark_model(model, processor, device):
+    """Time prefill and decoding on a blank page, reported in the Status tab"""
+    request = GenerationRequest(
+        build_finetuning_prompt("Benchmark."),
+        Image.new("RGB", (512, 512), "white"),
+        GenerationParams(0.0, BENCHMARK_TOKENS, 1, False),
+    )
+    inputs = prepare_inputs(processor, device, [request])
+    seconds = {}
+    for tokens in (1, BENCHMARK_TOKENS):
+        started = time.perf_counter()
+        # Force the full length, a blank page would otherwise stop right away
+        model.generate(
+            **inputs, max_new_tokens=tokens, min_new_tokens=tokens, do_sample=False
+        )
+        seconds[tokens] = time.perf_counter() - started
+
+    decode_seconds = seconds[BENCHMARK_TOKENS] - seconds[1]
+    result = {
+        "prompt_tokens": int(inputs["attention_mask"].sum()),
+        "prefill_seconds": round(seconds[1], 3),
+        "new_tokens": BENCHMARK_TOKENS,
+        "tokens_per_second": round((BENCHMARK_TOKENS - 1) / decode_seconds, 2),
+        "threads": torch.get_num_threads(),
+        "quantized": device.type == "cpu" and CPU_QUANTIZE,
+        "compiled": device.type == "cpu" and CPU_COMPILE and not COMPILE,
+    }
+    print(
+        f"Self-benchmark on {device}: {result['tokens_per_second']} tokens/s, "
+        f"prefill of {result['prompt_tokens']} tokens in {result['prefill_seconds']}s"
+    )
+    return result
+
+
+def configure_cpu(threads=None):
+    """Size the thread pools for CPU serving and log the CPU serving options"""
+    intra_threads, inter_threads = configure_threads(threads)
+    print(
+        f"CPU serving mode: {intra_threads} intra-op and {inter_threads} inter-op "
+        f"threads, int8 weights {'on' if CPU_QUANTIZE else 'off'}, "
+        f"compiled forward {'on' if CPU_COMPILE else 'off'}"
+    )
+
+
+def make_engine(device=None):
+    """Return a lazily loaded model on `device`, by default as set by OLMOCR_DEVICE"""
+    cpu = device == "cpu" if device is not None else CPU_MODE
+    return ModelHandle(
+        MODEL_NAME,
+        PROCESSOR_NAME,
+        revision=MODEL_REVISION,
+        # Dynamic int8 quantisation starts from float32 weights
+        dtype=torch.float32 if cpu and CPU_QUANTIZE else torch.bfloat16,
+        warmup=warmup_model if WARMUP else None,
+        device="cpu" if cpu else device,
+        optimize=optimize_model if cpu or COMPILE else None,
+        benchmark=benchmark_model if BENCHMARK_TOKENS > 1 else None,
+        low_memory=LOW_MEMORY_LOAD,
+    )
+
+
+def generate_batch(engine, requests):
+    """Run a scheduled batch, waiting for the model to finish loading if needed"""
+    model, processor, device = engine.get()
+    return run_generation(model, processor, device, requests)
+
+
+def make_replica(device=None):
+    """Return the (engine, run_batch) pair served by one worker of the replica pool
+
+    CPU replicas size their thread pools to the CPU set the worker is pinned to.
+    """
+    if device == "cpu":
+        configure_cpu(CPU_THREADS or None)
+    engine = make_engine(device)
+    return engine, partial(generate_batch, engine)
+
+
+def prefix_cache_stats():
+    return prefix_cache.stats() if prefix_cache is not None else None
+
+
+def compiled_stats():
+    return compiled.stats() if compiled is not None else None
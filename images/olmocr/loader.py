@@ -0,0 +1,234 @@
+import os
+import sys
+import threading
+import time
+
+import torch
+
+from weights import load_streaming
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def host_memory_mb():
+    """Return the (current, peak) resident memory of this process in MB, or None"""
+    current = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        current = round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        peak = round(max_rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+    return current, peak
+
+
+def memory_snapshot(device):
+    """Return the current and peak memory of the host and of a CUDA `device`"""
+    rss, peak_rss = host_memory_mb()
+    snapshot = {"rss_mb": rss, "peak_rss_mb": peak_rss}
+    if device.type == "cuda":
+        snapshot["device_mb"] = round(torch.cuda.memory_allocated(device) / 2**20, 1)
+        snapshot["device_peak_mb"] = round(
+            torch.cuda.max_memory_allocated(device) / 2**20, 1
+        )
+    return snapshot
+
+
+class ModelHandle:
+    """Lazily loaded model and processor that can be shared between threads
+
+    Nothing is downloaded or loaded until `get()` is first called, or until
+    `start_background()` warms the model up in a daemon thread. Each startup phase
+    (weights download, load, device transfer, optional optimisation, warm-up generate,
+    optional self-benchmark) is timed and reported by `status()`, along with the
+    memory in use after it. With `low_memory`, safetensors checkpoints are streamed
+    straight to the device (see weights.load_streaming) instead of being loaded on
+    the host first.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        processor_name,
+        revision=None,
+        dtype=torch.bfloat16,
+        warmup=None,
+        device=None,
+        optimize=None,
+        benchmark=None,
+        low_memory=True,
+    ):
+        self.model_name = model_name
+        self.processor_name = processor_name
+        self.revision = revision
+        self.dtype = dtype
+        self.warmup = warmup
+        # optimize(model, processor, device) returns the model to serve
+        self.optimize = optimize
+        # benchmark(model, processor, device) returns a dict shown by status()
+        self.benchmark = benchmark
+        self.low_memory = low_memory
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+
+        self._components = None
+        self._lock = threading.Lock()
+        self._state = "idle"
+        self._phase = None
+        self._error = None
+        self._timings = {}
+        self._memory = {}
+        self._loader = None
+        self._benchmark = None
+
+    def get(self):
+        """Return (model, processor, device), loading them first if needed"""
+        components = self._components
+        if components is not None:
+            return components
+
+        with self._lock:
+            if self._components is None:
+                self._load()
+        return self._components
+
+    def start_background(self):
+        """Start loading and warming up the model without blocking the caller"""
+        thread = threading.Thread(
+            target=self._load_quietly, name="olmocr-model-warmup", daemon=True
+        )
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        return self._components is not None
+
+    def status(self):
+        """Return the readiness state, and the duration and memory of each phase
+
+        "memory" holds the snapshot after each startup phase and "steady" the one
+        taken when the model is ready; the peaks cover the whole startup.
+        """
+        return {
+            "state": self._state,
+            "phase": self._phase,
+            "device": str(self.device),
+            "loader": self._loader,
+            "timings": dict(self._timings),
+            "memory": dict(self._memory),
+            "benchmark": self._benchmark,
+            "error": self._error,
+        }
+
+    def _load_quietly(self):
+        try:
+            self.get()
+        except Exception:
+            # The error is reported by status() and raised again by the next get()
+            pass
+
+    def _run_phase(self, phase, fn):
+        self._phase = phase
+        started = time.monotonic()
+        result = fn()
+        self._timings[phase] = round(time.monotonic() - started, 3)
+        self._memory[phase] = memory_snapshot(self.device)
+        print(
+            f"Model startup phase '{phase}' took {self._timings[phase]:.2f}s, "
+            f"peak host memory {self._memory[phase]['peak_rss_mb']} MB"
+        )
+        return result
+
+    def _load(self):
+        from huggingface_hub import snapshot_download
+        from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+
+        self._state = "loading"
+        self._error = None
+        self._timings = {}
+        self._memory = {}
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        try:
+            print("Initializing the model...")
+
+            def download():
+                model_path = snapshot_download(self.model_name, revision=self.revision)
+                # Only the tokenizer and preprocessing configs are needed for the processor
+                processor_path = snapshot_download(
+                    self.processor_name,
+                    allow_patterns=["*.json", "*.txt", "*.jinja"],
+                )
+                return model_path, processor_path
+
+            model_path, processor_path = self._run_phase("download", download)
+
+            def load():
+                model = None
+                if self.low_memory:
+                    model = load_streaming(
+                        Qwen2VLForConditionalGeneration,
+                        model_path,
+                        self.dtype,
+                        self.device,
+                    )
+                    self._loader = "streaming"
+                if model is None:
+                    # Builds the whole model on the host, moved by device_transfer
+                    self._loader = "from_pretrained"
+                    model = Qwen2VLForConditionalGeneration.from_pretrained(
+                        model_path, torch_dtype=self.dtype
+                    ).eval()
+                processor = AutoProcessor.from_pretrained(processor_path)
+                # Pad on the left so that batched prompts all end where generation starts
+                processor.tokenizer.padding_side = "left"
+                return model, processor
+
+            model, processor = self._run_phase("load", load)
+            model = self._run_phase("device_transfer", lambda: model.to(self.device))
+
+            if self.optimize is not None:
+                model = self._run_phase(
+                    "optimize", lambda: self.optimize(model, processor, self.device)
+                )
+
+            if self.warmup is not None:
+                self._run_phase(
+                    "warmup", lambda: self.warmup(model, processor, self.device)
+                )
+
+            if self.benchmark is not None:
+                self._benchmark = self._run_phase(
+                    "benchmark", lambda: self.benchmark(model, processor, self.device)
+                )
+
+            self._components = (model, processor, self.device)
+            self._state = "ready"
+            self._phase = None
+            steady = self._memory["steady"] = memory_snapshot(self.device)
+            print(
+                f"Model loaded on {self.device} with the {self._loader} loader, "
+                f"host memory {steady['rss_mb']} MB (peak {steady['peak_rss_mb']} MB)"
+                + (
+                    f", device memory {steady['device_mb']} MB "
+                    f"(peak {steady['device_peak_mb']} MB)"
+                    if "device_mb" in steady
+                    else ""
+                )
+            )
+
+        except Exception as e:
+            self._state = "failed"
+            self._error = str(e)
+            print(f"Model failed to load during '{self._phase}': {e}")
+            raise
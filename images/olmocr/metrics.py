@@ -0,0 +1,389 @@
+"""Prometheus-format metrics for the OCR service
+
+Set OLMOCR_METRICS=0 to disable them: stage timers then return a shared no-op
+context manager and the recording functions return immediately.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+ENABLED = os.environ.get("OLMOCR_METRICS", "1") == "1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 1536, 2048, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+_NOOP = nullcontext()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def state(self):
+        """Return the values of the counter, as merged by `merge`"""
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, state):
+        """Add the values returned by `state()` of another counter"""
+        with self._lock:
+            for labels, value in state.items():
+                self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        values = self.state()
+        for remote in _remote_states(self.name):
+            for labels, value in remote.items():
+                values[labels] = values.get(labels, 0) + value
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """Value sampled when metrics are scraped, from `set()` or from a callback"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Returns a {labels: value} mapping, or a single value without labels
+        self.callback = callback
+        self._values = {}
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def samples(self):
+        values = dict(self._values)
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception:
+                result = None
+            if isinstance(result, dict):
+                values.update(result)
+            elif result is not None:
+                values[()] = result
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Cumulative bucketed histogram, optionally split by label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts, the last one is +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def state(self):
+        """Return the series of the histogram, as merged by `merge`"""
+        with self._lock:
+            return {labels: list(values) for labels, values in self._series.items()}
+
+    def merge(self, state):
+        """Add the series returned by `state()` of a histogram with the same buckets"""
+        with self._lock:
+            for labels, values in state.items():
+                _add_series(self._series, labels, values)
+
+    def samples(self):
+        series = self.state()
+        for remote in _remote_states(self.name):
+            for labels, values in remote.items():
+                _add_series(series, labels, values)
+        names = self.labelnames + ("le",)
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(names, labels + (bound,)),
+                    cumulative,
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum", label_text, values[-1]
+            yield f"{self.name}_count", label_text, cumulative
+
+
+def _add_series(series, labels, values):
+    current = series.get(labels)
+    if current is None:
+        series[labels] = list(values)
+    else:
+        series[labels] = [a + b for a, b in zip(current, values)]
+
+
+REGISTRY = []
+
+# Latest state() of the counters and histograms of other processes, such as the
+# model replicas, by process: they are added to the samples of this one
+_remote = {}
+_remote_lock = threading.Lock()
+
+
+def _remote_states(name):
+    with _remote_lock:
+        return [
+            snapshot[name] for snapshot in _remote.values() if name in snapshot
+        ]
+
+
+def snapshot():
+    """Return the state of every counter and histogram, see `update_remote`"""
+    if not ENABLED:
+        return None
+    return {
+        metric.name: metric.state()
+        for metric in REGISTRY
+        if hasattr(metric, "state")
+    }
+
+
+def update_remote(source, state):
+    """Include the `snapshot()` of another process in the samples, replacing the last
+
+    Counters of a process only grow, so the latest snapshot holds all of its values.
+    """
+    if state is None:
+        return
+    with _remote_lock:
+        _remote[source] = state
+
+
+def retire_remote(source):
+    """Keep the last snapshot of a process that exited, its successor starts at 0"""
+    with _remote_lock:
+        state = _remote.pop(source, None)
+    if state is None:
+        return
+    for metric in REGISTRY:
+        if metric.name in state and hasattr(metric, "merge"):
+            metric.merge(state[metric.name])
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+STAGE_SECONDS = register(
+    Histogram(
+        "olmocr_stage_seconds",
+        "Latency of each pipeline stage (download, render, anchor, text_layer, "
+        "resize, queue, processor, prefill, generate, batch_decode)",
+        ["stage"],
+    )
+)
+PROMPT_TOKENS = register(
+    Counter("olmocr_prompt_tokens_total", "Prompt tokens, image tokens included")
+)
+GENERATED_TOKENS = register(
+    Counter("olmocr_generated_tokens_total", "Generated tokens")
+)
+REJECTED_REQUESTS = register(
+    Counter(
+        "olmocr_rejected_requests_total",
+        "Requests turned away by admission control",
+        ["reason"],
+    )
+)
+GENERATION_TOKENS_PER_SECOND = register(
+    Histogram(
+        "olmocr_generation_tokens_per_second",
+        "Generated tokens per second of each generate call",
+        buckets=RATE_BUCKETS,
+    )
+)
+VISUAL_TOKENS = register(
+    Histogram(
+        "olmocr_visual_tokens",
+        "Visual tokens of each image handed to the model",
+        buckets=TOKEN_BUCKETS,
+    )
+)
+TEXT_LAYER_PAGES = register(
+    Counter(
+        "olmocr_text_layer_pages_total",
+        "PDF pages by the source of their text, the text layer or the model",
+        ["source"],
+    )
+)
+TEXT_LAYER_SAVED_SECONDS = register(
+    Counter(
+        "olmocr_text_layer_saved_seconds_total",
+        "Estimated model time saved by pages answered from their text layer",
+    )
+)
+QUEUE_DEPTH = register(
+    Gauge("olmocr_queue_depth", "Requests waiting to be generated")
+)
+REPLICA_UTILISATION = register(
+    Gauge(
+        "olmocr_replica_utilisation",
+        "Fraction of the last second each model replica spent generating",
+        ["replica"],
+    )
+)
+
+
+def _process_memory():
+    # statm reports the resident set size in pages
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _accelerator_memory():
+    import torch
+
+    if not torch.cuda.is_available():
+        return {}
+    values = {}
+    for index in range(torch.cuda.device_count()):
+        values[(str(index), "allocated")] = torch.cuda.memory_allocated(index)
+        values[(str(index), "reserved")] = torch.cuda.memory_reserved(index)
+        values[(str(index), "peak_allocated")] = torch.cuda.max_memory_allocated(index)
+    return values
+
+
+register(
+    Gauge(
+        "olmocr_process_resident_memory_bytes",
+        "Resident memory of the service process",
+        callback=_process_memory,
+    )
+)
+register(
+    Gauge(
+        "olmocr_accelerator_memory_bytes",
+        "Accelerator memory held by PyTorch",
+        ["device", "kind"],
+        callback=_accelerator_memory,
+    )
+)
+
+
+class _StageTimer:
+    __slots__ = ("labels", "started")
+
+    def __init__(self, name):
+        self.labels = (name,)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, self.labels)
+        return False
+
+
+def stage(name):
+    """Context manager recording the duration of a pipeline stage"""
+    if not ENABLED:
+        return _NOOP
+    return _StageTimer(name)
+
+
+def observe_stage(name, seconds):
+    if ENABLED:
+        STAGE_SECONDS.observe(seconds, (name,))
+
+
+def observe_generation(prompt_tokens, generated_tokens, seconds):
+    """Record the token counts and throughput of one generate call"""
+    if not ENABLED:
+        return
+    PROMPT_TOKENS.inc(prompt_tokens)
+    GENERATED_TOKENS.inc(generated_tokens)
+    if seconds > 0 and generated_tokens:
+        GENERATION_TOKENS_PER_SECOND.observe(generated_tokens / seconds)
+
+
+def observe_rejection(reason):
+    if ENABLED:
+        REJECTED_REQUESTS.inc(labels=(reason,))
+
+
+def observe_image(tokens):
+    if ENABLED:
+        VISUAL_TOKENS.observe(tokens)
+
+
+def observe_text_layer(source, saved_seconds=None):
+    """Record the source of a PDF page's text, see textlayer.py"""
+    if not ENABLED:
+        return
+    TEXT_LAYER_PAGES.inc(labels=(source,))
+    if saved_seconds:
+        TEXT_LAYER_SAVED_SECONDS.inc(saved_seconds)
+
+
+def render():
+    """Return every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def add_route(app, path="/metrics"):
+    """Serve the metrics at `path` of a FastAPI app, next to the UI and the API"""
+    from fastapi.responses import PlainTextResponse
+
+    @app.get(path, include_in_schema=False)
+    def metrics_endpoint():
+        return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+    return app
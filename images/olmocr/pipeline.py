@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from pypdf import PdfReader
+
+from anchors import AnchorIndex
+
+# CPU-side pipeline settings for whole-document OCR
+RENDER_WORKERS = int(
+    os.environ.get("OLMOCR_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+PAGE_LOOKAHEAD = int(os.environ.get("OLMOCR_PAGE_LOOKAHEAD", "4"))
+RENDER_CHUNK_PAGES = int(os.environ.get("OLMOCR_RENDER_CHUNK_PAGES", "8"))
+ANCHOR_INDEX_DOCUMENTS = int(os.environ.get("OLMOCR_ANCHOR_INDEX_DOCUMENTS", "4"))
+
+_executor = None
+_render_threads = None
+_executor_lock = threading.Lock()
+
+# Anchor indexes of the documents recently seen by this (worker) process
+_anchor_indexes = OrderedDict()
+
+
+def get_render_executor():
+    """Return the shared process pool used to extract anchor text"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Anchor text extraction is CPU bound and not thread safe, so use processes
+            _executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _executor
+
+
+def get_render_threads():
+    """Return the shared thread pool driving pdftoppm, which renders in its own process"""
+    global _render_threads
+    with _executor_lock:
+        if _render_threads is None:
+            _render_threads = ThreadPoolExecutor(
+                max_workers=RENDER_WORKERS, thread_name_prefix="olmocr-render"
+            )
+    return _render_threads
+
+
+def get_page_count(pdf_path):
+    """Return the number of pages of a PDF"""
+    return len(PdfReader(pdf_path).pages)
+
+
+def parse_page_range(spec, page_count):
+    """Parse a page selection such as "1-3, 7" or "all" into a list of page numbers"""
+    spec = str(spec or "").strip().lower()
+    if spec in ("", "all", "*"):
+        return list(range(1, page_count + 1))
+
+    pages = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end > page_count or start > end:
+            raise ValueError(
+                f"Invalid page range '{part}' for a document with {page_count} pages"
+            )
+        pages.extend(range(start, end + 1))
+
+    # Keep the order given by the user but drop duplicates
+    return list(dict.fromkeys(pages))
+
+
+def get_anchor_index(pdf_path, target_length=4000):
+    """Return this process's AnchorIndex of a PDF, rebuilt if the file changed"""
+    stat = os.stat(pdf_path)
+    identity = (
+        os.path.realpath(pdf_path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        target_length,
+    )
+    index = _anchor_indexes.get(identity)
+    if index is None:
+        index = _anchor_indexes[identity] = AnchorIndex(pdf_path, target_length)
+        while len(_anchor_indexes) > ANCHOR_INDEX_DOCUMENTS:
+            _anchor_indexes.popitem(last=False)
+    _anchor_indexes.move_to_end(identity)
+    return index
+
+
+def extract_anchor_text(pdf_path, page_number, target_length=4000):
+    """Extract the anchor text of a page (runs in a worker process)
+
+    Each worker keeps an index of the documents it has seen, so a document is opened
+    and parsed once per worker instead of once per page.
+    """
+    return get_anchor_index(pdf_path, target_length).get(page_number)
+
+
+def extract_text_layer(pdf_path, page_number, target_length=4000):
+    """Extract and score the text layer of a page (runs in a worker process)
+
+    Shares the document's anchor index, so the anchor text of the page is parsed in
+    the same pass.
+    """
+    return get_anchor_index(pdf_path, target_length).text_layer(page_number)
+
+
+def timed_call(fn, *args):
+    """Call `fn` (in a worker process) and return (result, seconds)"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def combine_futures(futures, combine):
+    """Return a Future resolved with `combine(*results)` once all `futures` are done"""
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] or combined.done():
+                return
+        try:
+            combined.set_result(combine(*(future.result() for future in futures)))
+        except BaseException as e:
+            if not combined.done():
+                combined.set_exception(e)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    # Cancelling the combined Future cancels the stages that have not started yet
+    combined.add_done_callback(
+        lambda done: done.cancelled() and [future.cancel() for future in futures]
+    )
+    return combined
+
+
+def chain_futures(first, then):
+    """Return a Future resolved like the Future returned by `then(first)`
+
+    `then` is called with `first` once it is done, whether it failed or not, and
+    decides the next stage. Cancelling the chained Future cancels the pending stage.
+    """
+    chained = Future()
+    stages = [first]
+
+    def copy(done):
+        if chained.done():
+            return
+        if done.cancelled():
+            chained.cancel()
+        elif done.exception() is not None:
+            chained.set_exception(done.exception())
+        else:
+            chained.set_result(done.result())
+
+    def on_first(done):
+        if chained.done():
+            return
+        if done.cancelled():
+            chained.cancel()
+            return
+        try:
+            second = then(done)
+        except BaseException as e:
+            chained.set_exception(e)
+            return
+        stages.append(second)
+        second.add_done_callback(copy)
+
+    first.add_done_callback(on_first)
+    chained.add_done_callback(
+        lambda done: done.cancelled() and [stage.cancel() for stage in stages]
+    )
+    return chained
+
+
+def iter_pipelined(
+    pages, prepare, generate, lookahead=PAGE_LOOKAHEAD, heartbeat=None
+):
+    """Run prepare -> generate over pages, yielding (page_number, result, error) in order
+
+    `prepare(page_number)` returns a Future for the CPU stage and `generate(prepared)`
+    returns a Future for the model stage. At most `lookahead` pages are held in each
+    stage, so pages N+1..N+k are prepared while page N is being generated and memory
+    stays bounded regardless of the document size. With `heartbeat` seconds, None is
+    yielded each time the next page has not finished within that time.
+    """
+    lookahead = max(1, int(lookahead))
+    pending_pages = iter(pages)
+    preparing = deque()
+    generating = deque()
+
+    def fill_preparing():
+        while len(preparing) < lookahead:
+            page_number = next(pending_pages, None)
+            if page_number is None:
+                return
+            preparing.append((page_number, prepare(page_number)))
+
+    fill_preparing()
+    try:
+        while preparing or generating:
+            # Hand prepared pages to the model while there is room in the model stage
+            while (
+                preparing
+                and len(generating) < lookahead
+                and (preparing[0][1].done() or not generating)
+            ):
+                page_number, future = preparing.popleft()
+                try:
+                    generating.append((page_number, generate(future.result())))
+                except Exception as e:
+                    generating.append((page_number, _failed(e)))
+                fill_preparing()
+
+            page_number, future = generating[0]
+            if heartbeat is not None and not wait([future], timeout=heartbeat).done:
+                yield None
+                continue
+            generating.popleft()
+            try:
+                yield page_number, future.result(), None
+            except Exception as e:
+                yield page_number, None, e
+    finally:
+        # Stop feeding the workers if the consumer goes away
+        for _, future in list(preparing) + list(generating):
+            future.cancel()
+
+
+def _failed(error):
+    future = Future()
+    future.set_exception(error)
+    return future
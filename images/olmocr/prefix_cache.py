@@ -0,0 +1,211 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache, LogitsProcessor
+
+# Stands in for the anchor text to find where the per-request part of a prompt starts
+PROMPT_SENTINEL = "\x00OLMOCR_ANCHOR_TEXT\x00"
+# transformers releases whose Qwen2-VL generate() and cache internals the prefix cache
+# follows, the image gets 4.48 from sglang
+SUPPORTED_TRANSFORMERS = ("4.46", "4.49")
+
+
+def transformers_supported():
+    """Return whether the installed transformers is in SUPPORTED_TRANSFORMERS"""
+    import transformers
+    from packaging.version import Version
+
+    low, high = SUPPORTED_TRANSFORMERS
+    return Version(low) <= Version(transformers.__version__) < Version(high)
+
+
+def prefix_token_ids(processor, build_prompt):
+    """Return the token ids of the chat prompt that precede the anchor text
+
+    The prefix is derived from the current prompt and chat templates on every call,
+    so a changed template yields different ids (and thus different cache entries).
+    The last token is left out in case it merges with the text that follows it.
+    """
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": build_prompt(PROMPT_SENTINEL)},
+                {"type": "image"},
+            ],
+        }
+    ]
+    text = processor.apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=True
+    )
+    prefix = text[: text.index(PROMPT_SENTINEL)]
+    return processor.tokenizer(prefix, add_special_tokens=False)["input_ids"][:-1]
+
+
+def move_padding_after_prefix(inputs, prefix_ids):
+    """Move the left padding of each row behind the shared prefix
+
+    All rows then hold the prefix at the same positions, so one cached prefix serves
+    the whole batch. Returns None when a row does not start with `prefix_ids`.
+    """
+    input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+    prefix = torch.tensor(prefix_ids, device=input_ids.device)
+    length = len(prefix_ids)
+    rows, masks = [], []
+    for ids, mask in zip(input_ids, attention_mask):
+        padding = int((mask == 0).sum())
+        if not torch.equal(ids[padding : padding + length], prefix):
+            return None
+        order = torch.cat(
+            [
+                torch.arange(padding, padding + length),
+                torch.arange(0, padding),
+                torch.arange(padding + length, ids.shape[0]),
+            ]
+        ).to(ids.device)
+        rows.append(ids[order])
+        masks.append(mask[order])
+    return dict(inputs, input_ids=torch.stack(rows), attention_mask=torch.stack(masks))
+
+
+class FirstTokenTimer(LogitsProcessor):
+    """Records when the first token's logits are ready, i.e. when prefill is done"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.prefill_seconds = None
+
+    def __call__(self, input_ids, scores):
+        if self.prefill_seconds is None:
+            self.prefill_seconds = time.perf_counter() - self.started
+        return scores
+
+
+class PrefixCache:
+    """KV cache of the prompt prefix shared by all requests, computed once per model
+
+    Entries are keyed by the model and the prefix token ids, so a changed prompt
+    template misses and computes a new entry, and the least recently used entries
+    beyond `max_entries` are dropped. Prefill times are tracked with and without the
+    cache so the gain shows up in `stats()`.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self._prefill = {"cached": [0, 0.0], "uncached": [0, 0.0]}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model, prefix_ids):
+        """Return the KV cache of `prefix_ids` for a batch of one, computing it if needed"""
+        key = (id(model), tuple(prefix_ids))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Text-only positions are the same in all three rotary sections
+        positions = torch.arange(len(prefix_ids), device=model.device)
+        with torch.no_grad():
+            entry = model(
+                input_ids=torch.tensor([prefix_ids], device=model.device),
+                position_ids=positions.view(1, 1, -1).expand(3, 1, -1),
+                use_cache=True,
+            ).past_key_values
+
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def record_prefill(self, cached, seconds):
+        with self._lock:
+            totals = self._prefill["cached" if cached else "uncached"]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+            for name, (count, seconds) in self._prefill.items():
+                stats[f"{name}_batches"] = count
+                stats[f"{name}_mean_prefill_ms"] = (
+                    round(1000 * seconds / count, 1) if count else None
+                )
+        return stats
+
+
+def generate_from_prefix(
+    model, inputs, prefix_kv, prefix_length, num_return_sequences=1, **generate_kwargs
+):
+    """Generate for a batch whose rows all start with the prefix cached in `prefix_kv`
+
+    `inputs` must come from move_padding_after_prefix. generate() cannot start from a
+    pre-filled cache on Qwen2-VL (it drops the image and the multimodal rotary
+    offsets once the cache is not empty), so the tokens after the prefix are
+    prefilled here with the full prompt's position ids. Only the last prompt token is
+    left for generate(), which continues from the stored rotary offsets.
+
+    The prompt and image are prefilled once per request; the cache is then copied
+    for each of the `num_return_sequences` candidates, which own consecutive rows.
+    Without `prefix_kv` (and a `prefix_length` of 0) the whole prompt is prefilled
+    into an empty cache, which any left padded batch can do.
+    """
+    input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+    batch_size, length = input_ids.shape
+
+    if prefix_kv is None:
+        past_key_values = DynamicCache()
+    else:
+        # The cached entry is shared, extend a copy of it
+        past_key_values = copy.deepcopy(prefix_kv)
+        past_key_values.batch_repeat_interleave(batch_size)
+
+    get_rope_index = getattr(model, "get_rope_index", None) or model.model.get_rope_index
+    position_ids, rope_deltas = get_rope_index(
+        input_ids, inputs.get("image_grid_thw"), None, attention_mask
+    )
+
+    with torch.no_grad():
+        model(
+            input_ids=input_ids[:, prefix_length:-1],
+            attention_mask=attention_mask[:, :-1],
+            position_ids=position_ids[:, :, prefix_length:-1],
+            past_key_values=past_key_values,
+            pixel_values=inputs.get("pixel_values"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            cache_position=torch.arange(prefix_length, length - 1, device=input_ids.device),
+            use_cache=True,
+        )
+
+    if num_return_sequences > 1:
+        past_key_values.batch_repeat_interleave(num_return_sequences)
+        input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+        rope_deltas = rope_deltas.repeat_interleave(num_return_sequences, dim=0)
+
+    # Depending on the transformers version the offsets are read from the generation
+    # kwargs or from the model itself
+    for owner in (model, getattr(model, "model", None)):
+        if owner is not None and hasattr(owner, "rope_deltas"):
+            owner.rope_deltas = rope_deltas
+    return model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        past_key_values=past_key_values,
+        rope_deltas=rope_deltas,
+        **generate_kwargs,
+    )
@@ -0,0 +1,202 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import metrics
+
+# pdftoppm names its outputs <prefix>-<page>.ppm, zero padded to the page count width
+PAGE_FILE = re.compile(r"^page-(\d+)\.ppm$")
+
+
+def render_pages(
+    pdf_path, first_page, last_page, target_longest_image_dim=1024, poll_interval=0.01
+):
+    """Rasterise a page range with a single pdftoppm run, yielding (page_number, ppm_bytes)
+
+    The document is opened and parsed once for the whole range, and pages are handed
+    out as soon as pdftoppm finishes them. Pages are scaled so that their longest side
+    is `target_longest_image_dim` and returned as raw PPM buffers, which skips PNG
+    encoding (and base64) entirely.
+    """
+    temp_dir = tempfile.mkdtemp(prefix="olmocr-render-")
+    stderr_path = os.path.join(temp_dir, "stderr.txt")
+    with open(stderr_path, "wb") as stderr:
+        process = subprocess.Popen(
+            [
+                "pdftoppm",
+                "-f",
+                str(first_page),
+                "-l",
+                str(last_page),
+                "-scale-to",
+                str(target_longest_image_dim),
+                pdf_path,
+                os.path.join(temp_dir, "page"),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+
+    try:
+        next_page = first_page
+        page_started = time.perf_counter()
+        while next_page <= last_page:
+            finished = process.poll() is not None
+            written = {}
+            for name in os.listdir(temp_dir):
+                match = PAGE_FILE.match(name)
+                if match:
+                    written[int(match.group(1))] = os.path.join(temp_dir, name)
+
+            # pdftoppm writes one page at a time, so a page is complete once a later
+            # page has been started or the process has exited
+            while next_page in written and (
+                finished or any(page > next_page for page in written)
+            ):
+                with open(written[next_page], "rb") as f:
+                    data = f.read()
+                os.unlink(written[next_page])
+                # Pages are rendered one after the other, time each from the previous
+                now = time.perf_counter()
+                metrics.observe_stage("render", now - page_started)
+                page_started = now
+                yield next_page, data
+                next_page += 1
+
+            if next_page > last_page:
+                break
+            if finished or any(page > next_page for page in written):
+                with open(stderr_path, "rb") as f:
+                    errors = f.read().decode("utf-8", "replace").strip()
+                raise RuntimeError(
+                    f"pdftoppm did not render page {next_page} of {pdf_path} "
+                    f"(exit code {process.poll()}): {errors}"
+                )
+            time.sleep(poll_interval)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def render_page(pdf_path, page_number, target_longest_image_dim=1024):
+    """Rasterise a single page, returning its raw PPM buffer"""
+    for _, data in render_pages(
+        pdf_path, page_number, page_number, target_longest_image_dim
+    ):
+        return data
+
+
+def contiguous_chunks(pages, chunk_size):
+    """Split page numbers into runs of consecutive pages of at most `chunk_size`"""
+    chunks = []
+    for page in pages:
+        if chunks and page == chunks[-1][-1] + 1 and len(chunks[-1]) < chunk_size:
+            chunks[-1].append(page)
+        else:
+            chunks.append([page])
+    return chunks
+
+
+class RangeRenderer:
+    """Render the requested pages of one document in contiguous chunks on a thread pool
+
+    Each chunk is a single pdftoppm run, started the first time one of its pages is
+    requested with `submit()`. Several chunks render in parallel on `executor`. With
+    `needs_render(page_number)`, the other pages of a chunk for which it returns False
+    (e.g. pages answered from their text layer) are left out, splitting the chunk
+    into one run per remaining range; it is called on the executor and may block. A
+    page left out and requested later is rendered on its own.
+    """
+
+    def __init__(
+        self,
+        pdf_path,
+        pages,
+        executor,
+        target_longest_image_dim=1024,
+        chunk_size=8,
+        needs_render=None,
+    ):
+        self.pdf_path = pdf_path
+        self.executor = executor
+        self.target_longest_image_dim = target_longest_image_dim
+        self.needs_render = needs_render
+
+        self._chunks = contiguous_chunks(list(pages), max(1, int(chunk_size)))
+        self._chunk_of = {}
+        self._futures = {}
+        for index, chunk in enumerate(self._chunks):
+            for page in chunk:
+                self._chunk_of[page] = index
+                self._futures[page] = Future()
+        self._started = set()
+        self._requested = set()
+        self._skipped = set()
+        self._lock = threading.Lock()
+
+    def submit(self, page_number):
+        """Return a Future of the page's PPM buffer, starting its chunk if needed"""
+        index = self._chunk_of[page_number]
+        with self._lock:
+            self._requested.add(page_number)
+            if index not in self._started:
+                self._started.add(index)
+                self.executor.submit(self._render_chunk, self._chunks[index])
+            elif page_number in self._skipped:
+                self._skipped.discard(page_number)
+                self.executor.submit(self._render_runs, [page_number])
+        return self._futures[page_number]
+
+    def _render_chunk(self, chunk):
+        pages = chunk
+        if self.needs_render is not None:
+            needed = [page for page in chunk if self._needs_render(page)]
+            with self._lock:
+                # Pages requested in the meantime are rendered all the same
+                pages = [
+                    page
+                    for page in chunk
+                    if page in needed or page in self._requested
+                ]
+                self._skipped.update(page for page in chunk if page not in pages)
+        self._render_runs(pages)
+
+    def _needs_render(self, page):
+        with self._lock:
+            if page in self._requested:
+                return True
+        try:
+            return self.needs_render(page)
+        except Exception as e:
+            print(f"Rendering page {page}, could not tell if it is needed: {e}")
+            return True
+
+    def _render_runs(self, pages):
+        """Render `pages` with one pdftoppm run per range of consecutive pages"""
+        try:
+            for run in contiguous_chunks(pages, len(pages)):
+                for page, data in render_pages(
+                    self.pdf_path, run[0], run[-1], self.target_longest_image_dim
+                ):
+                    self._resolve(page, result=data)
+        except Exception as e:
+            for page in pages:
+                self._resolve(page, error=e)
+
+    def _resolve(self, page, result=None, error=None):
+        future = self._futures[page]
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            # Cancelled, or already rendered, while the chunk was being rendered
+            pass
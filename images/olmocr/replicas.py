@@ -0,0 +1,667 @@
+import argparse
+import importlib
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from multiprocessing.connection import Connection
+
+import metrics
+from admission import estimate_tokens
+from cpu import cpu_quota
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_cpus(text):
+    """Parse a CPU list such as "0-3,8" into [0, 1, 2, 3, 8]"""
+    cpus = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpus(cpus):
+    return ",".join(str(cpu) for cpu in cpus)
+
+
+def replica_specs(count, devices=None, cpu_sets=None):
+    """Return the (device, cpus) of each of `count` replicas
+
+    `devices` are assigned to the replicas in turn; by default every CUDA device in
+    turn, or the CPU when there is none. CPU replicas split the CPUs this process may
+    use (within its cgroup quota) into disjoint sets unless `cpu_sets` are given.
+    Replicas on an accelerator get no CPU set.
+    """
+    count = max(1, int(count))
+    if not devices:
+        import torch
+
+        gpus = torch.cuda.device_count()
+        devices = [f"cuda:{index}" for index in range(gpus)] or ["cpu"]
+    devices = [device for device, _ in zip(itertools.cycle(devices), range(count))]
+
+    cpu_replicas = [index for index, device in enumerate(devices) if device == "cpu"]
+    cpus = [None] * count
+    if cpu_sets:
+        for index, cpu_set in zip(cpu_replicas, itertools.cycle(cpu_sets)):
+            cpus[index] = cpu_set
+    elif cpu_replicas:
+        available = sorted(os.sched_getaffinity(0))[: cpu_quota()]
+        share = max(1, len(available) // len(cpu_replicas))
+        for slot, index in enumerate(cpu_replicas):
+            cpu_set = available[slot * share : (slot + 1) * share]
+            cpus[index] = cpu_set or available
+    return list(zip(devices, cpus))
+
+
+class PendingRequest:
+    """A request sent to a replica and not answered yet, owned by ReplicaPool"""
+
+    def __init__(self, future, streamer, tokens, stop_event, message):
+        self.future = future
+        self.streamer = streamer
+        self.tokens = tokens
+        self.stop_event = stop_event
+        self.message = message
+        self.attempts = 1
+        # Set once text was streamed, a retry would stream it again
+        self.streamed = False
+
+
+class Replica:
+    """Bookkeeping of one worker process, owned by ReplicaPool"""
+
+    def __init__(self, index, device, cpus):
+        self.index = index
+        self.device = device
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.state = "stopped"
+        self.started_at = None
+        self.last_seen = None
+        self.restart_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.requests = 0
+        self.pending = {}
+        self.worker = {}
+        self.utilisation = 0.0
+        self._busy = None
+
+    def load(self):
+        """Outstanding (estimated tokens, requests) used for least-loaded dispatch"""
+        return (
+            sum(request.tokens for request in self.pending.values()),
+            len(self.pending),
+        )
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def observe(self, status):
+        """Record a status report of the worker and update its utilisation"""
+        now = time.monotonic()
+        busy = status["busy_seconds"]
+        if self._busy is not None and now > self._busy[0]:
+            self.utilisation = min(1.0, (busy - self._busy[1]) / (now - self._busy[0]))
+        self._busy = (now, busy)
+        self.last_seen = now
+        self.worker = status
+
+
+class ReplicaPool:
+    """Model replicas in worker processes behind a least-loaded dispatcher
+
+    Each worker (see `serve`) loads its own model on its device or CPU set and
+    batches the requests it is sent with a BatchScheduler. Requests go to the
+    running replica with the fewest outstanding estimated tokens. A worker that
+    exits, stops reporting for `health_timeout` seconds, or whose running batch
+    decodes no token for `stall_timeout` seconds (0 disables it) is killed and
+    restarted with an increasing delay, the other replicas keep serving. Its
+    outstanding requests are sent again to another running replica, or to the
+    restarted worker, unless they streamed text already or were sent MAX_ATTEMPTS
+    times: those fail. Workers send their stage and token metrics with their
+    status, they are added to this process's metrics. `factory` ("module:function")
+    builds the engine and batch runner of a worker, see generation.make_replica.
+    """
+
+    HEALTH_INTERVAL = 0.25
+    # Times a request is sent before a crash fails it, so that a request crashing
+    # its worker is not retried forever
+    MAX_ATTEMPTS = 2
+    # Seconds a new worker may take to import its model code and report
+    STARTUP_TIMEOUT = 300.0
+
+    def __init__(
+        self,
+        specs,
+        factory="generation:make_replica",
+        max_batch_size=4,
+        max_wait_ms=50,
+        max_batch_tokens=0,
+        health_timeout=30.0,
+        stall_timeout=300.0,
+    ):
+        self.replicas = [
+            Replica(index, device, cpus) for index, (device, cpus) in enumerate(specs)
+        ]
+        self.factory = factory
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_tokens = max_batch_tokens
+        self.health_timeout = health_timeout
+        self.stall_timeout = stall_timeout
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for replica in self.replicas:
+                self._spawn(replica)
+        threading.Thread(
+            target=self._monitor, name="olmocr-replica-monitor", daemon=True
+        ).start()
+
+    def close(self):
+        """Stop the workers, failing their outstanding requests"""
+        with self._lock:
+            self._closed = True
+            replicas = [r for r in self.replicas if r.process is not None]
+        for replica in replicas:
+            replica.process.kill()
+            replica.process.wait()
+            replica.conn.close()
+            with self._lock:
+                pending, replica.pending = replica.pending, {}
+                replica.state = "stopped"
+            for request in pending.values():
+                if not request.future.done():
+                    request.future.set_exception(RuntimeError("Replica pool closed"))
+
+    def submit(
+        self, prompt, image, params, streamer=None, stop_event=None, client=None
+    ):
+        """Send a request to the least loaded replica and return a Future of its outputs
+
+        Cancelling the Future unqueues the request, or stops it if it is running.
+        """
+        future = Future()
+        request_id = next(self._ids)
+        message = (
+            "submit",
+            request_id,
+            prompt,
+            image,
+            tuple(params),
+            streamer is not None,
+            client,
+        )
+        request = PendingRequest(
+            future,
+            streamer,
+            estimate_tokens(prompt, image, params),
+            stop_event,
+            message,
+        )
+        with self._lock:
+            replica = self._choose()
+            if replica is None:
+                future.set_exception(RuntimeError("No model replica is running"))
+                return future
+            replica.pending[request_id] = request
+            replica.requests += 1
+
+        def cancel(done):
+            if done.cancelled():
+                # The request may have moved to another replica since
+                with self._lock:
+                    owner = self._owner(request_id)
+                if owner is not None:
+                    self._send(owner, ("cancel", request_id))
+
+        future.add_done_callback(cancel)
+        if not self._send(replica, message):
+            self._fail(replica, request_id, RuntimeError("Model replica unavailable"))
+        return future
+
+    def _choose(self):
+        """Return the replica to send a request to, None when none is running"""
+        running = [r for r in self.replicas if r.state in ("starting", "ready")]
+        if not running:
+            return None
+        # Prefer replicas whose model is loaded, then the least loaded one
+        return min(running, key=lambda r: (r.state != "ready", r.load()))
+
+    def _owner(self, request_id):
+        for replica in self.replicas:
+            if request_id in replica.pending:
+                return replica
+        return None
+
+    def queue_depth(self):
+        ready = [r for r in self.replicas if r.state == "ready"]
+        return sum(r.worker.get("queued", 0) for r in ready)
+
+    def utilisation(self):
+        """Return the busy fraction of each replica, keyed by its label"""
+        return {(str(r.index),): r.utilisation for r in self.replicas}
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "replica": r.index,
+                    "device": r.device,
+                    "cpus": format_cpus(r.cpus) if r.cpus else None,
+                    "state": r.state,
+                    "pid": r.process.pid if r.process else None,
+                    "uptime_seconds": (
+                        round(now - r.started_at, 1) if r.started_at else None
+                    ),
+                    "restarts": r.restarts,
+                    "outstanding": len(r.pending),
+                    "requests": r.requests,
+                    "utilisation": round(r.utilisation, 3),
+                    "model": r.worker.get("model"),
+                    "batches": r.worker.get("batches"),
+                    "stalled_seconds": r.worker.get("stalled_seconds"),
+                }
+                for r in self.replicas
+            ]
+
+    def _spawn(self, replica):
+        """Start the worker process of a replica, connected by a socket pair"""
+        parent_socket, child_socket = socket.socketpair()
+        command = [
+            sys.executable,
+            os.path.join(HERE, "replicas.py"),
+            "--fd",
+            str(child_socket.fileno()),
+            "--device",
+            replica.device,
+            "--factory",
+            self.factory,
+            "--max-batch-size",
+            str(self.max_batch_size),
+            "--max-wait-ms",
+            str(self.max_wait_ms),
+            "--max-batch-tokens",
+            str(self.max_batch_tokens),
+        ]
+        if replica.cpus:
+            command += ["--cpus", format_cpus(replica.cpus)]
+        replica.process = subprocess.Popen(command, pass_fds=[child_socket.fileno()])
+        child_socket.close()
+        replica.conn = Connection(parent_socket.detach())
+        replica.state = "starting"
+        replica.started_at = replica.last_seen = time.monotonic()
+        replica.restart_at = None
+        replica._busy = None
+        replica.worker = {}
+        print(
+            f"Started model replica {replica.index} on {replica.device}"
+            + (f" (CPUs {format_cpus(replica.cpus)})" if replica.cpus else "")
+            + f", pid {replica.process.pid}"
+        )
+        # Requests of the previous worker that found no other replica to go to
+        for request in replica.pending.values():
+            self._send(replica, request.message)
+        threading.Thread(
+            target=self._read,
+            args=(replica, replica.conn),
+            name=f"olmocr-replica-{replica.index}",
+            daemon=True,
+        ).start()
+
+    def _send(self, replica, message):
+        try:
+            replica.send(message)
+            return True
+        except (OSError, ValueError):
+            # The worker died, the monitor restarts it
+            return False
+
+    def _read(self, replica, conn):
+        """Dispatch the messages of a worker until its connection closes"""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            if replica.conn is not conn:
+                # Left over from a worker that was restarted
+                return
+            kind, request_id = message[0], message[1]
+            if kind == "status":
+                status = message[1]
+                metrics.update_remote(
+                    ("replica", replica.index), status.pop("metrics", None)
+                )
+                with self._lock:
+                    replica.observe(status)
+                    if replica.worker["model"]["state"] == "ready":
+                        replica.state = "ready"
+                        replica.failures = 0
+                continue
+
+            with self._lock:
+                request = replica.pending.get(request_id)
+                if request is not None and kind == "text":
+                    request.streamed = True
+            if request is None:
+                continue
+            future = request.future
+            if kind == "text":
+                if request.streamer is not None:
+                    request.streamer.on_finalized_text(
+                        message[2], stream_end=message[3]
+                    )
+                continue
+
+            with self._lock:
+                replica.pending.pop(request_id, None)
+            if future.done():
+                continue
+            if kind == "result":
+                future.set_result(message[2])
+            elif kind == "cancelled":
+                future.set_exception(CancelledError())
+            else:
+                future.set_exception(RuntimeError(message[2]))
+
+    def _fail(self, replica, request_id, error):
+        with self._lock:
+            request = replica.pending.pop(request_id, None)
+        if request is not None and not request.future.done():
+            request.future.set_exception(error)
+
+    def _monitor(self):
+        """Forward stop requests, and restart workers that died or hang"""
+        while not self._closed:
+            time.sleep(self.HEALTH_INTERVAL)
+            now = time.monotonic()
+            for replica in self.replicas:
+                if self._closed:
+                    return
+                if replica.state == "restarting":
+                    if now >= replica.restart_at:
+                        with self._lock:
+                            if not self._closed:
+                                self._spawn(replica)
+                    continue
+
+                with self._lock:
+                    stopped = [
+                        request_id
+                        for request_id, request in replica.pending.items()
+                        if request.stop_event is not None
+                        and request.stop_event.is_set()
+                    ]
+                for request_id in stopped:
+                    self._send(replica, ("stop", request_id))
+
+                timeout = self.health_timeout
+                if not replica.worker:
+                    timeout = self.STARTUP_TIMEOUT
+                # Seconds since the running batch last decoded a token, as of now
+                stalled = replica.worker.get("stalled_seconds")
+                if stalled is not None:
+                    stalled += now - replica.last_seen
+                code = replica.process.poll()
+                if code is not None:
+                    reason = f"exited with code {code}"
+                elif now - replica.last_seen > timeout:
+                    reason = f"sent no status for {timeout:.0f}s"
+                elif self.stall_timeout and stalled and stalled > self.stall_timeout:
+                    reason = f"decoded no token for {stalled:.0f}s"
+                else:
+                    continue
+                if code is None:
+                    replica.process.kill()
+                    replica.process.wait()
+                self._restart_later(replica, reason)
+
+    def _restart_later(self, replica, reason):
+        with self._lock:
+            replica.conn.close()
+            pending, replica.pending = replica.pending, {}
+            replica.failures += 1
+            replica.restarts += 1
+            delay = min(30, 2 ** (replica.failures - 1))
+            replica.state = "restarting"
+            replica.restart_at = time.monotonic() + delay
+            replica.utilisation = 0.0
+            failed, moved = self._requeue(replica, pending)
+        # Its counters restart from 0 with the new worker
+        metrics.retire_remote(("replica", replica.index))
+        print(
+            f"Model replica {replica.index} {reason}, restarting in {delay}s"
+            + (f", {len(moved)} requests sent to other replicas" if moved else "")
+        )
+        for target, request_id, request in moved:
+            if not self._send(target, request.message):
+                error = RuntimeError("Model replica unavailable")
+                self._fail(target, request_id, error)
+        error = RuntimeError(f"Model replica {replica.index} {reason}")
+        for request in failed:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _requeue(self, replica, pending):
+        """Reassign the outstanding requests of a replica being restarted
+
+        Returns the requests that fail, and the (replica, request id, request) to
+        send to another replica. Requests for which no replica is running stay with
+        this one and are sent to its new worker. Called with the lock held.
+        """
+        failed, moved = [], []
+        for request_id, request in pending.items():
+            if request.future.done():
+                continue
+            stopped = request.stop_event is not None and request.stop_event.is_set()
+            if stopped or request.streamed or request.attempts >= self.MAX_ATTEMPTS:
+                failed.append(request)
+                continue
+            request.attempts += 1
+            target = self._choose()
+            if target is None:
+                replica.pending[request_id] = request
+                continue
+            target.pending[request_id] = request
+            target.requests += 1
+            moved.append((target, request_id, request))
+        return failed, moved
+
+
+class ConnectionStreamer:
+    """Streamer handed to generate() in a worker, forwarding the decoded text
+
+    The tokenizer is only available once the model has loaded, so the text streamer
+    doing the decoding is created on first use.
+    """
+
+    def __init__(self, send, request_id, engine):
+        self.send = send
+        self.request_id = request_id
+        self.engine = engine
+        self._streamer = None
+
+    def _text_streamer(self):
+        if self._streamer is None:
+            from transformers import TextStreamer
+
+            _, processor, _ = self.engine.get()
+            self._streamer = TextStreamer(
+                processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+            self._streamer.on_finalized_text = self.on_finalized_text
+        return self._streamer
+
+    def put(self, value):
+        self._text_streamer().put(value)
+
+    def end(self):
+        self._text_streamer().end()
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.send(("text", self.request_id, text, stream_end))
+
+
+def serve(conn, device, cpus, factory, max_batch_size, max_wait_ms, max_batch_tokens):
+    """Run a replica worker: load the model and generate the requests sent on `conn`"""
+    from scheduler import BatchScheduler
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    module_name, _, function_name = factory.partition(":")
+    engine, run_batch = getattr(importlib.import_module(module_name), function_name)(
+        device
+    )
+
+    busy = {"seconds": 0.0, "started": None, "ready_at": None}
+
+    def timed_run_batch(requests):
+        busy["started"] = time.monotonic()
+        try:
+            return run_batch(requests)
+        finally:
+            busy["seconds"] += time.monotonic() - busy["started"]
+            busy["started"] = None
+
+    def busy_seconds():
+        # Include the running batch, so that long batches show up as they run
+        started = busy["started"]
+        running = time.monotonic() - started if started is not None else 0.0
+        return busy["seconds"] + running
+
+    def stalled_seconds(model):
+        """Seconds since the running batch decoded a token, None when idle or loading
+
+        The first batch waits for the model to load, and prefill counts as a stall
+        until the first token: the clock starts at the latest of the batch start,
+        the model being ready and the last decoding step.
+        """
+        started = busy["started"]
+        if model["state"] != "ready":
+            return None
+        if busy["ready_at"] is None:
+            busy["ready_at"] = time.monotonic()
+        if started is None:
+            return None
+        # Set by generation.StepClock, absent when the factory does not use it
+        generation = sys.modules.get("generation")
+        last_step_at = getattr(generation, "last_step_at", None) or 0.0
+        return time.monotonic() - max(started, busy["ready_at"], last_step_at)
+
+    scheduler = BatchScheduler(
+        timed_run_batch,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        max_batch_tokens=max_batch_tokens,
+    )
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def report_status():
+        while True:
+            stats = scheduler.stats()
+            model = engine.status()
+            send(
+                (
+                    "status",
+                    {
+                        "model": model,
+                        "busy_seconds": busy_seconds(),
+                        "stalled_seconds": stalled_seconds(model),
+                        "queued": stats["queued"],
+                        "batches": stats["batches"],
+                        "metrics": metrics.snapshot(),
+                    },
+                )
+            )
+            time.sleep(1.0)
+
+    engine.start_background()
+    threading.Thread(target=report_status, daemon=True).start()
+
+    requests = {}
+
+    def reply(request_id, done):
+        requests.pop(request_id, None)
+        if done.cancelled():
+            send(("cancelled", request_id))
+        elif done.exception() is not None:
+            error = done.exception()
+            if isinstance(error, CancelledError):
+                send(("cancelled", request_id))
+            else:
+                send(("error", request_id, f"{type(error).__name__}: {error}"))
+        else:
+            send(("result", request_id, done.result()))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            # The server went away
+            return
+        kind, request_id = message[0], message[1]
+        if kind == "submit":
+            _, _, prompt, image, params, stream, client = message
+            stop_event = threading.Event()
+            streamer = ConnectionStreamer(send, request_id, engine) if stream else None
+            future = scheduler.submit(
+                prompt, image, params, streamer, stop_event, client
+            )
+            requests[request_id] = (future, stop_event)
+            future.add_done_callback(
+                lambda done, request_id=request_id: reply(request_id, done)
+            )
+        elif request_id in requests:
+            future, stop_event = requests[request_id]
+            stop_event.set()
+            if kind == "cancel":
+                future.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="olmOCR model replica worker")
+    parser.add_argument("--fd", type=int, required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--cpus", type=parse_cpus)
+    parser.add_argument("--factory", default="generation:make_replica")
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=50)
+    parser.add_argument("--max-batch-tokens", type=int, default=0)
+    args = parser.parse_args()
+    serve(
+        Connection(args.fd),
+        args.device,
+        args.cpus,
+        args.factory,
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.max_batch_tokens,
+    )
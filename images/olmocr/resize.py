@@ -0,0 +1,52 @@
+import math
+
+from PIL import Image
+
+# Qwen2-VL encodes 14x14 pixel patches and merges them 2x2, so every 28x28 pixel
+# block of the image becomes one visual token
+PATCH_SIZE = 28
+
+
+def visual_tokens(width, height):
+    """Return the number of visual tokens of an image, after the processor's rounding"""
+    return max(1, round(width / PATCH_SIZE)) * max(1, round(height / PATCH_SIZE))
+
+
+def fit_to_budget(width, height, budget):
+    """Return the largest size with the aspect ratio of (width, height) within `budget` tokens
+
+    The size is returned unchanged when it already fits or the budget is 0. Otherwise
+    both sides are multiples of PATCH_SIZE, so the processor does not resize again.
+    """
+    if budget <= 0 or visual_tokens(width, height) <= budget:
+        return width, height
+
+    scale = math.sqrt(budget / (width * height / PATCH_SIZE**2))
+    columns = max(1, math.floor(width * scale / PATCH_SIZE))
+    rows = max(1, math.floor(height * scale / PATCH_SIZE))
+    # Very long images can round up to the budget on the short side, trim the long one
+    while columns * rows > budget:
+        if columns >= rows:
+            columns -= 1
+        else:
+            rows -= 1
+    return columns * PATCH_SIZE, rows * PATCH_SIZE
+
+
+def downscale_to_budget(image, budget):
+    """Return `image` downscaled so that it costs at most `budget` visual tokens
+
+    The image is returned as is when it already fits. JPEG files that are not
+    decoded yet are decoded at a reduced scale, which skips most of the decoding
+    work for large photos.
+    """
+    size = fit_to_budget(image.width, image.height, budget)
+    if size == image.size:
+        return image
+
+    image.draft(None, size)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    # Pillow's bilinear filter is antialiased when downscaling and far cheaper than
+    # bicubic. Large factors are first reduced by an integer factor with a box filter
+    return image.resize(size, Image.BILINEAR, reducing_gap=2.0)
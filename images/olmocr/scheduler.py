@@ -0,0 +1,239 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import CancelledError, Future
+
+import metrics
+from admission import estimate_tokens
+
+# Generation settings that must be identical for requests to share a batch
+GenerationParams = namedtuple(
+    "GenerationParams",
+    ["temperature", "max_new_tokens", "num_return_sequences", "do_sample"],
+)
+
+
+class GenerationRequest:
+    """A single prompt/image pair waiting to be generated
+
+    A request with a `streamer` receives its tokens as they are decoded, whatever
+    batch it shares. Setting `stop_event` asks the model to stop generating it.
+    `client` identifies who sent it, for fair scheduling.
+    """
+
+    def __init__(
+        self, prompt, image, params, streamer=None, stop_event=None, client=None
+    ):
+        self.prompt = prompt
+        self.image = image
+        self.params = params
+        self.streamer = streamer
+        self.stop_event = stop_event
+        self.client = client
+        self.tokens = estimate_tokens(prompt, image, params)
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+
+class BatchScheduler:
+    """Collect generation requests arriving within a short window and run them as one batch
+
+    Requests are grouped by their generation params and by image size (rounded up to
+    `size_bucket` pixels) so that a batch only pads prompts and images that are alike.
+    `run_batch` receives a list of requests sharing the same params and must return
+    one result per request, in order.
+
+    A batch holds at most `max_batch_tokens` estimated KV cache tokens (0 for no
+    limit), a larger request runs alone. Clients are served in turn: the request
+    picked next is the one whose client has been served least since it started
+    waiting (start-time fair queueing), so a client sending many requests cannot
+    hold back the others.
+    """
+
+    def __init__(
+        self,
+        run_batch,
+        max_batch_size=4,
+        max_wait_ms=50,
+        size_bucket=256,
+        max_batch_tokens=0,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self.size_bucket = max(1, int(size_bucket))
+        self.max_batch_tokens = max(0, int(max_batch_tokens))
+
+        self._pending = {}
+        # Requests served per client, and the count of the last client served
+        self._served = {}
+        self._clock = 0
+        self._cond = threading.Condition()
+        self._batches = 0
+        self._requests = 0
+        self._worker = threading.Thread(
+            target=self._run, name="olmocr-batch-scheduler", daemon=True
+        )
+        self._worker.start()
+
+    def submit(
+        self, prompt, image, params, streamer=None, stop_event=None, client=None
+    ):
+        """Queue a request and return a Future resolved with its decoded outputs
+
+        Cancelling the Future before the request is scheduled removes it from the queue.
+        """
+        request = GenerationRequest(
+            prompt, image, GenerationParams(*params), streamer, stop_event, client
+        )
+        key = self._batch_key(request)
+        with self._cond:
+            # A client that was idle starts level with the clients being served
+            self._served[client] = max(self._served.get(client, 0), self._clock)
+            self._pending.setdefault(key, []).append(request)
+            self._cond.notify()
+        request.future.add_done_callback(lambda done: self._forget(key, request))
+        return request.future
+
+    def stats(self):
+        """Return cumulative batching statistics"""
+        with self._cond:
+            batches, requests = self._batches, self._requests
+            queued = sum(len(group) for group in self._pending.values())
+        return {
+            "batches": batches,
+            "requests": requests,
+            "queued": queued,
+            "max_batch_size": self.max_batch_size,
+            "mean_batch_fill": (
+                requests / (batches * self.max_batch_size) if batches else 0.0
+            ),
+        }
+
+    def _forget(self, key, request):
+        """Drop a request cancelled while queued, instead of keeping it until its turn"""
+        if not request.future.cancelled():
+            return
+        with self._cond:
+            group = self._pending.get(key)
+            if group is not None and request in group:
+                group.remove(request)
+                if not group:
+                    del self._pending[key]
+
+    def _priority(self, request):
+        return (self._served.get(request.client, 0), request.enqueued_at)
+
+    def _take(self, group):
+        """Remove the next batch from a group, within the batch size and token limits"""
+        group.sort(key=self._priority)
+        count, tokens = 0, 0
+        for request in group[: self.max_batch_size]:
+            over_budget = (
+                self.max_batch_tokens
+                and tokens + request.tokens > self.max_batch_tokens
+            )
+            if count and over_budget:
+                break
+            count += 1
+            tokens += request.tokens
+        batch = group[:count]
+        del group[:count]
+        return batch
+
+    def _batch_key(self, request):
+        width, height = request.image.size
+        return (
+            request.params,
+            math.ceil(width / self.size_bucket),
+            math.ceil(height / self.size_bucket),
+        )
+
+    def _next_batch(self):
+        """Block until a group is full or its oldest request has waited long enough"""
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+
+                # Serve the group holding the request with the highest priority
+                key, group = min(
+                    self._pending.items(),
+                    key=lambda item: min(map(self._priority, item[1])),
+                )
+                oldest = min(request.enqueued_at for request in group)
+                remaining = oldest + self.max_wait - time.monotonic()
+                full = len(group) >= self.max_batch_size or (
+                    self.max_batch_tokens
+                    and sum(request.tokens for request in group)
+                    >= self.max_batch_tokens
+                )
+                if full or remaining <= 0:
+                    batch = self._take(group)
+                    if not group:
+                        del self._pending[key]
+
+                    # Drop requests whose caller gave up while they were queued
+                    runnable = []
+                    for request in batch:
+                        if request.stopped:
+                            request.future.cancel()
+                        if request.future.set_running_or_notify_cancel():
+                            runnable.append(request)
+                    batch = runnable
+                    if not batch:
+                        continue
+                    for request in batch:
+                        served = self._served.get(request.client, 0)
+                        self._clock = max(self._clock, served)
+                        self._served[request.client] = served + 1
+                    self._forget_idle_clients()
+                    self._batches += 1
+                    self._requests += len(batch)
+                    return batch
+
+                self._cond.wait(timeout=remaining)
+
+    def _forget_idle_clients(self):
+        # Clients at or behind the clock restart from it anyway, keep the map small
+        if len(self._served) > 1024:
+            waiting = {
+                request.client
+                for group in self._pending.values()
+                for request in group
+            }
+            self._served = {
+                client: served
+                for client, served in self._served.items()
+                if client in waiting or served > self._clock
+            }
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.monotonic()
+            for request in batch:
+                metrics.observe_stage("queue", started - request.enqueued_at)
+            try:
+                results = self.run_batch(batch)
+                for request, result in zip(batch, results):
+                    if request.stopped:
+                        # Outputs of a stopped request are truncated, do not return them
+                        request.future.set_exception(CancelledError())
+                    else:
+                        request.future.set_result(result)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+
+            print(
+                f"Batch of {len(batch)}/{self.max_batch_size} "
+                f"({100.0 * len(batch) / self.max_batch_size:.0f}% full) "
+                f"generated in {time.monotonic() - started:.2f}s"
+            )
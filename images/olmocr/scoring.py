@@ -0,0 +1,93 @@
+import torch
+from transformers import LogitsProcessor
+
+
+def sampling_warpers(generation_config, temperature):
+    """Return the logits warpers generate() samples with, for a request's temperature
+
+    Like generate(): the temperature, then the model's top-k and top-p.
+    """
+    from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+    # Stand-in configs, such as the benchmark's stub model, may have neither
+    top_k = getattr(generation_config, "top_k", None)
+    top_p = getattr(generation_config, "top_p", None)
+    warpers = []
+    if temperature and temperature != 1.0:
+        warpers.append(TemperatureLogitsWarper(temperature))
+    if top_k:
+        warpers.append(TopKLogitsWarper(top_k))
+    if top_p is not None and top_p < 1.0:
+        warpers.append(TopPLogitsWarper(top_p))
+    return warpers
+
+
+class SequenceScorer(LogitsProcessor):
+    """Accumulates the log-probability of every generated sequence during generate()
+
+    The token chosen at a step is only known at the next call, so each call scores
+    the previous step and `finish()` scores the last one. generate() runs its
+    sampling warpers after the logits processors it is given, so they are applied
+    here too (see `sampling_warpers`): tokens are scored under the distribution
+    they were drawn from. Without warpers, i.e. greedy decoding, that is the
+    distribution after the other logits processors.
+    """
+
+    def __init__(self, warpers=None):
+        self.warpers = warpers or []
+        self._previous = None
+        self._steps = []
+
+    def __call__(self, input_ids, scores):
+        if self._previous is not None:
+            self._steps.append(self._previous.gather(1, input_ids[:, -1:]).squeeze(1))
+        warped = scores
+        for warper in self.warpers:
+            warped = warper(input_ids, warped)
+        self._previous = torch.log_softmax(warped.float(), dim=-1)
+        return scores
+
+    def finish(self, new_tokens, eos_token_id):
+        """Return (log-probability, token count) of each row of `new_tokens`
+
+        Tokens after a row's end-of-sequence token are padding and are not counted.
+        """
+        if self._previous is None:
+            # generate() did not run the logits processors, e.g. a stub model
+            return [(None, None)] * new_tokens.shape[0]
+
+        step = len(self._steps)
+        if step < new_tokens.shape[1]:
+            self._steps.append(
+                self._previous.gather(1, new_tokens[:, step : step + 1]).squeeze(1)
+            )
+        steps = torch.stack(self._steps, dim=1)
+        tokens = new_tokens[:, : steps.shape[1]]
+
+        if eos_token_id is None:
+            after_end = torch.zeros_like(tokens, dtype=torch.bool)
+        else:
+            eos = torch.tensor(eos_token_id, device=tokens.device).flatten()
+            is_eos = torch.isin(tokens, eos).int()
+            after_end = (is_eos.cumsum(dim=1) - is_eos) > 0
+        logprobs = steps.masked_fill(after_end, 0.0).sum(dim=1)
+        counts = (~after_end).sum(dim=1)
+        return [
+            (round(float(logprob), 4), int(count))
+            for logprob, count in zip(logprobs, counts)
+        ]
+
+
+def best_candidate(candidates):
+    """Return the candidate with the highest mean log-probability per token
+
+    Normalising by length keeps the choice from favouring outputs that stop early
+    and leave part of the page out. Candidates without a score rank last.
+    """
+
+    def score(candidate):
+        if candidate.get("logprob") is None or not candidate.get("tokens"):
+            return float("-inf")
+        return candidate["logprob"] / candidate["tokens"]
+
+    return max(candidates, key=score)
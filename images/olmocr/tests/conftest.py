@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app's modules import each other by plain name, as they do in the image's /app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+import pytest
+from PIL import Image
+
+from admission import AdmissionController, AdmissionError, estimate_tokens
+
+
+def rejection(controller, client, tokens):
+    with pytest.raises(AdmissionError) as info:
+        controller.admit(client, tokens)
+    return info.value
+
+
+def test_request_limit_and_release():
+    controller = AdmissionController(max_requests=2)
+    controller.admit("a", 10)
+    controller.admit("b", 10)
+    error = rejection(controller, "c", 10)
+    # Nothing completed yet to estimate from, e.g. while the model loads
+    assert error.retry_after == 10
+    controller.release("a", 10)
+    controller.admit("c", 10)
+    stats = controller.stats()
+    assert stats["requests"] == 2
+    assert stats["admitted"] == 3
+    assert stats["rejected"] == {"queue_full": 1}
+
+
+def test_retry_hint_follows_completions():
+    controller = AdmissionController(max_requests=1)
+    for _ in range(3):
+        controller.admit("a", 10)
+        controller.release("a", 10)
+    controller.admit("a", 10)
+    assert 1 <= rejection(controller, "b", 10).retry_after <= 300
+
+
+def test_per_client_limit():
+    controller = AdmissionController(max_requests=10, max_per_client=2)
+    controller.admit("a", 10)
+    controller.admit("a", 10)
+    assert "client limit" in str(rejection(controller, "a", 10))
+    controller.admit("b", 10)
+    # Requests without a client, such as batch jobs, are only bound by the totals
+    for _ in range(3):
+        controller.admit(None, 10)
+
+
+def test_token_budget():
+    controller = AdmissionController(max_requests=0, max_tokens=100)
+    # A request above the budget still runs when nothing else does
+    controller.admit("a", 150)
+    assert "tokens full" in str(rejection(controller, "b", 10))
+    controller.release("a", 150)
+    controller.admit("b", 60)
+    controller.admit("c", 40)
+    rejection(controller, "d", 1)
+
+
+def test_request_that_can_never_fit():
+    controller = AdmissionController(request_tokens=1000)
+    error = rejection(controller, "a", 1001)
+    assert error.retry_after is None
+    assert controller.stats()["rejected"] == {"too_large": 1}
+
+
+def test_check_reserves_nothing():
+    controller = AdmissionController(max_requests=1)
+    controller.check("a", 10)
+    controller.check("a", 10)
+    controller.admit("a", 10)
+    with pytest.raises(AdmissionError):
+        controller.check("b", 10)
+    assert controller.stats()["requests"] == 1
+
+
+def test_estimate_counts_every_candidate():
+    image = Image.new("RGB", (280, 280))
+    prompt = "x" * 400
+    single = estimate_tokens(prompt, image, (0.0, 50, 1, False))
+    assert single == 100 + 100 + 50
+    assert estimate_tokens(prompt, image, (0.8, 50, 3, True)) == 3 * single
@@ -0,0 +1,153 @@
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from pypdf.errors import PdfReadError
+
+from admission import AdmissionError
+from api import create_api
+from pipeline import parse_page_range
+
+PAGE_COUNT = 3
+
+
+class StubPipeline:
+    """Stands in for app.process_upload_pages, answering each page with its file"""
+
+    def __init__(self):
+        self.calls = []
+        self.error = None
+
+    def __call__(self, path, pages, *params, client=None, heartbeat=None):
+        self.calls.append({"path": path, "params": params, "client": client})
+        if self.error is not None:
+            raise self.error
+        with open(path, "rb") as f:
+            content = f.read().decode()
+        for page_number in parse_page_range(pages, PAGE_COUNT):
+            if page_number == 2:
+                # A pending page, for which the API sends a heartbeat
+                yield None
+            yield page_number, f"{content} page {page_number}", None
+
+
+@pytest.fixture
+def pipeline():
+    return StubPipeline()
+
+
+def make_client(pipeline, check_admission=None, max_upload_bytes=0):
+    api = create_api(
+        pipeline,
+        lambda: {"state": "ready"},
+        check_admission,
+        heartbeat=0.01,
+        allowed_extensions=(".pdf", ".png"),
+        max_upload_bytes=max_upload_bytes,
+    )
+    return TestClient(api)
+
+
+def upload(name="doc.pdf", content=b"doc"):
+    return {"files": (name, content, "application/octet-stream")}
+
+
+def test_pages_are_returned_in_order(pipeline):
+    response = make_client(pipeline).post(
+        "/v1/ocr",
+        files=[
+            ("files", ("a.pdf", b"A", "application/pdf")),
+            ("files", ("b.png", b"B", "image/png")),
+        ],
+        data={"pages": "2-3", "temperature": "0.5", "do_sample": "false"},
+    )
+    assert response.status_code == 200
+    assert response.json()["pages"] == [
+        {"file": "a.pdf", "page": 2, "text": "A page 2"},
+        {"file": "a.pdf", "page": 3, "text": "A page 3"},
+        {"file": "b.png", "page": 2, "text": "B page 2"},
+        {"file": "b.png", "page": 3, "text": "B page 3"},
+    ]
+    assert pipeline.calls[0]["params"] == (0.5, 50, 1, False, False)
+    # Uploads are deleted once processed
+    assert not any(os.path.exists(call["path"]) for call in pipeline.calls)
+
+
+def test_streamed_pages(pipeline):
+    response = make_client(pipeline).post(
+        "/v1/ocr", files=upload(), data={"stream": "true"}
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines() if line]
+    assert [line["page"] for line in lines] == [1, 2, 3]
+
+
+def test_unsupported_file(pipeline):
+    response = make_client(pipeline).post("/v1/ocr", files=upload("notes.txt"))
+    assert response.status_code == 415
+    assert pipeline.calls == []
+
+
+def test_oversized_upload(pipeline):
+    response = make_client(pipeline, max_upload_bytes=4).post(
+        "/v1/ocr", files=upload(content=b"x" * 5)
+    )
+    assert response.status_code == 413
+    assert pipeline.calls == []
+
+
+@pytest.mark.parametrize(
+    "error, status", [(ValueError("Invalid page range"), 400), (PdfReadError(), 422)]
+)
+def test_request_errors(pipeline, error, status):
+    pipeline.error = error
+    response = make_client(pipeline).post("/v1/ocr", files=upload())
+    assert response.status_code == status
+    assert "error" in response.json()
+
+
+def test_busy_server_is_checked_up_front(pipeline):
+    def check_admission(client, max_new_tokens, num_return_sequences):
+        if num_return_sequences > 4:
+            raise AdmissionError("too large")
+        raise AdmissionError("Server busy (queue full), retry in 7s", 7)
+
+    client = make_client(pipeline, check_admission)
+    busy = client.post("/v1/ocr", files=upload())
+    assert busy.status_code == 429
+    assert busy.headers["retry-after"] == "7"
+    too_large = client.post(
+        "/v1/ocr", files=upload(), data={"num_return_sequences": "8"}
+    )
+    assert too_large.status_code == 413
+    assert pipeline.calls == []
+
+
+def test_first_page_turned_away(pipeline):
+    def turned_away(path, *args, **kwargs):
+        yield 1, "Error: busy", AdmissionError("busy", 3)
+
+    response = make_client(turned_away).post("/v1/ocr", files=upload())
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "3"
+
+
+@pytest.mark.parametrize(
+    "headers, prefix",
+    [
+        ({"Authorization": "Bearer secret"}, "key:"),
+        ({"X-API-Key": "secret"}, "key:"),
+        ({"X-Client-Id": "batch-7"}, "client:batch-7"),
+        ({}, "host:"),
+    ],
+)
+def test_clients_are_identified(pipeline, headers, prefix):
+    make_client(pipeline).post("/v1/ocr", files=upload(), headers=headers)
+    client = pipeline.calls[0]["client"]
+    assert client.startswith(prefix)
+    assert "secret" not in client
+
+
+def test_status(pipeline):
+    assert make_client(pipeline).get("/v1/status").json() == {"state": "ready"}
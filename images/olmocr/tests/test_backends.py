@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from backends import OpenAIBackend, QueueStreamer
+
+WORDS = ["alpha ", "beta ", "gamma ", "delta "]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Streams WORDS for every candidate, like an OpenAI-compatible server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.payloads.append(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in WORDS:
+                time.sleep(self.server.token_seconds)
+                for index in range(body["n"]):
+                    choice = {"index": index, "delta": {"content": word}}
+                    if body["logprobs"]:
+                        choice["logprobs"] = {
+                            "content": [{"token": word, "logprob": -0.5 * (index + 1)}]
+                        }
+                    self.send_event({"choices": [choice]})
+            self.send_event(
+                {"choices": [], "usage": {"prompt_tokens": 7, "completion_tokens": 4}}
+            )
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+            self.server.completed += 1
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.aborted += 1
+
+    def send_event(self, data):
+        self.send_chunk(f"data: {json.dumps(data)}\n\n".encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.payloads, server.completed, server.aborted = [], 0, 0
+    server.token_seconds = 0.0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(server):
+    backend = OpenAIBackend(
+        f"http://127.0.0.1:{server.server_address[1]}/v1", "stub", max_concurrency=2
+    )
+    yield backend
+    backend._executor.shutdown(wait=False)
+
+
+IMAGE = Image.new("RGB", (28, 28), "white")
+
+
+def test_single_candidate_streams_text(server, backend):
+    streamer = QueueStreamer(timeout=5)
+    future = backend.submit(
+        "prompt", IMAGE, None, (0.0, 16, 1, False), streamer=streamer
+    )
+    assert "".join(streamer) == "".join(WORDS)
+    assert future.result(timeout=5) == [
+        {"text": "".join(WORDS), "logprob": None, "tokens": None}
+    ]
+    assert server.payloads[0]["stream"] is True
+
+
+def test_several_candidates_are_scored(server, backend):
+    future = backend.submit("prompt", IMAGE, None, (0.8, 16, 2, True))
+    candidates = future.result(timeout=5)
+    assert [candidate["text"] for candidate in candidates] == ["".join(WORDS)] * 2
+    assert [candidate["logprob"] for candidate in candidates] == [-2.0, -4.0]
+    assert [candidate["tokens"] for candidate in candidates] == [4, 4]
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_stop_aborts_the_request(server, backend, streaming):
+    server.token_seconds = 0.2
+    stop_event = threading.Event()
+    future = backend.submit(
+        "prompt",
+        IMAGE,
+        None,
+        (0.0, 16, 1, False),
+        streamer=QueueStreamer(timeout=5) if streaming else None,
+        stop_event=stop_event,
+    )
+    time.sleep(0.3)
+    stop_event.set()
+    with pytest.raises(CancelledError):
+        future.result(timeout=5)
+    # The server notices the closed connection on its next write
+    deadline = time.monotonic() + 5
+    while not server.aborted and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert server.aborted == 1
+    assert server.completed == 0
+
+
+def test_concurrency_is_the_connection_pool(backend):
+    # The UI runs as many handlers as the server is sent requests at once
+    assert backend.concurrency == 2
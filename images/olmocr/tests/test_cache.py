@@ -0,0 +1,102 @@
+import os
+
+from cache import TEMP_SUFFIX, DiskStore, LRUCache, PageCache, ResultCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", "A", 10)
+    cache.put("b", "B", 10)
+    cache.put("c", "C", 10)
+    assert cache.get("a") == "A"
+    cache.put("d", "D", 10)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.current_bytes == 30
+    assert cache.evictions == 1
+
+
+def test_lru_cache_replaces_and_skips_oversized_entries():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", "A", 10)
+    cache.put("a", "AA", 20)
+    assert cache.get("a") == "AA"
+    assert cache.current_bytes == 20
+    cache.put("huge", "H", 31)
+    assert cache.get("huge") is None
+    assert len(cache) == 1
+
+
+def keys(count):
+    return [f"{index:02x}" * 32 for index in range(count)]
+
+
+def test_disk_store_evicts_oldest_files(tmp_path):
+    store = DiskStore(str(tmp_path), max_bytes=100)
+    first, second, third = keys(3)
+    store.put(first, b"x" * 40)
+    store.put(second, b"y" * 40)
+    # Reading refreshes the modification time, make the first entry the newest
+    os.utime(store._path(first), (1_000, 1_000))
+    os.utime(store._path(second), (100, 100))
+    assert store.get(first) == b"x" * 40
+
+    store.put(third, b"z" * 40)
+    assert store.get(second) is None
+    assert store.get(first) == b"x" * 40
+    assert store.get(third) == b"z" * 40
+    assert store.current_bytes == 80
+    assert store.evictions == 1
+
+
+def test_disk_store_counts_existing_files(tmp_path):
+    store = DiskStore(str(tmp_path), max_bytes=100)
+    (key,) = keys(1)
+    store.put(key, b"x" * 40)
+    store.append(key, b"y" * 10)
+    assert store.get(key) == b"x" * 40 + b"y" * 10
+    assert DiskStore(str(tmp_path), max_bytes=100).current_bytes == 50
+    store.put(key, b"z" * 101)
+    assert store.get(key) == b"x" * 40 + b"y" * 10
+
+
+def test_disk_store_leaves_files_being_written(tmp_path):
+    store = DiskStore(str(tmp_path), max_bytes=100)
+    first, second = keys(2)
+    # A concurrent put() that has not moved its file into place yet
+    os.makedirs(os.path.dirname(store._path(first)))
+    partial = tmp_path / first[:2] / f"partial{TEMP_SUFFIX}"
+    partial.write_bytes(b"p" * 60)
+    assert DiskStore(str(tmp_path), max_bytes=100).current_bytes == 0
+
+    store.put(first, b"x" * 60)
+    store.put(second, b"y" * 60)
+    assert partial.exists()
+    assert store.get(second) == b"y" * 60
+    assert store.current_bytes == 60
+
+
+def test_page_cache_budget_counts_pages():
+    cache = PageCache(max_pages=2)
+    for page_number in (1, 2, 3):
+        cache.put("digest", page_number, 1024, b"P6" * 100, "anchor")
+    assert cache.get("digest", 1, 1024) is None
+    assert cache.get("digest", 3, 1024) == (b"P6" * 100, "anchor")
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] == 2 * (200 + len("anchor"))
+    assert stats["evictions"] == 1
+
+
+def test_result_key_covers_the_model():
+    page = (b"page", "anchor", "prompt", (0.0, 16, 1, False))
+    transformers = ("transformers", "allenai/olmOCR-7B-0225-preview", "main")
+    assert ResultCache.make_key(*page, transformers) == ResultCache.make_key(
+        *page, transformers
+    )
+    assert ResultCache.make_key(*page, transformers) != ResultCache.make_key(
+        *page, ("transformers", "allenai/olmOCR-7B-0225-preview", "v2")
+    )
+    assert ResultCache.make_key(*page, transformers) != ResultCache.make_key(
+        *page, ("openai", "http://localhost:30000/v1", transformers[1])
+    )
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from compiled import Bucket, CompiledGeneration, parse_sizes
+from scheduler import GenerationParams, GenerationRequest
+
+
+def make_compiled():
+    model = SimpleNamespace(
+        forward=lambda **inputs: None,
+        device=torch.device("cpu"),
+        generation_config=SimpleNamespace(),
+    )
+    return CompiledGeneration(model, [1, 4], parse_sizes("812x1036"), [1536], [2048])
+
+
+def requests(size, count=1, candidates=1):
+    params = GenerationParams(0.0, 1024, candidates, False)
+    return [
+        GenerationRequest("prompt", Image.new("RGB", size), params)
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize("size", [(791, 1024), (724, 1024)])
+def test_letter_and_a4_pages_fit_the_default_bucket(size):
+    compiled = make_compiled()
+    bucket = compiled.plan(requests(size, count=3))
+    assert bucket == Bucket(4, (812, 1036), None, 2048)
+
+
+def test_batches_fitting_no_bucket_run_eagerly():
+    compiled = make_compiled()
+    assert compiled.plan(requests((1024, 791))) is None
+    assert compiled.plan(requests((791, 1024), count=5)) is None
+    assert compiled.plan(requests((791, 1024), candidates=2)) is None
+    assert compiled.stats()["eager_batches"] == {
+        "image_size": 1,
+        "batch_size": 1,
+        "candidates": 1,
+    }
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from downloader import DownloadError, Downloader
+
+DOCUMENTS = {"/a.pdf": b"%PDF-a" * 100, "/b.pdf": b"%PDF-b" * 100}
+
+
+class DocumentHandler(BaseHTTPRequestHandler):
+    """Serves DOCUMENTS with an ETag, and /big.pdf without a Content-Length"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        time.sleep(self.server.delay)
+        if self.path == "/big.pdf":
+            # HTTP/1.0 without a length, the body ends with the connection
+            self.send_response(200)
+            self.end_headers()
+            for _ in range(64):
+                self.wfile.write(b"x" * 1024)
+            return
+        body = DOCUMENTS.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = f'"{self.path}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DocumentHandler)
+    server.requests, server.delay = [], 0.0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    downloader = Downloader(str(tmp_path), max_bytes=16 * 1024, max_entries=1)
+    yield downloader
+    downloader.close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_then_revalidate(server, downloader):
+    with downloader.lease(server.url + "/a.pdf") as path:
+        assert read(path) == DOCUMENTS["/a.pdf"]
+    # The second fetch only asks whether the document changed
+    with downloader.lease(server.url + "/a.pdf") as again:
+        assert again == path
+    assert downloader.stats()["downloads"] == 1
+    assert downloader.stats()["revalidated"] == 1
+    assert len(server.requests) == 2
+
+
+def test_concurrent_fetches_share_one_download(server, downloader):
+    server.delay = 0.3
+    with ThreadPoolExecutor(4) as executor:
+        paths = list(executor.map(downloader.fetch, [server.url + "/a.pdf"] * 4))
+    assert len(set(paths)) == 1
+    assert server.requests == ["/a.pdf"]
+    assert downloader.stats()["shared"] == 3
+    for path in paths:
+        downloader.release(path)
+    assert downloader.stats()["leased_files"] == 0
+
+
+def test_evicted_file_is_kept_while_leased(server, downloader):
+    first = downloader.fetch(server.url + "/a.pdf")
+    # max_entries=1: fetching another document evicts the first one
+    with downloader.lease(server.url + "/b.pdf"):
+        assert os.path.exists(first)
+    downloader.release(first)
+    assert not os.path.exists(first)
+
+
+def test_oversized_documents_are_refused(server, downloader):
+    with pytest.raises(DownloadError, match="limit"):
+        downloader.fetch(server.url + "/big.pdf")
+    # The partial file of the stream that went over the limit is removed
+    assert os.listdir(downloader.directory) == []
+
+
+def test_failed_download(server, downloader):
+    with pytest.raises(DownloadError, match="HTTP 404"):
+        downloader.fetch(server.url + "/missing.pdf")
+    with pytest.raises(DownloadError):
+        downloader.fetch("http://127.0.0.1:1/a.pdf")
+
+
+def test_close_only_removes_its_own_files(tmp_path):
+    (tmp_path / "notes.txt").write_text("keep me")
+    Downloader(str(tmp_path)).close()
+    assert os.listdir(tmp_path) == ["notes.txt"]
@@ -0,0 +1,63 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import metrics
+from metrics import Counter, Histogram
+
+pytestmark = pytest.mark.skipif(not metrics.ENABLED, reason="OLMOCR_METRICS=0")
+
+
+def samples(metric):
+    return {name + labels: value for name, labels, value in metric.samples()}
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "Test", ("stage",), buckets=(0.1, 1))
+    for seconds in (0.05, 0.5, 0.5, 5):
+        histogram.observe(seconds, labels=("render",))
+    values = samples(histogram)
+    assert values['test_seconds_bucket{stage="render",le="0.1"}'] == 1
+    assert values['test_seconds_bucket{stage="render",le="1"}'] == 3
+    assert values['test_seconds_bucket{stage="render",le="+Inf"}'] == 4
+    assert values['test_seconds_count{stage="render"}'] == 4
+    assert values['test_seconds_sum{stage="render"}'] == pytest.approx(6.05)
+
+
+def test_merged_states_add_up():
+    local, remote = Counter("test_total", "Test"), Counter("test_total", "Test")
+    local.inc(2)
+    remote.inc(3)
+    local.merge(remote.state())
+    assert samples(local) == {"test_total": 5}
+
+
+def generated_tokens():
+    return samples(metrics.GENERATED_TOKENS).get("olmocr_generated_tokens_total", 0)
+
+
+def test_replica_snapshots_are_included_and_kept():
+    before = generated_tokens()
+    replica = Counter(metrics.GENERATED_TOKENS.name, "Replica")
+    replica.inc(5)
+    metrics.update_remote("replica-0", {replica.name: replica.state()})
+    replica.inc(5)
+    # A newer snapshot replaces the previous one of the same process
+    metrics.update_remote("replica-0", {replica.name: replica.state()})
+    assert generated_tokens() == before + 10
+
+    # The counts of a restarted replica are kept, its successor starts from 0
+    metrics.retire_remote("replica-0")
+    metrics.update_remote("replica-0", {replica.name: Counter("x", "x").state()})
+    assert generated_tokens() == before + 10
+    metrics.retire_remote("replica-0")
+
+
+def test_endpoint_serves_the_registry():
+    client = TestClient(metrics.add_route(FastAPI()))
+    metrics.observe_stage("render", 0.2)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == metrics.CONTENT_TYPE
+    assert "# TYPE olmocr_stage_seconds histogram" in response.text
+    assert 'olmocr_stage_seconds_count{stage="render"}' in response.text
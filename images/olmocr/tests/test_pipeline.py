@@ -0,0 +1,143 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from pipeline import chain_futures, combine_futures, iter_pipelined, parse_page_range
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def test_parse_page_range():
+    assert parse_page_range("all", 3) == [1, 2, 3]
+    assert parse_page_range("", 2) == [1, 2]
+    assert parse_page_range("1-3, 7", 8) == [1, 2, 3, 7]
+    assert parse_page_range("-2", 5) == [1, 2]
+    assert parse_page_range("4-", 5) == [4, 5]
+    # The order given is kept, duplicates are dropped
+    assert parse_page_range("5, 2-3, 3", 5) == [5, 2, 3]
+
+
+@pytest.mark.parametrize("spec", ["0", "6", "3-2", "2-9", "x"])
+def test_parse_page_range_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_page_range(spec, 5)
+
+
+def test_combine_futures():
+    first, second = Future(), Future()
+    combined = combine_futures([first, second], lambda a, b: a + b)
+    second.set_result(2)
+    assert not combined.done()
+    first.set_result(1)
+    assert combined.result(timeout=1) == 3
+
+
+def test_combine_futures_fails_with_a_stage():
+    first, second = Future(), Future()
+    combined = combine_futures([first, second], lambda a, b: a + b)
+    first.set_exception(ValueError("broken page"))
+    second.set_result(2)
+    with pytest.raises(ValueError):
+        combined.result(timeout=1)
+
+
+def test_cancelling_combined_future_cancels_stages():
+    first, second = Future(), Future()
+    combined = combine_futures([first, second], lambda a, b: a + b)
+    assert combined.cancel()
+    assert first.cancelled() and second.cancelled()
+
+
+def test_chain_futures():
+    first = Future()
+    chained = chain_futures(first, lambda done: resolved(done.result() * 2))
+    first.set_result(21)
+    assert chained.result(timeout=1) == 42
+
+
+def test_chain_futures_passes_failures_to_the_next_stage():
+    first = Future()
+    chained = chain_futures(
+        first, lambda done: resolved(f"fallback after {done.exception()}")
+    )
+    first.set_exception(ValueError("no text layer"))
+    assert chained.result(timeout=1) == "fallback after no text layer"
+
+
+def test_cancelling_chained_future_cancels_pending_stage():
+    first, second = Future(), Future()
+    chained = chain_futures(first, lambda done: second)
+    first.set_result(None)
+    assert chained.cancel()
+    assert second.cancelled()
+
+
+def prepared_after(seconds, page_number):
+    time.sleep(seconds)
+    return page_number
+
+
+def test_iter_pipelined_yields_pages_in_order():
+    # Earlier pages take longer to prepare and to generate
+    delays = {1: 0.06, 2: 0.0, 3: 0.03, 4: 0.0}
+    with ThreadPoolExecutor(4) as executor:
+        results = list(
+            iter_pipelined(
+                list(delays),
+                lambda page: executor.submit(prepared_after, delays[page], page),
+                lambda page: executor.submit(prepared_after, delays[page], page * 10),
+                lookahead=2,
+            )
+        )
+    assert results == [(1, 10, None), (2, 20, None), (3, 30, None), (4, 40, None)]
+
+
+def test_iter_pipelined_reports_failed_pages():
+    def generate(page_number):
+        if page_number == 2:
+            raise ValueError("unreadable page")
+        return resolved(page_number)
+
+    results = list(iter_pipelined([1, 2, 3], resolved, generate))
+    assert [(page, result) for page, result, _ in results] == [
+        (1, 1),
+        (2, None),
+        (3, 3),
+    ]
+    assert isinstance(results[1][2], ValueError)
+
+
+def test_iter_pipelined_bounds_and_cancels_pending_pages():
+    prepared = []
+    futures = []
+
+    def prepare(page_number):
+        prepared.append(page_number)
+        return resolved(page_number)
+
+    def generate(page_number):
+        futures.append(Future())
+        if page_number == 1:
+            futures[-1].set_result(page_number)
+        return futures[-1]
+
+    results = iter_pipelined(range(1, 101), prepare, generate, lookahead=2)
+    assert next(results) == (1, 1, None)
+    # Two pages in the model and two being prepared, not the whole document
+    assert len(prepared) <= 5
+    results.close()
+    assert all(future.cancelled() for future in futures[1:])
+
+
+def test_iter_pipelined_heartbeat():
+    future = Future()
+    threading.Timer(0.2, future.set_result, ["text"]).start()
+    items = list(iter_pipelined([1], resolved, lambda _: future, heartbeat=0.05))
+    assert items[0] is None
+    assert items[-1] == (1, "text", None)
@@ -0,0 +1,87 @@
+import pytest
+import torch
+
+from prefix_cache import generate_from_prefix, transformers_supported
+
+pytestmark = pytest.mark.skipif(
+    not transformers_supported(), reason="follows the internals of transformers 4.4x"
+)
+
+IMAGE_TOKEN, VISION_START, VISION_END, VIDEO_TOKEN = 250, 251, 252, 253
+# A 56x56 image: 4x4 patches of 14 pixels, merged 2x2 into 4 visual tokens
+IMAGE_GRID = [1, 4, 4]
+
+
+@pytest.fixture(scope="module")
+def model():
+    from transformers import Qwen2VLConfig, Qwen2VLForConditionalGeneration
+
+    torch.manual_seed(0)
+    config = Qwen2VLConfig(
+        vocab_size=300,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},
+        vision_config={
+            "depth": 1,
+            "embed_dim": 32,
+            "hidden_size": 64,
+            "num_heads": 2,
+            "patch_size": 14,
+            "spatial_merge_size": 2,
+            "temporal_patch_size": 2,
+        },
+        image_token_id=IMAGE_TOKEN,
+        vision_start_token_id=VISION_START,
+        vision_end_token_id=VISION_END,
+        video_token_id=VIDEO_TOKEN,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    return Qwen2VLForConditionalGeneration(config).eval()
+
+
+def make_inputs(text_lengths):
+    """A left padded batch of prompts, each with an image and `length` text tokens"""
+    image = [VISION_START] + [IMAGE_TOKEN] * 4 + [VISION_END]
+    rows = [[3, 4] + image + list(range(10, 10 + length)) for length in text_lengths]
+    longest = max(len(row) for row in rows)
+    return {
+        "input_ids": torch.tensor([[0] * (longest - len(r)) + r for r in rows]),
+        "attention_mask": torch.tensor(
+            [[0] * (longest - len(r)) + [1] * len(r) for r in rows]
+        ),
+        "pixel_values": torch.randn(16 * len(rows), 3 * 2 * 14 * 14),
+        "image_grid_thw": torch.tensor([IMAGE_GRID] * len(rows)),
+    }
+
+
+def test_shared_prefill_matches_a_prefill_per_candidate(model):
+    inputs = make_inputs([6, 9])
+    kwargs = dict(max_new_tokens=8, do_sample=False, pad_token_id=0)
+    with torch.no_grad():
+        expected = model.generate(**inputs, **kwargs).repeat_interleave(3, dim=0)
+        output = generate_from_prefix(model, inputs, None, 0, 3, **kwargs)
+    assert torch.equal(output, expected)
+
+
+def test_shared_prefill_samples_distinct_candidates(model):
+    inputs = make_inputs([6])
+    torch.manual_seed(1)
+    with torch.no_grad():
+        output = generate_from_prefix(
+            model,
+            inputs,
+            None,
+            0,
+            3,
+            max_new_tokens=8,
+            do_sample=True,
+            temperature=1.5,
+            pad_token_id=0,
+        )
+    candidates = {tuple(row[-8:].tolist()) for row in output}
+    assert len(candidates) == 3
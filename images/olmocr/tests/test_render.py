@@ -0,0 +1,72 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+import render
+from render import RangeRenderer, contiguous_chunks
+
+
+def test_contiguous_chunks():
+    assert contiguous_chunks([1, 2, 3, 5, 6, 9], 2) == [[1, 2], [3], [5, 6], [9]]
+    assert contiguous_chunks([3, 2, 1], 8) == [[3], [2], [1]]
+
+
+class CancelledLate(Future):
+    """A page Future cancelled right before the renderer hands it its result"""
+
+    def set_result(self, result):
+        self.cancel()
+        super().set_result(result)
+
+
+def fake_render_pages(fail_after=None, runs=None):
+    """Stand in for pdftoppm, recording the (first, last) page of each run"""
+
+    def render_pages(pdf_path, first_page, last_page, target_longest_image_dim):
+        if runs is not None:
+            runs.append((first_page, last_page))
+        for page in range(first_page, last_page + 1):
+            if page == fail_after:
+                raise RuntimeError("pdftoppm failed")
+            yield page, f"page {page}".encode()
+
+    return render_pages
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(2) as executor:
+        yield executor
+
+
+def test_page_cancelled_while_rendering(monkeypatch, executor):
+    renderer = RangeRenderer("doc.pdf", [1, 2, 3], executor)
+    renderer._futures[2] = CancelledLate()
+    monkeypatch.setattr(render, "render_pages", fake_render_pages())
+    first = renderer.submit(1)
+    assert first.result(timeout=5) == b"page 1"
+    assert renderer.submit(2).cancelled()
+    # The rest of the chunk is not failed by the cancelled page
+    assert renderer.submit(3).result(timeout=5) == b"page 3"
+
+
+def test_failed_chunk_fails_its_remaining_pages(monkeypatch, executor):
+    renderer = RangeRenderer("doc.pdf", [1, 2, 3], executor)
+    monkeypatch.setattr(render, "render_pages", fake_render_pages(fail_after=2))
+    assert renderer.submit(1).result(timeout=5) == b"page 1"
+    with pytest.raises(RuntimeError):
+        renderer.submit(3).result(timeout=5)
+
+
+def test_pages_not_needed_are_left_out_of_the_chunk(monkeypatch, executor):
+    runs = []
+    renderer = RangeRenderer(
+        "doc.pdf", range(1, 6), executor, needs_render=lambda page: page not in (2, 3)
+    )
+    monkeypatch.setattr(render, "render_pages", fake_render_pages(runs=runs))
+    assert renderer.submit(1).result(timeout=5) == b"page 1"
+    assert renderer.submit(5).result(timeout=5) == b"page 5"
+    assert runs == [(1, 1), (4, 5)]
+    # A page left out is still rendered when it is asked for
+    assert renderer.submit(3).result(timeout=5) == b"page 3"
+    assert runs[2:] == [(3, 3)]
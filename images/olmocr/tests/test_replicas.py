@@ -0,0 +1,114 @@
+import os
+import signal
+import time
+
+import pytest
+from PIL import Image
+
+from replicas import ReplicaPool, parse_cpus, replica_specs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = os.path.join(os.path.dirname(HERE), "benchmarks")
+
+PARAMS = (0.0, 8, 1, False)
+IMAGE = Image.new("RGB", (56, 56), "white")
+
+
+def test_parse_cpus():
+    assert parse_cpus("0-3,8") == [0, 1, 2, 3, 8]
+    assert parse_cpus(" 5 ,") == [5]
+
+
+def test_replica_specs_cycle_devices_and_cpu_sets():
+    specs = replica_specs(3, ["cuda:0", "cpu"], [[0, 1], [2, 3]])
+    assert specs == [("cuda:0", None), ("cpu", [0, 1]), ("cuda:0", None)]
+
+
+def wait_for(condition, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def start_pool(monkeypatch):
+    """Start pools of stub model workers (see bench_pipeline.stub_replica)"""
+    # The workers import the factory from the benchmarks
+    path = [BENCHMARKS, os.environ.get("PYTHONPATH")]
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, path)))
+    monkeypatch.setenv("OLMOCR_BENCH_STUB_TOKENS", "4")
+    monkeypatch.setenv("OLMOCR_BENCH_STUB_PREFILL_MS", "500")
+    monkeypatch.setenv("OLMOCR_BENCH_STUB_TOKEN_MS", "0")
+    monkeypatch.setattr(ReplicaPool, "HEALTH_INTERVAL", 0.05)
+    pools = []
+
+    def start(replicas):
+        pool = ReplicaPool(
+            [("cpu", None)] * replicas,
+            factory="bench_pipeline:stub_replica",
+            max_batch_size=1,
+            max_wait_ms=0,
+        )
+        pools.append(pool)
+        pool.start()
+        wait_for(lambda: all(r["state"] == "ready" for r in pool.status()))
+        return pool
+
+    yield start
+    for pool in pools:
+        pool.close()
+
+
+def submit(pool, count):
+    return [pool.submit(f"page {index}", IMAGE, PARAMS) for index in range(count)]
+
+
+def test_requests_are_split_across_replicas(start_pool):
+    pool = start_pool(2)
+    futures = submit(pool, 4)
+    results = [future.result(timeout=30) for future in futures]
+    assert all(result == results[0] for result in results)
+    # Each request goes to the replica with the fewest outstanding requests
+    assert [r["requests"] for r in pool.status()] == [2, 2]
+    assert all(r["outstanding"] == 0 for r in pool.status())
+
+
+def kill_busy_replica(pool):
+    wait_for(lambda: any(r["outstanding"] for r in pool.status()))
+    busy = next(r for r in pool.status() if r["outstanding"])
+    os.kill(busy["pid"], signal.SIGKILL)
+    return busy
+
+
+def test_crashed_replica_requests_go_to_another_replica(start_pool):
+    pool = start_pool(2)
+    (future,) = submit(pool, 1)
+    crashed = kill_busy_replica(pool)
+    assert future.result(timeout=30)
+    status = pool.status()
+    assert status[crashed["replica"]]["restarts"] == 1
+    assert status[1 - crashed["replica"]]["requests"] == 1
+    # The crashed worker is replaced
+    wait_for(lambda: pool.status()[crashed["replica"]]["state"] == "ready")
+    assert pool.status()[crashed["replica"]]["pid"] != crashed["pid"]
+
+
+def test_requests_wait_for_the_restart_of_the_only_replica(start_pool):
+    pool = start_pool(1)
+    (future,) = submit(pool, 1)
+    crashed = kill_busy_replica(pool)
+    assert future.result(timeout=30)
+    (status,) = pool.status()
+    assert status["restarts"] == 1
+    assert status["pid"] != crashed["pid"]
+
+
+def test_request_crashing_every_worker_fails(start_pool):
+    pool = start_pool(1)
+    (future,) = submit(pool, 1)
+    for _ in range(ReplicaPool.MAX_ATTEMPTS):
+        crashed = kill_busy_replica(pool)
+        wait_for(lambda: pool.status()[0]["pid"] != crashed["pid"])
+    with pytest.raises(RuntimeError, match="exited"):
+        future.result(timeout=30)
@@ -0,0 +1,54 @@
+import math
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from resize import PATCH_SIZE, downscale_to_budget, fit_to_budget, visual_tokens
+
+
+def test_visual_tokens_round_like_the_processor():
+    assert visual_tokens(28, 28) == 1
+    assert visual_tokens(1024, 1024) == 37 * 37
+    assert visual_tokens(10, 10) == 1
+
+
+@pytest.mark.parametrize(
+    "size", [(6000, 4000), (4000, 6000), (1700, 2200), (20000, 300), (300, 20000)]
+)
+def test_fit_to_budget(size):
+    width, height = fit_to_budget(*size, budget=1369)
+    assert width % PATCH_SIZE == 0 and height % PATCH_SIZE == 0
+    assert visual_tokens(width, height) <= 1369
+    # Close to the budget, and the aspect ratio is kept up to the patch rounding
+    assert visual_tokens(width, height) > 1369 * 0.85
+    scale = math.sqrt(1369 * PATCH_SIZE**2 / (size[0] * size[1]))
+    assert abs(width - size[0] * scale) <= 2 * PATCH_SIZE
+    assert abs(height - size[1] * scale) <= 2 * PATCH_SIZE
+
+
+def test_fitting_or_unbounded_sizes_are_unchanged():
+    assert fit_to_budget(1000, 700, budget=1369) == (1000, 700)
+    assert fit_to_budget(6000, 4000, budget=0) == (6000, 4000)
+
+
+def encoded(image, format):
+    buffer = BytesIO()
+    image.save(buffer, format=format)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+def test_jpeg_is_downscaled_to_the_budget():
+    photo = encoded(Image.new("RGB", (3000, 2000), "gray"), "JPEG")
+    small = downscale_to_budget(photo, 1369)
+    assert small.size == fit_to_budget(3000, 2000, 1369)
+    assert small.mode == "RGB"
+
+
+def test_downscaled_images_are_rgb():
+    scan = encoded(Image.new("RGBA", (2000, 2000)), "PNG")
+    assert downscale_to_budget(scan, 1369).mode == "RGB"
+    page = encoded(Image.new("RGBA", (500, 500)), "PNG")
+    # Images within the budget are returned untouched
+    assert downscale_to_budget(page, 1369) is page
@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+from PIL import Image
+
+from scheduler import BatchScheduler
+
+PARAMS = (0.0, 16, 1, False)
+IMAGE = Image.new("RGB", (28, 28), "white")
+
+
+class BlockingRunner:
+    """run_batch that records the batches it runs and holds the first one"""
+
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append([request.prompt for request in batch])
+        self.started.set()
+        self.release.wait(timeout=5)
+        return [request.prompt.upper() for request in batch]
+
+
+@pytest.fixture
+def runner():
+    runner = BlockingRunner()
+    yield runner
+    runner.release.set()
+
+
+def submit_while_busy(runner, scheduler, requests):
+    """Hold the scheduler on a first batch while `requests` are queued behind it"""
+    first = scheduler.submit("a1", IMAGE, PARAMS, client="a")
+    assert runner.started.wait(timeout=5)
+    futures = [
+        scheduler.submit(prompt, IMAGE, PARAMS, client=client, stop_event=stop)
+        for prompt, client, stop in requests
+    ]
+    return first, futures
+
+
+def test_clients_are_served_in_turn(runner):
+    scheduler = BatchScheduler(runner, max_batch_size=1, max_wait_ms=0)
+    first, futures = submit_while_busy(
+        runner,
+        scheduler,
+        [("a2", "a", None), ("a3", "a", None), ("b1", "b", None)],
+    )
+    runner.release.set()
+    assert first.result(timeout=5) == "A1"
+    assert [future.result(timeout=5) for future in futures] == ["A2", "A3", "B1"]
+    # b has not been served yet when a1 finishes, so it goes before a's backlog
+    assert runner.batches == [["a1"], ["b1"], ["a2"], ["a3"]]
+
+
+def test_batches_group_requests(runner):
+    scheduler = BatchScheduler(runner, max_batch_size=2, max_wait_ms=0)
+    first, futures = submit_while_busy(
+        runner, scheduler, [("a2", "a", None), ("b1", "b", None), ("c1", "c", None)]
+    )
+    runner.release.set()
+    for future in [first] + futures:
+        future.result(timeout=5)
+    assert runner.batches == [["a1"], ["b1", "c1"], ["a2"]]
+    assert scheduler.stats()["requests"] == 4
+
+
+def test_cancelled_request_leaves_the_queue(runner):
+    scheduler = BatchScheduler(runner, max_batch_size=1, max_wait_ms=0)
+    first, (cancelled, kept) = submit_while_busy(
+        runner, scheduler, [("a2", "a", None), ("a3", "a", None)]
+    )
+    assert scheduler.stats()["queued"] == 2
+    assert cancelled.cancel()
+    assert scheduler.stats()["queued"] == 1
+    runner.release.set()
+    assert kept.result(timeout=5) == "A3"
+    assert ["a2"] not in runner.batches
+
+
+def test_stopped_request_is_not_run(runner):
+    scheduler = BatchScheduler(runner, max_batch_size=1, max_wait_ms=0)
+    stop = threading.Event()
+    first, (stopped, kept) = submit_while_busy(
+        runner, scheduler, [("a2", "a", stop), ("a3", "a", None)]
+    )
+    stop.set()
+    runner.release.set()
+    assert kept.result(timeout=5) == "A3"
+    assert stopped.cancelled()
+    assert ["a2"] not in runner.batches
+
+
+def test_request_stopped_while_running_is_cancelled(runner):
+    scheduler = BatchScheduler(runner, max_batch_size=1, max_wait_ms=0)
+    stop = threading.Event()
+    future = scheduler.submit("a1", IMAGE, PARAMS, client="a", stop_event=stop)
+    assert runner.started.wait(timeout=5)
+    stop.set()
+    runner.release.set()
+    with pytest.raises(CancelledError):
+        future.result(timeout=5)
@@ -0,0 +1,52 @@
+import math
+
+import torch
+
+from scoring import SequenceScorer, best_candidate
+
+EOS = 0
+VOCAB = 4
+
+
+def scored(new_tokens, eos_token_id=EOS):
+    """Run SequenceScorer as generate() does, over uniform logits"""
+    scorer = SequenceScorer()
+    prompt = torch.ones(new_tokens.shape[0], 3, dtype=torch.long)
+    for step in range(new_tokens.shape[1]):
+        input_ids = torch.cat([prompt, new_tokens[:, :step]], dim=1)
+        scorer(input_ids, torch.zeros(new_tokens.shape[0], VOCAB))
+    return scorer.finish(new_tokens, eos_token_id)
+
+
+def test_tokens_after_eos_are_not_counted():
+    new_tokens = torch.tensor([[2, EOS, 3, 3], [1, 2, 3, 1]])
+    step = round(-math.log(VOCAB), 4)
+    (first_logprob, first_count), (second_logprob, second_count) = scored(new_tokens)
+    # The end-of-sequence token counts, the padding after it does not
+    assert first_count == 2
+    assert math.isclose(first_logprob, 2 * step, abs_tol=1e-3)
+    assert second_count == 4
+    assert math.isclose(second_logprob, 4 * step, abs_tol=1e-3)
+
+
+def test_several_eos_tokens():
+    new_tokens = torch.tensor([[2, 3, 1], [3, 2, 1]])
+    counts = [count for _, count in scored(new_tokens, eos_token_id=[3])]
+    assert counts == [2, 1]
+
+
+def test_without_eos_every_token_counts():
+    new_tokens = torch.tensor([[EOS, EOS]])
+    assert scored(new_tokens, eos_token_id=None)[0][1] == 2
+
+
+def test_unscored_generation():
+    assert SequenceScorer().finish(torch.tensor([[1], [2]]), EOS) == [(None, None)] * 2
+
+
+def test_best_candidate_normalises_by_length():
+    short = {"text": "a", "logprob": -1.0, "tokens": 1}
+    long = {"text": "a b c", "logprob": -1.5, "tokens": 3}
+    unscored = {"text": "?", "logprob": None, "tokens": None}
+    assert best_candidate([short, long, unscored]) is long
+    assert best_candidate([unscored]) is unscored
@@ -0,0 +1,62 @@
+import json
+from types import SimpleNamespace
+
+from textlayer import glyph_sanity, page_response, score_text_layer
+
+# US Letter, 8.5 x 11 inches in points
+LETTER = SimpleNamespace(x0=0, y0=0, x1=612, y1=792)
+PROSE = "The quick brown fox jumps over the lazy dog. " * 40
+
+
+def report(*images):
+    return SimpleNamespace(
+        mediabox=LETTER,
+        image_elements=[
+            SimpleNamespace(bbox=SimpleNamespace(x0=x0, y0=y0, x1=x1, y1=y1))
+            for x0, y0, x1, y1 in images
+        ],
+    )
+
+
+def test_dense_born_digital_page_scores_high():
+    layer = score_text_layer(report(), PROSE)
+    assert layer["coverage"] == 1.0
+    assert layer["glyphs"] == 1.0
+    assert layer["density"] == 1.0
+    assert layer["score"] == 1.0
+
+
+def test_scanned_page_scores_zero():
+    # The page image bleeds over the edges, it is clipped to the page
+    layer = score_text_layer(report((-10, -10, 700, 800)), PROSE)
+    assert layer["coverage"] == 0.0
+    assert layer["score"] == 0.0
+
+
+def test_sparse_page_scores_by_density():
+    layer = score_text_layer(report((0, 0, 612, 396)), "Figure 1")
+    assert layer["coverage"] == 0.5
+    assert 0 < layer["density"] < 0.01
+    assert layer["score"] == round(0.5 * layer["density"], 4)
+
+
+def test_unmapped_glyphs_lower_the_score():
+    assert glyph_sanity("abcd") == 1.0
+    assert glyph_sanity("ab(cid:12)(cid:13)") == 0.5
+    assert glyph_sanity("ab�\x07") == 0.5
+    assert glyph_sanity("   ") == 0.0
+    layer = score_text_layer(report(), PROSE.replace("o", "(cid:3)"))
+    assert layer["glyphs"] < 1.0
+    assert layer["score"] == round(layer["glyphs"] * layer["density"], 4)
+
+
+def test_page_response_is_the_model_output_format():
+    response = json.loads(page_response("Héllo\nworld"))
+    assert response == {
+        "primary_language": None,
+        "is_rotation_valid": True,
+        "rotation_correction": 0,
+        "is_table": False,
+        "is_diagram": False,
+        "natural_text": "Héllo\nworld",
+    }
@@ -0,0 +1,163 @@
+import json
+import re
+import threading
+import unicodedata
+from collections import deque
+from dataclasses import asdict
+
+from olmocr.prompts import PageResponse
+
+# Characters per square inch from which a page counts as fully laid out with text,
+# about a third of a dense page of prose
+DENSE_CHARS_PER_SQUARE_INCH = 10
+POINTS_PER_INCH = 72
+
+# Glyphs pypdf could not map to Unicode are written as "(cid:123)"
+CID_PATTERN = re.compile(r"\(cid:\d+\)")
+# Control, unassigned, private use and surrogate characters
+BAD_CATEGORIES = {"Cc", "Cn", "Co", "Cs"}
+
+
+def glyph_sanity(text):
+    """Return the fraction of non-space characters that are real, printable glyphs"""
+    text, unmapped = CID_PATTERN.subn("", text)
+    good = bad = 0
+    for char in text:
+        if char.isspace():
+            continue
+        if char == "\ufffd" or unicodedata.category(char) in BAD_CATEGORIES:
+            bad += 1
+        else:
+            good += 1
+    bad += unmapped
+    return good / (good + bad) if good + bad else 0.0
+
+
+def image_coverage(report):
+    """Return the fraction of the page covered by images, at most 1"""
+    page = report.mediabox
+    page_area = (page.x1 - page.x0) * (page.y1 - page.y0)
+    if page_area <= 0:
+        return 1.0
+    covered = 0.0
+    for element in report.image_elements:
+        box = element.bbox
+        # Clip to the page, images often bleed over the edges
+        width = min(box.x1, page.x1) - max(box.x0, page.x0)
+        height = min(box.y1, page.y1) - max(box.y0, page.y0)
+        if width > 0 and height > 0:
+            covered += width * height
+    return min(1.0, covered / page_area)
+
+
+def score_text_layer(report, text):
+    """Score how well a page's text layer stands in for OCR, see the README
+
+    Returns a dict of the three signals, each between 0 and 1, and their product
+    `score`: `coverage` is the share of the page not covered by images (a scan is
+    one page-sized image, whatever text is hidden on top of it), `glyphs` the share
+    of characters that are real glyphs and `density` the amount of text for the
+    page's area, relative to DENSE_CHARS_PER_SQUARE_INCH.
+    """
+    page = report.mediabox
+    square_inches = (page.x1 - page.x0) * (page.y1 - page.y0) / POINTS_PER_INCH**2
+    chars = sum(1 for char in text if not char.isspace())
+    coverage = 1.0 - image_coverage(report)
+    glyphs = glyph_sanity(text)
+    density = (
+        min(1.0, chars / square_inches / DENSE_CHARS_PER_SQUARE_INCH)
+        if square_inches > 0
+        else 0.0
+    )
+    return {
+        "score": round(coverage * glyphs * density, 4),
+        "coverage": round(coverage, 4),
+        "glyphs": round(glyphs, 4),
+        "density": round(density, 4),
+        "chars": chars,
+    }
+
+
+def page_response(text):
+    """Return a page's text layer as the structured output the model emits
+
+    The text layer says nothing of the language, tables or diagrams of the page, so
+    the language is null and the page is taken as upright text.
+    """
+    response = PageResponse(
+        primary_language=None,
+        is_rotation_valid=True,
+        rotation_correction=0,
+        is_table=False,
+        is_diagram=False,
+        natural_text=text,
+    )
+    return json.dumps(asdict(response), ensure_ascii=False)
+
+
+class TextLayerStats:
+    """Decisions of the text-layer fast path and the model time they saved
+
+    The time a page would have spent in the model is estimated by the moving
+    average of the pages that did go to the model. The last `history` decisions
+    are kept for the service status.
+    """
+
+    def __init__(self, threshold, history=100, smoothing=0.1):
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.model_page_seconds = None
+        self.decisions = {"text_layer": 0, "model": 0}
+        self.saved_seconds = 0.0
+        self._recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def accepts(self, layer):
+        return layer is not None and layer["score"] >= self.threshold
+
+    def observe_model_page(self, seconds):
+        """Record how long a page took in the model, from submission to result"""
+        with self._lock:
+            if self.model_page_seconds is None:
+                self.model_page_seconds = seconds
+            else:
+                self.model_page_seconds += self.smoothing * (
+                    seconds - self.model_page_seconds
+                )
+
+    def record(self, label, page_number, layer, seconds):
+        """Record the decision of a page and return it, with the time saved if any
+
+        `seconds` is the time spent extracting and scoring the text layer.
+        """
+        source = "text_layer" if self.accepts(layer) else "model"
+        decision = {
+            "file": label,
+            "page": page_number,
+            "source": source,
+            "score": layer["score"] if layer is not None else None,
+            "text_layer_seconds": round(seconds, 4),
+            "saved_seconds": None,
+        }
+        with self._lock:
+            self.decisions[source] += 1
+            if source == "text_layer" and self.model_page_seconds is not None:
+                saved = max(0.0, self.model_page_seconds - seconds)
+                decision["saved_seconds"] = round(saved, 3)
+                self.saved_seconds += saved
+            self._recent.append(decision)
+        return decision
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "decisions": dict(self.decisions),
+                "saved_seconds": round(self.saved_seconds, 3),
+                "model_page_seconds": (
+                    round(self.model_page_seconds, 3)
+                    if self.model_page_seconds is not None
+                    else None
+                ),
+                "recent": list(self._recent),
+            }
@@ -0,0 +1,123 @@
+import json
+import os
+import re
+from contextlib import contextmanager
+
+from torch import nn
+
+SINGLE_SHARD = "model.safetensors"
+SHARD_INDEX = "model.safetensors.index.json"
+
+
+def safetensors_shards(model_path):
+    """Return the safetensors files of a checkpoint directory, or None"""
+    index_path = os.path.join(model_path, SHARD_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [
+            os.path.join(model_path, shard)
+            for shard in sorted(set(weight_map.values()))
+        ]
+    if os.path.exists(os.path.join(model_path, SINGLE_SHARD)):
+        return [os.path.join(model_path, SINGLE_SHARD)]
+    return None
+
+
+@contextmanager
+def parameters_on_meta():
+    """Create the parameters of new modules on the meta device, without storage
+
+    Buffers such as the rotary frequencies are small and computed at construction,
+    they are still created for real.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            param_class = type(module._parameters[name])
+            module._parameters[name] = param_class(
+                module._parameters[name].to("meta"), requires_grad=param.requires_grad
+            )
+
+    nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def set_tensor(model, name, tensor):
+    """Replace the parameter or buffer `name` of `model`, returning False if unknown"""
+    module_name, _, leaf = name.rpartition(".")
+    try:
+        module = model.get_submodule(module_name)
+    except AttributeError:
+        return False
+    if leaf in module._parameters:
+        module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+    elif leaf in module._buffers:
+        module._buffers[leaf] = tensor
+    else:
+        return False
+    return True
+
+
+def load_streaming(model_class, model_path, dtype, device):
+    """Load a checkpoint straight onto `device`, one tensor at a time
+
+    The model is built without parameter storage, then each safetensors shard is
+    memory-mapped and its tensors are cast to `dtype` and copied to `device` one by
+    one, so the host never holds more than a tensor beyond the mapped shard. Returns
+    None when the checkpoint has no safetensors shards.
+    """
+    from safetensors import safe_open
+    from transformers import AutoConfig, GenerationConfig
+    from transformers.modeling_utils import no_init_weights
+
+    shards = safetensors_shards(model_path)
+    if shards is None:
+        return None
+
+    config = AutoConfig.from_pretrained(model_path)
+    with parameters_on_meta(), no_init_weights():
+        model = model_class._from_config(config, torch_dtype=dtype)
+    # Checkpoint names renamed by newer transformers releases
+    renames = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+
+    unexpected = []
+    for shard in shards:
+        with safe_open(shard, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                name = key
+                for pattern, replacement in renames.items():
+                    name, count = re.subn(pattern, replacement, name)
+                    if count:
+                        break
+                tensor = f.get_tensor(key)
+                tensor = tensor.to(
+                    device=device,
+                    dtype=dtype if tensor.is_floating_point() else None,
+                )
+                if not set_tensor(model, name, tensor):
+                    unexpected.append(key)
+                del tensor
+    if unexpected:
+        print(f"Ignored {len(unexpected)} unexpected weights, such as {unexpected[0]}")
+
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(
+            f"{len(missing)} weights are missing from {model_path}, such as "
+            f"{missing[0]}"
+        )
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        # No generation_config.json, keep the defaults derived from the config
+        pass
+    # Only the buffers are left on the host
+    return model.to(device).eval()